@@ -0,0 +1,301 @@
+'''
+Geometry fingerprints of the submissions, to find duplicates and near-duplicates
+
+Many submissions are versions of each other (e.g., _v2, _v3, _2nd, _3rd,
+_B ... _F), and some are identical to another file, only saved again. The
+fingerprint of a layout is a Merkle tree of its cells: each cell has a hash
+for each layer, of its own shapes (in any order) and of the layer hashes of
+its children with their placements, and a hash of all its layers. The cell
+names are not part of the hashes, so a file with renamed cells has the same
+fingerprint, and cells are matched by content across files.
+
+ - exact duplicates: files with the same top cell hash
+ - near-duplicates: files that share most of their cells (weighted by the
+   number of shapes), with a cell-level diff: the cells that changed (and
+   on which layers), were renamed, added or removed
+
+Fingerprints are cached in fingerprint_cache, keyed by the file contents.
+run_verification.py verifies only one file of each group of exact duplicates
+(with the same cell names), and merge/EBeam_merge.py --fingerprints lists
+the duplicates and near-duplicates in its log.
+
+Usage:
+  python fingerprint.py submissions                      (duplicate report)
+  python fingerprint.py --diff submissions/EBeam_a_v2.gds submissions/EBeam_a_v3.gds
+'''
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import pya
+
+cache_folder = 'fingerprint_cache'
+version = 2  # of the fingerprint format; cached fingerprints of other versions are computed again
+similarity_threshold = 0.9  # fraction of the shapes, in cells shared by two files, to be near-duplicates
+common_files = 20  # cells in more files than this (e.g., the grating couplers) do not make files candidates
+
+
+def sha(items):
+    h = hashlib.sha256()
+    for item in items:
+        h.update(item.encode('utf-8'))
+        h.update(b'\n')
+    return h.hexdigest()[:32]
+
+
+def shape_text(shape):
+    '''
+    The shape's type and geometry, as text (exact, unlike KLayout's hash values)
+    '''
+    if shape.is_box():
+        return 'box %s' % shape.box
+    if shape.is_path():
+        return 'path %s' % shape.path
+    if shape.is_text():
+        return 'text %s' % shape.text
+    if shape.is_edge():
+        return 'edge %s' % shape.edge
+    return 'polygon %s' % shape.polygon
+
+
+def instance_text(inst):
+    '''
+    The placement of an instance (without its cell)
+    '''
+    if inst.is_regular_array():
+        return '%s [%s %s %s %s]' % (inst.cplx_trans, inst.a, inst.b, inst.na, inst.nb)
+    return str(inst.cplx_trans)
+
+
+def fingerprint_layout(layout):
+    '''
+    Fingerprint of a layout: {'hash', 'layers': {layer: hash}, 'names', 'top_cells',
+    'cells': {name: {'hash', 'layers': {layer: [hash, own shapes]}, 'shapes'}}}
+    '''
+    layers = [(li, layout.get_info(li).to_s()) for li in layout.layer_indexes()]
+    cells = {}  # cell index: record
+    for ci in layout.each_cell_bottom_up():
+        cell = layout.cell(ci)
+        instances = [(cells[i.cell_index], instance_text(i)) for i in cell.each_inst()]
+        record = {'layers': {}, 'shapes': 0}
+        for li, name in layers:
+            own = sorted(shape_text(s) for s in cell.shapes(li).each())
+            children = sorted(child['layers'][name][0] + ' ' + t for child, t in instances if name in child['layers'])
+            if own or children:
+                record['layers'][name] = [sha(own + ['instances'] + children), len(own)]
+                record['shapes'] += len(own)
+        record['hash'] = sha(['%s %s' % (name, h[0]) for name, h in sorted(record['layers'].items())] +
+                             ['instances'] + sorted(child['hash'] + ' ' + t for child, t in instances))
+        record['name'] = cell.name
+        cells[ci] = record
+
+    top_cells = sorted(c.name for c in layout.top_cells())
+    tops = [cells[c.cell_index()] for c in layout.top_cells()]
+    layer_names = sorted(set(name for top in tops for name in top['layers']))
+    # the shapes are in database units, so the files are only the same with the same dbu
+    dbu = ['dbu %s' % layout.dbu]
+    return {'hash': sha(dbu + sorted(top['hash'] for top in tops)),
+            'layers': {name: sha(dbu + sorted(top['layers'][name][0] for top in tops if name in top['layers'])) for name in layer_names},
+            'names': sha(sorted(r['name'] for r in cells.values())),
+            'top_cells': top_cells,
+            'cells': {r.pop('name'): r for r in cells.values()}}
+
+
+def file_key(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    # the PCells of the libraries that are loaded are generated again when the file is read
+    h.update(('fingerprint %s %s' % (version, sorted(pya.Library.library_names()))).encode('utf-8'))
+    return h.hexdigest()
+
+
+def fingerprint_file(filename, cache_path=None):
+    '''
+    Fingerprint of a layout file (see fingerprint_layout), with 'file' added;
+    'error' instead if it cannot be read
+    '''
+    file_cache = os.path.join(cache_path, file_key(filename) + '.json') if cache_path else None
+    if file_cache and os.path.exists(file_cache):
+        try:
+            with open(file_cache, 'r') as f:
+                return dict(json.load(f), file=filename)
+        except (OSError, ValueError):
+            pass  # incomplete entry; compute it again
+    try:
+        layout = pya.Layout()
+        layout.read(filename)
+        result = fingerprint_layout(layout)
+    except Exception as e:
+        return {'file': filename, 'error': str(e)}
+    if file_cache:
+        with open(file_cache + '.tmp%s' % os.getpid(), 'w') as f:
+            json.dump(result, f, separators=(',', ':'))
+        os.replace(file_cache + '.tmp%s' % os.getpid(), file_cache)
+    return dict(result, file=filename)
+
+
+def fingerprint_files(files, jobs=None, cache_path=None):
+    '''
+    Fingerprints of the files, computed in parallel; in the order of the files
+    '''
+    if cache_path:
+        os.makedirs(cache_path, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(fingerprint_file, files, [cache_path] * len(files), chunksize=4))
+
+
+def duplicates(fingerprints, names=False):
+    '''
+    Groups of files with the same geometry (and, with names, the same cell names):
+    {first file: [the other files]}
+    '''
+    groups = {}
+    for fp in fingerprints:
+        if 'error' not in fp:
+            groups.setdefault((fp['hash'], fp['names']) if names else fp['hash'], []).append(fp['file'])
+    return {files[0]: files[1:] for files in groups.values() if len(files) > 1}
+
+
+def similarity(a, b):
+    '''
+    Fraction of the shapes of the two files that are in cells they share (by content)
+    '''
+    weights_a = {c['hash']: max(1, c['shapes']) for c in a['cells'].values()}
+    weights_b = {c['hash']: max(1, c['shapes']) for c in b['cells'].values()}
+    shared = sum(w for h, w in weights_a.items() if h in weights_b)
+    return shared / max(1, sum(weights_a.values()) + sum(weights_b.values()) - shared)
+
+
+def near_duplicates(fingerprints, threshold=similarity_threshold):
+    '''
+    Pairs of files (not exact duplicates) that share cells with at least threshold of their shapes:
+    [(file a, file b, similarity)], most similar first
+    '''
+    fingerprints = [fp for fp in fingerprints if 'error' not in fp]
+    # candidates: files sharing a cell that is not in many files
+    files_with = {}
+    for i, fp in enumerate(fingerprints):
+        for h in set(c['hash'] for c in fp['cells'].values()):
+            files_with.setdefault(h, []).append(i)
+    candidates = set()
+    for files in files_with.values():
+        if 1 < len(files) <= common_files:
+            candidates.update((i, j) for i in files for j in files if i < j)
+    pairs = []
+    for i, j in candidates:
+        a, b = fingerprints[i], fingerprints[j]
+        if a['hash'] == b['hash']:
+            continue
+        s = similarity(a, b)
+        if s >= threshold:
+            pairs.append((a['file'], b['file'], s))
+    return sorted(pairs, key=lambda p: (-p[2], p[0], p[1]))
+
+
+def diff(a, b):
+    '''
+    Cell-level diff of two fingerprints:
+    {'changed': [(cell, [layers])], 'renamed': [(cell in a, cell in b)], 'removed': [cells], 'added': [cells], 'same': count}
+    '''
+    by_hash_b = {}
+    for name, c in b['cells'].items():
+        by_hash_b.setdefault(c['hash'], []).append(name)
+    result = {'changed': [], 'renamed': [], 'removed': [], 'added': [], 'same': 0}
+    matched_b = set()
+    for name, c in sorted(a['cells'].items()):
+        if name in b['cells'] and b['cells'][name]['hash'] == c['hash']:
+            result['same'] += 1
+            matched_b.add(name)
+        elif name in b['cells']:
+            layers_b = b['cells'][name]['layers']
+            layers = sorted(l for l in set(c['layers']) | set(layers_b) if c['layers'].get(l, [None])[0] != layers_b.get(l, [None])[0])
+            result['changed'].append((name, layers))
+            matched_b.add(name)
+        else:
+            renamed = [n for n in by_hash_b.get(c['hash'], []) if n not in a['cells'] and n not in matched_b]
+            if renamed:
+                result['renamed'].append((name, renamed[0]))
+                matched_b.add(renamed[0])
+            else:
+                result['removed'].append(name)
+    result['added'] = sorted(n for n in b['cells'] if n not in matched_b)
+    return result
+
+
+def print_diff(a, b, log=print):
+    d = diff(a, b)
+    log('%s -> %s: %s cells the same, %s changed, %s renamed, %s removed, %s added' % (
+        os.path.basename(a['file']), os.path.basename(b['file']), d['same'], len(d['changed']), len(d['renamed']), len(d['removed']), len(d['added'])))
+    for name, layers in d['changed']:
+        log('  ~ %s (layers %s)' % (name, ', '.join(layers)))
+    for name_a, name_b in d['renamed']:
+        log('  = %s -> %s' % (name_a, name_b))
+    for name in d['removed']:
+        log('  - %s' % name)
+    for name in d['added']:
+        log('  + %s' % name)
+
+
+def print_report(fingerprints, log=print, threshold=similarity_threshold, diffs=True):
+    '''
+    Exact duplicates and near-duplicates of the files, with the cell-level diffs
+    '''
+    by_file = {fp['file']: fp for fp in fingerprints}
+    for fp in fingerprints:
+        if 'error' in fp:
+            log('%s: could not be read: %s' % (fp['file'], fp['error']))
+    groups = duplicates(fingerprints)
+    log('Exact duplicates: %s groups, %s redundant files' % (len(groups), sum(len(g) for g in groups.values())))
+    for first, others in sorted(groups.items()):
+        log('  - %s = %s' % (os.path.basename(first), ', '.join(os.path.basename(f) for f in others)))
+    pairs = near_duplicates(fingerprints, threshold)
+    log('Near-duplicates: %s pairs sharing at least %s%% of their shapes' % (len(pairs), int(100 * threshold)))
+    for a, b, s in pairs:
+        log('  - %s ~ %s: %.0f%%' % (os.path.basename(a), os.path.basename(b), 100 * s))
+        if diffs:
+            print_diff(by_file[a], by_file[b], lambda line: log('    ' + line))
+
+
+def find_files(paths):
+    files = []
+    for p in paths:
+        if os.path.isdir(p):
+            files += [os.path.join(p, f) for f in sorted(os.listdir(p)) if f.lower().endswith(('.gds', '.oas'))]
+        else:
+            files.append(p)
+    return files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Geometry fingerprints of layout files: duplicates, near-duplicates, and cell-level diffs')
+    parser.add_argument('files', nargs='*', help='.gds/.oas files, or folders containing them')
+    parser.add_argument('--diff', nargs=2, metavar=('A', 'B'), help='cell-level diff of two files')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes (default: all CPU cores)')
+    parser.add_argument('--threshold', type=float, default=similarity_threshold, help='similarity of near-duplicates, 0 to 1')
+    parser.add_argument('--no-diffs', action='store_true', help='do not list the cell-level diffs of the near-duplicates')
+    parser.add_argument('--no-cache', action='store_true', help='compute all the fingerprints again')
+    parser.add_argument('--json', default=None, help='output file for the fingerprints, in JSON')
+    args = parser.parse_args()
+
+    cache_path = None if args.no_cache else os.path.join(os.path.dirname(os.path.realpath(__file__)), cache_folder)
+    start_time = time.time()
+    if args.diff:
+        a, b = fingerprint_files(args.diff, 2, cache_path)
+        print_diff(a, b)
+        sys.exit(0)
+    if not args.files:
+        parser.error('no files given')
+
+    files = find_files(args.files)
+    fingerprints = fingerprint_files(files, args.jobs, cache_path)
+    print('Fingerprints of %s files, in %.1f seconds' % (len(files), time.time() - start_time))
+    print_report(fingerprints, threshold=args.threshold, diffs=not args.no_diffs)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(fingerprints, f, indent=1)
@@ -0,0 +1,94 @@
+'''
+Import time of the command-line entry points, against a budget
+
+Each entry point is imported in a new Python process, with -X importtime,
+and the cumulative import time of its module is compared with its budget,
+so that a new module-level import of KLayout, SiEPIC, PyQt6, matplotlib or
+scipy in a tool that does not need it is noticed. The slowest imports of
+each entry point are listed, to find what to import lazily (in the function
+that uses it).
+
+Usage:
+  python import_times.py              (all the entry points)
+  python import_times.py fetch verify
+
+Exits with 1 if an entry point is over its budget.
+'''
+
+import os
+import sys
+import subprocess
+import argparse
+
+path = os.path.dirname(os.path.realpath(__file__))
+runs = 5  # the fastest run is used
+slowest = 5  # imports listed for each entry point
+
+# name: (folder, module, budget in ms; None: reported only)
+entry_points = {
+    'fetch': ('measurements', 'fetch_measurement_data', 200),
+    'catalog': ('measurements', 'viewer', 50),
+    'verify': ('.', 'klayout_server', 100),
+    'analysis': ('measurements', 'analysis', None),
+    'viewer gui': ('measurements', 'viewer_gui', None),
+    'verify (in process)': ('.', 'run_verification', None),
+}
+
+
+def import_times(folder, module):
+    '''
+    -X importtime of the module: {name: (self, cumulative, depth)} in microseconds,
+    for the module and the modules it imports
+    '''
+    folder = os.path.join(path, folder)
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module], cwd=folder,
+                            env=dict(os.environ, PYTHONPATH=os.pathsep.join([folder, os.environ.get('PYTHONPATH', '')])),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True).stderr
+    # lines: "import time: self [us] | cumulative | imported package", nested imports are indented
+    lines = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        t_self, t_cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        lines.append((name.strip(), int(t_self), int(t_cumulative), depth))
+    # the module is the last top-level import; the ones before it are the interpreter's own
+    end = max([i for i, l in enumerate(lines) if l[0] == module and l[3] == 0], default=None)
+    if end is None:
+        raise RuntimeError('%s could not be imported:\n%s' % (module, output[-2000:]))
+    start = max([i for i, l in enumerate(lines[:end]) if l[3] == 0], default=-1) + 1
+    return {name: (t_self, t_cumulative, depth) for name, t_self, t_cumulative, depth in lines[start:end + 1]}
+
+
+def measure(folder, module, runs=runs):
+    '''
+    Fastest of the runs: (total in ms, [(import, cumulative ms)] of the slowest direct imports)
+    '''
+    best = None
+    for r in range(runs):
+        times = import_times(folder, module)
+        if best is None or times[module][1] < best[module][1]:
+            best = times
+    imports = sorted(((name, t[1] / 1000) for name, t in best.items() if t[2] == 1), key=lambda i: -i[1])
+    return best[module][1] / 1000, imports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Import time of the command-line entry points, against a budget')
+    parser.add_argument('names', nargs='*', help='entry points: %s (default: all)' % ', '.join(entry_points))
+    parser.add_argument('--runs', type=int, default=runs, help='runs per entry point; the fastest is used')
+    args = parser.parse_args()
+
+    over = []
+    for name in args.names or entry_points:
+        folder, module, budget = entry_points[name]
+        total, imports = measure(folder, module, args.runs)
+        status = '' if budget is None else (' (budget %s ms)' % budget if total <= budget else ' OVER the budget of %s ms' % budget)
+        print('%s: %s, %.1f ms%s' % (name, module, total, status))
+        for i, t in imports[:slowest]:
+            print('    %8.1f ms  %s' % (t, i))
+        if budget is not None and total > budget:
+            over.append(name)
+    if over:
+        print('Over the budget: %s' % ', '.join(over))
+    sys.exit(1 if over else 0)
@@ -0,0 +1,385 @@
+'''
+Warm KLayout worker, for a quick edit-verify loop
+
+Each of run_verification.py, preflight.py and merge/EBeam_merge.py takes
+several seconds to start: importing pya, SiEPIC and siepic_ebeam_pdk, and
+loading the technology. This server does that once, and then runs jobs
+sent over a Unix socket; each job runs in a child process forked from the
+warm server, so it starts in milliseconds, jobs run in parallel, and a
+job cannot change the state of the server (e.g., prepare deletes the
+libraries, like the merge workers do).
+
+Jobs:
+  verify:    run_verification.verify_file_cached (with verification_cache)
+  preflight: preflight.check_file
+  prepare:   EBeam_merge.prepare_submission_cached (with merge/cache)
+  render:    PNG image of a cell (default: the top cell)
+
+Modules that were edited since the server started (e.g., run_verification.py,
+or preflight.py and the other modules the tools import) are reloaded in the
+job's process, so the results are the same as running the scripts.
+
+Usage:
+  python klayout_server.py verify submissions/EBeam_username.gds [more files]
+  python klayout_server.py preflight submissions/EBeam_username.gds
+  python klayout_server.py prepare submissions/EBeam_username.gds
+  python klayout_server.py render submissions/EBeam_username.gds [--cell name] [--output file.png]
+  python klayout_server.py start | stop | status
+
+The server is started in the background by the first job, and stops after
+idle_timeout. With --local, or if the server cannot be started, the job runs
+in the client's process instead.
+
+Linux and macOS only (Unix socket and fork).
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+path = os.path.dirname(os.path.realpath(__file__))
+socket_path = os.path.join(tempfile.gettempdir(), 'klayout_server_%s.sock' % os.getuid())
+log_file = os.path.join(tempfile.gettempdir(), 'klayout_server_%s.log' % os.getuid())
+idle_timeout = 3600  # seconds without jobs, before the server stops
+start_timeout = 120  # seconds to wait for the server to start
+request_timeout = 10  # seconds for a client to send its request, so that a stalled client does not block the server
+render_size = [800, 600]  # pixels
+
+_modules = {}  # modules loaded by the server: {name: (module, modification time of its file)}
+# the modules imported by the tools, reloaded before them; then the tools, which import them
+dependencies = ['preflight', 'fingerprint', 'floorplan', 'gds_stream', 'label_index', 'cell_dedup']
+tools = ['run_verification', 'EBeam_merge']
+
+
+def load_modules():
+    '''
+    Import the tools, and load the technology; done once, in the server
+    '''
+    sys.path.insert(0, path)
+    sys.path.insert(0, os.path.join(path, 'merge'))
+    import importlib
+    # imported for their side effects, once in the server, so that the jobs do not import them:
+    # KLayout and its layout view (for render), and the PDK, which registers the EBeam technology
+    for name in ['pya', 'klayout.lay', 'siepic_ebeam_pdk']:
+        importlib.import_module(name)
+    for name in dependencies + tools:
+        m = importlib.import_module(name)
+        _modules[name] = (m, os.path.getmtime(m.__file__))
+    _modules['run_verification'][0].load_technology()
+
+
+def module(name):
+    '''
+    A module loaded by the server. The modules whose file changed since are
+    reloaded, and if one of their dependencies changed, the tools are too.
+    '''
+    import importlib
+    if name not in _modules:
+        load_modules()
+    changed = [n for n in dependencies + tools if os.path.getmtime(_modules[n][0].__file__) != _modules[n][1]]
+    if any(n in dependencies for n in changed):
+        changed += [n for n in tools if n not in changed]
+    for n in dependencies + tools:
+        if n in changed:
+            m = importlib.reload(_modules[n][0])
+            _modules[n] = (m, os.path.getmtime(m.__file__))
+            if n == 'run_verification':
+                m.load_technology()
+    return _modules[name][0]
+
+
+def render_cell(filename, cell=None, output=None, size=render_size):
+    '''
+    Render a cell of a layout file as a PNG, with the EBeam layer properties; returns the PNG file
+    '''
+    import klayout.db as pya
+    import klayout.lay as lay
+    layout = pya.Layout()
+    layout.read(filename)
+    layout.technology_name = 'EBeam'
+    c = layout.cell(cell) if cell else layout.top_cell()
+    if c is None:
+        raise ValueError('cell %s not found in %s' % (cell, filename))
+    output = output or os.path.splitext(filename)[0] + '.png'
+
+    layout_view = lay.LayoutView()
+    cell_view_index = layout_view.create_layout(True)
+    layout_view.active_cellview_index = cell_view_index
+    cell_view = layout_view.cellview(cell_view_index)
+    cell_view.layout().assign(layout)
+    cell_view.cell = cell_view.layout().cell(c.name)
+    layout_view.load_layer_props(layout.technology().eff_layer_properties_file())
+    layout_view.set_config("text-font", 3)
+    layout_view.set_config("background-color", "#ffffff")
+    layout_view.set_config("grid-show-ruler", "false")
+    layout_view.max_hier()
+    layout_view.zoom_fit()
+    layout_view.save_image(output, size[0], size[1])
+    return output
+
+
+def run_job(job, args):
+    '''
+    Run one job; returns its result (JSON)
+    '''
+    filename = os.path.abspath(args['file'])
+    if job == 'verify':
+        run_verification = module('run_verification')
+        cache_path = None
+        if args.get('cache', True):
+            cache_path = os.path.join(path, run_verification.cache_folder)
+            os.makedirs(cache_path, exist_ok=True)
+        return run_verification.verify_file_cached(filename, cache_path, args.get('preflight', True))
+    if job == 'preflight':
+        report = module('preflight').check_file(filename)
+        module('preflight').print_report(report)
+        return report
+    if job == 'prepare':
+        EBeam_merge = module('EBeam_merge')
+        EBeam_merge.disable_libraries(False)
+        cache_path = None
+        if args.get('cache', True):
+            cache_path = os.path.join(path, 'merge', EBeam_merge.cache_folder)
+            os.makedirs(cache_path, exist_ok=True)
+        result, key, cached = EBeam_merge.prepare_submission_cached(filename, cache_path)
+        print('\n'.join(result['log']))
+        # the clipped cell is not sent back; it is in the cache (result['gds_file']), or written to the output file
+        if args.get('output') and result.get('gds_file'):
+            shutil.copyfile(result['gds_file'], args['output'])
+        elif args.get('output') and result['gds']:
+            with open(args['output'], 'wb') as file:
+                file.write(result['gds'])
+        result = {k: v for k, v in result.items() if k not in ('gds', 'log')}
+        result.update({'file': filename, 'key': key, 'cached': cached})
+        return result
+    if job == 'render':
+        return {'file': filename, 'png': render_cell(filename, args.get('cell'), args.get('output'), args.get('size', render_size))}
+    raise ValueError('unknown job: %s' % job)
+
+
+def send(connection, message):
+    connection.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+
+def receive(connection):
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = connection.recv(1 << 16)
+        if not chunk:
+            break
+        data += chunk
+    return json.loads(data) if data else None
+
+
+def run_child(connection, request):
+    '''
+    In the forked process: run the job, with its output (including KLayout's) captured, and send the reply
+    '''
+    reply = {'result': None, 'error': None}
+    with tempfile.TemporaryFile() as captured:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(captured.fileno(), 1)
+        os.dup2(captured.fileno(), 2)
+        try:
+            os.chdir(request.get('cwd', path))
+            reply['result'] = run_job(request['job'], request['args'])
+        except Exception as e:
+            reply['error'] = '%s: %s' % (type(e).__name__, e)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        captured.seek(0)
+        reply['output'] = captured.read().decode('utf-8', errors='replace')
+    send(connection, reply)
+
+
+def serve(socket_path=socket_path, idle_timeout=idle_timeout):
+    '''
+    The server: load the tools, then fork a process for each job, until idle_timeout or shutdown
+    '''
+    start_time = time.time()
+    load_modules()
+    print('KLayout server: tools loaded in %.1f seconds' % (time.time() - start_time), flush=True)
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path + '.tmp%s' % os.getpid())
+    # renamed into place when ready, so that clients do not connect before
+    os.replace(socket_path + '.tmp%s' % os.getpid(), socket_path)
+    server.listen(16)
+    server.settimeout(idle_timeout)
+    print('KLayout server: listening on %s' % socket_path, flush=True)
+
+    jobs = 0
+    children = set()
+    try:
+        while True:
+            try:
+                connection, _ = server.accept()
+            except socket.timeout:
+                print('KLayout server: idle for %s seconds, stopping' % idle_timeout, flush=True)
+                break
+            # collect the finished jobs
+            for pid in list(children):
+                if os.waitpid(pid, os.WNOHANG)[0]:
+                    children.discard(pid)
+
+            connection.settimeout(request_timeout)
+            try:
+                request = receive(connection)
+            except (OSError, ValueError) as e:
+                print('KLayout server: no valid request (%s: %s)' % (type(e).__name__, e), flush=True)
+                request = None
+            if not request:
+                connection.close()
+                continue
+            if request['job'] == 'ping':
+                send(connection, {'result': {'pid': os.getpid(), 'uptime': time.time() - start_time, 'jobs': jobs, 'running': len(children)}})
+                connection.close()
+                continue
+            if request['job'] == 'shutdown':
+                send(connection, {'result': {'pid': os.getpid(), 'jobs': jobs}})
+                connection.close()
+                print('KLayout server: stopped, after %s jobs' % jobs, flush=True)
+                break
+
+            jobs += 1
+            pid = os.fork()
+            if pid == 0:
+                server.close()
+                connection.settimeout(None)
+                try:
+                    run_child(connection, request)
+                finally:
+                    os._exit(0)
+            children.add(pid)
+            connection.close()
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        for pid in children:
+            os.waitpid(pid, 0)
+
+
+def request(job, args=None, socket_path=socket_path, timeout=None):
+    '''
+    Send a job to the server, and wait for the reply; raises OSError if the server is not running
+    '''
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(timeout)
+    try:
+        connection.connect(socket_path)
+        send(connection, {'job': job, 'args': args or {}, 'cwd': os.getcwd()})
+        reply = receive(connection)
+    finally:
+        connection.close()
+    if reply is None:
+        raise OSError('no reply from the server')
+    return reply
+
+
+def start_server(socket_path=socket_path, idle_timeout=idle_timeout):
+    '''
+    Start the server in the background, if it is not running; returns True when it is ready
+    '''
+    try:
+        request('ping', socket_path=socket_path, timeout=5)
+        return True
+    except OSError:
+        pass
+    with open(log_file, 'a') as log:
+        subprocess.Popen([sys.executable, os.path.realpath(__file__), 'serve', '--socket', socket_path, '--idle', str(idle_timeout)],
+                         cwd=path, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+                         start_new_session=True, env=dict(os.environ, QT_QPA_PLATFORM='offscreen'))
+    deadline = time.time() + start_timeout
+    while time.time() < deadline:
+        try:
+            request('ping', socket_path=socket_path, timeout=5)
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def submit(job, args, local=False, socket_path=socket_path):
+    '''
+    Run a job on the server (started if needed), or in this process with local=True,
+    or if the server cannot be started. Returns the reply: {'result', 'error', 'output'}
+    '''
+    if not local and start_server(socket_path):
+        try:
+            return request(job, args, socket_path)
+        except OSError as e:
+            print('KLayout server: %s; running the job here' % e)
+    try:
+        return {'result': run_job(job, args), 'error': None, 'output': ''}
+    except Exception as e:
+        return {'result': None, 'error': '%s: %s' % (type(e).__name__, e), 'output': ''}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Warm KLayout worker, for verification, the merge, and rendering')
+    parser.add_argument('command', choices=['verify', 'preflight', 'prepare', 'render', 'start', 'stop', 'status', 'serve'])
+    parser.add_argument('files', nargs='*', help='layout files, for the jobs')
+    parser.add_argument('--socket', default=socket_path, help='Unix socket of the server')
+    parser.add_argument('--idle', type=float, default=idle_timeout, help='seconds without jobs, before the server stops')
+    parser.add_argument('--local', action='store_true', help='run the job in this process, without the server')
+    parser.add_argument('--no-cache', action='store_true', help='do not use the verification or merge cache')
+    parser.add_argument('--no-preflight', action='store_true', help='run layout_check, even if the pre-flight check fails')
+    parser.add_argument('--cell', help='render: cell to render (default: the top cell)')
+    parser.add_argument('--output', help='render: PNG file; prepare: GDSII file for the clipped cell')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of files sent at the same time (default: all CPU cores)')
+    args = parser.parse_intermixed_args()
+
+    if args.command == 'serve':
+        serve(args.socket, args.idle)
+        sys.exit(0)
+    if args.command == 'start':
+        ok = start_server(args.socket, args.idle)
+        print('KLayout server: %s' % ('running' if ok else 'could not be started, see %s' % log_file))
+        sys.exit(0 if ok else 1)
+    if args.command in ('stop', 'status'):
+        try:
+            reply = request('shutdown' if args.command == 'stop' else 'ping', socket_path=args.socket, timeout=5)
+            print('KLayout server: %s' % json.dumps(reply['result']))
+        except OSError:
+            print('KLayout server: not running')
+        sys.exit(0)
+
+    if not args.files:
+        parser.error('no files given')
+    job_args = {'cache': not args.no_cache, 'preflight': not args.no_preflight, 'cell': args.cell, 'output': args.output}
+    if not args.local:
+        start_server(args.socket, args.idle)  # once, before the files are sent in parallel
+
+    def run(filename):
+        return submit(args.command, dict(job_args, file=filename), args.local, args.socket)
+
+    errors = 0
+    with ThreadPoolExecutor(max_workers=args.jobs or os.cpu_count()) as executor:
+        for filename, reply in zip(args.files, executor.map(run, args.files)):
+            if reply['output']:
+                print(reply['output'], end='' if reply['output'].endswith('\n') else '\n')
+            result = reply['result']
+            if reply['error']:
+                print('%s: %s' % (filename, reply['error']))
+                errors += 1
+            elif args.command == 'verify':
+                print('%s: %s errors, %.1f seconds%s' % (filename, result['errors'], result['runtime'], ' (cached)' if result['cached'] else ''))
+                errors += result['errors']
+            elif args.command == 'preflight':
+                errors += len(result['errors'])
+            elif args.command == 'prepare':
+                print('%s: cell %s, course %s%s' % (filename, result['cell_name'], result['course'], ' (cached)' if result['cached'] else ''))
+            elif args.command == 'render':
+                print('%s: %s' % (filename, result['png']))
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,221 @@
+'''
+Batch analysis of the measured spectra, for all the devices in the catalog
+
+The spectra are read from the spectrum store (spectra.py), as arrays of
+shape (devices x 4 channels, points) for each wavelength grid, and all the
+parameters are computed with numpy operations over the whole array:
+ - noise-floor mask: points and channels above noise_floor
+ - insertion loss: -maximum transmission, and its wavelength
+ - resonances (dips deeper than dip_depth below the upper envelope):
+   free spectral range (median spacing), extinction of the deepest dip
+ - rings: Q of the deepest resonance, from its full width at half depth
+ - Bragg gratings, BraggMMcavity, contra-directional couplers:
+   bandwidth of the main peak, bandwidth_level below its maximum
+
+The results are written to measurement_analysis.csv, one row per channel
+above the noise floor, keyed by the opt_in label.
+
+Usage:
+  python measurements/analysis.py
+'''
+
+import os
+import re
+import sys
+import csv
+import time
+import numpy as np
+from catalog import build_catalog, load_catalog, save_catalog, catalog_file
+from spectra import SpectrumStore, convert, mat_files_folder
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+analysis_file = 'measurement_analysis.csv'
+noise_floor = -50  # dB, same as the viewer
+dip_depth = 3  # dB, minimum depth of a resonance, below the upper envelope
+envelope_width = 2.0  # nm, window for the upper envelope, and the minimum spacing between resonances
+bandwidth_level = 3  # dB, below the peak, for the Bragg bandwidth
+batch_files = 256  # files analysed at once, to limit the memory used
+
+# device type, from the opt_in label (the first match)
+device_types = [('ring', r'ring|crow|(^|_)m?rr'), ('bragg', r'bragg|contra|cdc'), ('mzi', r'mzi|mz|machzehnder|michelson')]
+
+columns = ['opt_in', 'file', 'channel', 'type', 'valid_fraction', 'insertion_loss', 'peak_wavelength',
+           'resonances', 'fsr', 'extinction', 'resonance_wavelength', 'q', 'bragg_wavelength', 'bragg_bandwidth']
+
+
+def device_type(opt_in):
+    for name, pattern in device_types:
+        if re.search(pattern, opt_in, re.IGNORECASE):
+            return name
+    return ''
+
+
+def running_max(x, w):
+    '''
+    Maximum of x over a window of w points centered on each point, along the last axis.
+    van Herk / Gil-Werman: cumulative maxima in blocks of w, forward and backward, so the
+    cost does not depend on w.
+    '''
+    m, n = x.shape
+    half = w // 2
+    blocks = -(-(n + w) // w)
+    padded = np.full((m, blocks * w), -np.inf)
+    padded[:, half:half + n] = x
+    b = padded.reshape(m, blocks, w)
+    forward = np.maximum.accumulate(b, axis=2).reshape(m, -1)
+    backward = np.maximum.accumulate(b[:, :, ::-1], axis=2)[:, :, ::-1].reshape(m, -1)
+    # window [i, i + w - 1] in the padded array is centered on point i of x
+    return np.maximum(backward[:, :n], forward[:, w - 1:w - 1 + n])
+
+
+def edges(inside, center):
+    '''
+    The run of True in each row of inside that contains the center index:
+    (first, last) indices of the run
+    '''
+    m, n = inside.shape
+    j = np.arange(n)
+    left = np.where(~inside & (j < center[:, None]), j, -1).max(axis=1) + 1
+    right = np.where(~inside & (j > center[:, None]), j, n).min(axis=1) - 1
+    return left, right
+
+
+def group_median(rows, values, m):
+    '''
+    Median of the values for each row (NaN for rows without values)
+    '''
+    order = np.lexsort((values, rows))
+    rows, values = rows[order], values[order]
+    counts = np.bincount(rows, minlength=m)
+    starts = np.cumsum(counts) - counts
+    median = np.full(m, np.nan)
+    has = counts > 0
+    median[has] = values[starts[has] + counts[has] // 2]
+    return median
+
+
+def analyze_spectra(wavelengths, x, types):
+    '''
+    Parameters of the spectra x [dB], of shape (m, points), on the wavelengths [nm];
+    types: device type for each spectrum (see device_types). Returns {column: array of m values}
+    '''
+    m, n = x.shape
+    step = (wavelengths[-1] - wavelengths[0]) / (n - 1)
+    rows = np.arange(m)
+    valid = x > noise_floor  # NaN is False
+    y = np.where(np.isnan(x), -np.inf, x)
+    result = {'valid_fraction': valid.mean(axis=1)}
+
+    peak = np.argmax(y, axis=1)
+    result['insertion_loss'] = -y[rows, peak]
+    result['peak_wavelength'] = wavelengths[peak]
+
+    # resonances: local minima over the envelope window, deep enough below the envelope
+    w = max(3, int(envelope_width / step) | 1)
+    envelope = running_max(y, w)
+    local_min = -running_max(-y, w)
+    # only the first point of a flat bottom
+    descending = np.concatenate([np.ones((m, 1), dtype=bool), y[:, 1:] < y[:, :-1]], axis=1)
+    dips = (y == local_min) & descending & (envelope - y > dip_depth) & (envelope > noise_floor + dip_depth)
+    r, c = np.nonzero(dips)
+    result['resonances'] = np.bincount(r, minlength=m)
+    same = r[1:] == r[:-1]
+    result['fsr'] = group_median(r[1:][same], np.diff(wavelengths[c])[same], m)
+
+    depth = np.where(dips, envelope - y, -np.inf)
+    deepest = np.argmax(depth, axis=1)
+    has = result['resonances'] > 0
+    result['extinction'] = np.where(has, depth[rows, deepest], np.nan)
+    result['resonance_wavelength'] = np.where(has, wavelengths[deepest], np.nan)
+
+    # Q of the deepest resonance, from the width where the transmission is below half of the dip (linear)
+    ring = has & (types == 'ring')
+    result['q'] = np.full(m, np.nan)
+    if ring.any():
+        linear = 10 ** (y[ring] / 10)
+        half = (10 ** (envelope[ring, deepest[ring]] / 10) + linear[np.arange(ring.sum()), deepest[ring]]) / 2
+        left, right = edges(linear < half[:, None], deepest[ring])
+        result['q'][ring] = wavelengths[deepest[ring]] / ((right - left + 1) * step)
+
+    # Bragg bandwidth: width of the main peak, bandwidth_level below its maximum
+    bragg = types == 'bragg'
+    result['bragg_wavelength'] = np.full(m, np.nan)
+    result['bragg_bandwidth'] = np.full(m, np.nan)
+    if bragg.any():
+        left, right = edges(y[bragg] > (y[bragg, peak[bragg]] - bandwidth_level)[:, None], peak[bragg])
+        result['bragg_wavelength'][bragg] = (wavelengths[left] + wavelengths[right]) / 2
+        result['bragg_bandwidth'][bragg] = (right - left + 1) * step
+    return result
+
+
+def measurement_catalog(mat_files_dir=mat_files_folder):
+    '''
+    The measurement catalog (see catalog.py), from the file saved by the viewer,
+    or built with the label index of the layout (see ../merge/label_index.py)
+    '''
+    catalog_path = os.path.join(script_dir, catalog_file)
+    layout_path = os.path.abspath(os.path.join(script_dir, '..', 'merge', 'EBeam.oas'))
+    catalog = load_catalog(catalog_path, mat_files_dir, layout_path if os.path.exists(layout_path) else None)
+    if catalog is None:
+        sys.path.append(os.path.join(script_dir, '..', 'merge'))
+        from label_index import load_label_index
+        labels = load_label_index(layout_path).measurement_labels()
+        catalog = build_catalog(mat_files_dir, labels, layout_path)
+        save_catalog(catalog, catalog_path)
+    return catalog
+
+
+def analyze(catalog=None, store=None):
+    '''
+    Analysis of all the measurements in the catalog.
+    Returns {opt_in: [row, ...]}, with a row (dict of columns) per channel above the noise floor
+    '''
+    if catalog is None:
+        catalog = measurement_catalog()
+    if store is None:
+        convert()  # adds the new .mat files
+        store = SpectrumStore()
+
+    # files in the store, for each wavelength grid
+    grids = {}
+    for key, entries in catalog['files'].items():
+        for path, condition, repeat, timestamp in entries:
+            if path in store.index['files']:
+                grid, row = store.index['files'][path][0:2]
+                grids.setdefault(grid, []).append((row, path, catalog['labels'][key]['opt_in']))
+
+    results = {}
+    for grid, files in grids.items():
+        wavelengths, spectra = store.grid(grid)
+        files.sort()
+        for b in range(0, len(files), batch_files):
+            batch = files[b:b + batch_files]
+            x = np.asarray(spectra[[row for row, path, opt_in in batch]], dtype=np.float64)
+            channels = x.shape[1]
+            x = x.reshape(len(batch) * channels, -1)
+            types = np.repeat([device_type(opt_in) for row, path, opt_in in batch], channels)
+            result = analyze_spectra(wavelengths, x, types)
+            for i in np.nonzero(np.nanmax(np.where(np.isnan(x), -np.inf, x), axis=1) > noise_floor)[0]:
+                row, path, opt_in = batch[i // channels]
+                values = {c: result[c][i].item() for c in result}
+                values.update({'opt_in': opt_in, 'file': path, 'channel': int(i % channels) + 1, 'type': types[i]})
+                results.setdefault(opt_in, []).append(values)
+    return results
+
+
+def save_analysis(results, filename):
+    with open(filename, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=columns)
+        writer.writeheader()
+        for opt_in in sorted(results):
+            for row in results[opt_in]:
+                writer.writerow({c: ('' if isinstance(v, float) and np.isnan(v) else round(v, 6) if isinstance(v, float) else v)
+                                 for c, v in row.items()})
+
+
+if __name__ == "__main__":
+    start_time = time.time()
+    results = analyze()
+    filename = os.path.join(script_dir, analysis_file)
+    save_analysis(results, filename)
+    print(f"Analysed {sum(len(r) for r in results.values())} channels of {len(results)} devices in {time.time() - start_time:.1f} seconds: {filename}")
@@ -0,0 +1,152 @@
+'''
+Catalog of the measurements: which .mat files belong to which opt_in label
+
+The measurement folders are named after the device, e.g.,
+  mat_files/TE_1550_25C_edX/LukasChrostowski_MZI1/09-Nov-2024 06.05.22.mat
+with the deviceID and params of the opt_in label,
+  opt_in_TE_1550_device_LukasChrostowski_MZI1
+and a "_N" suffix for repeated measurements (LukasChrostowski_MZI1_2).
+
+Each folder name is parsed once, and joined to the labels with a dict, so
+MZI1 does not match MZI10. The catalog is saved to a small JSON file, and
+loading it only needs the layout to be re-scanned if EBeam.oas changed.
+
+catalog = {
+  'layout': [size, mtime] of the layout the labels came from,
+  'labels': {key: label},  label without the pya.Text
+  'files': {key: [[path relative to mat_files, condition folder, repeat, timestamp], ...]}, newest first
+  'unmatched': [folders without a label],
+}
+'''
+
+import os
+import re
+import json
+from datetime import datetime
+
+catalog_file = 'measurement_catalog.json'
+
+# folder for a repeated measurement, e.g., LukasChrostowski_MZI1_2
+repeat_re = re.compile(r'^(.*)_(\d+)$')
+
+
+def label_key(label):
+    '''
+    Measurement folder name for an opt_in label: deviceID_params
+    '''
+    device_id = label.get('deviceID', '')
+    params = "_".join(label.get('params', []))
+    return f"{device_id}_{params}".strip('_')
+
+
+def file_timestamp(filename):
+    '''
+    Timestamp of a measurement, from the .mat file name, e.g., "09-Nov-2024 06.05.22.mat"
+    '''
+    try:
+        return datetime.strptime(os.path.splitext(filename)[0], '%d-%b-%Y %H.%M.%S').isoformat()
+    except ValueError:
+        return ''
+
+
+def folder_key(folder, labels):
+    '''
+    (key, repeat) for a measurement folder, or (None, None) if no label matches.
+    An exact match wins, e.g., Mehdi_WG2_1 is a device, not the 1st repeat of Mehdi_WG2.
+    '''
+    if folder in labels:
+        return folder, 0
+    m = repeat_re.match(folder)
+    if m and m.group(1) in labels:
+        return m.group(1), int(m.group(2))
+    return None, None
+
+
+def mat_file_list(mat_files_dir):
+    '''
+    All .mat files, relative to mat_files_dir, with / separators
+    '''
+    files = []
+    for root, _, filenames in os.walk(mat_files_dir):
+        for file in filenames:
+            if file.endswith(".mat"):
+                files.append(os.path.relpath(os.path.join(root, file), mat_files_dir).replace(os.sep, '/'))
+    return sorted(files)
+
+
+def layout_signature(layout_path):
+    if not layout_path or not os.path.exists(layout_path):
+        return None
+    s = os.stat(layout_path)
+    return [s.st_size, s.st_mtime]
+
+
+def join_files(catalog, files):
+    '''
+    Add the .mat files to the catalog, using its labels
+    '''
+    catalog['files'] = {}
+    unmatched = set()
+    for path in files:
+        parts = path.split('/')
+        folder = parts[-2] if len(parts) > 1 else ''
+        condition = parts[-3] if len(parts) > 2 else ''
+        key, repeat = folder_key(folder, catalog['labels'])
+        if key is None:
+            unmatched.add(folder)
+            continue
+        catalog['files'].setdefault(key, []).append([path, condition, repeat, file_timestamp(parts[-1])])
+    for entries in catalog['files'].values():
+        entries.sort(key=lambda e: e[3], reverse=True)
+    catalog['unmatched'] = sorted(unmatched)
+    catalog['mat_files'] = files
+    return catalog
+
+
+def build_catalog(mat_files_dir, labels, layout_path=None):
+    '''
+    Catalog of the .mat files, for the opt_in labels: from find_automated_measurement_labels,
+    (text_out, labels), or the list from LabelIndex.measurement_labels (../merge/label_index.py)
+    '''
+    if isinstance(labels, tuple):
+        labels = labels[1]
+    catalog = {'layout': layout_signature(layout_path), 'labels': {}}
+    for label in labels:
+        # first label wins, for duplicated keys
+        catalog['labels'].setdefault(label_key(label), {k: v for k, v in label.items() if k != 'Text'})
+    return join_files(catalog, mat_file_list(mat_files_dir))
+
+
+def save_catalog(catalog, filename):
+    with open(filename, 'w') as file:
+        json.dump(catalog, file, separators=(',', ':'))
+
+
+def load_catalog(filename, mat_files_dir, layout_path=None):
+    '''
+    Load a saved catalog. Returns None if the layout changed (the labels need
+    to be extracted again); new or removed .mat files are joined again here.
+    '''
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as file:
+        catalog = json.load(file)
+    if layout_path and catalog.get('layout') != layout_signature(layout_path):
+        return None
+    files = mat_file_list(mat_files_dir)
+    if files != catalog.get('mat_files'):
+        join_files(catalog, files)
+        save_catalog(catalog, filename)
+    return catalog
+
+
+def catalog_matches(catalog, mat_files_dir):
+    '''
+    The catalog as used by the viewer: {key: [file, label, file, label, ...]}
+    '''
+    matches = {}
+    for key, entries in catalog['files'].items():
+        for path, condition, repeat, timestamp in entries:
+            matches.setdefault(key, []).append(os.path.join(mat_files_dir, path))
+            matches[key].append(catalog['labels'][key])
+    return matches
@@ -6,15 +6,27 @@ written with the help of ChatGPT 4.o
 
 import os
 import re
+import sys
+import json
+import time
+import zlib
+import struct
+import base64
+import hashlib
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 import zipfile
 import shutil
 import pathlib
-import klayout.db as pya
-import siepic_ebeam_pdk
-from SiEPIC.utils import find_automated_measurement_labels
-import matplotlib.pyplot as plt
-import scipy.io
+
+download_workers = 8  # parallel range requests
+download_chunk_size = 8 * 2**20  # bytes per range request
+download_attempts = 3  # per chunk, before giving up (the download can then be resumed)
+extract_workers = 4  # zip members decompressed in parallel
+manifest_file = 'mat_files_manifest.json'  # in the measurements folder, for sync_mat_files
 
 def extract_measurement_url():
     """
@@ -57,13 +69,136 @@ def extract_measurement_url():
         raise RuntimeError(f"Error reading the README.md file: {e}")
 
 
-def download_file(url, output_dir="downloaded_files"):
+def http_session(workers=download_workers):
+    """
+    requests session, with a connection pool shared by the download workers,
+    and retries for failed connections and server errors.
+    """
+    session = requests.Session()
+    retry = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['HEAD', 'GET'])
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def remote_checksum(headers):
+    """
+    Checksum of the file provided by the server, as (algorithm, hex digest), or None.
+    Nextcloud sends "OC-Checksum: SHA1:<hex>"; others "Digest: SHA-256=<base64>" (RFC 3230).
+    """
+    # OC-Checksum may list several, e.g., "SHA1:<hex> MD5:<hex> ADLER32:<hex>"; only those hashlib has are used
+    for part in headers.get('OC-Checksum', '').split():
+        algorithm, _, value = part.partition(':')
+        algorithm = algorithm.lower().replace('-', '')
+        if value and algorithm in hashlib.algorithms_available:
+            return algorithm, value.strip().lower()
+    for part in headers.get('Digest', '').split(','):
+        algorithm, _, value = part.strip().partition('=')
+        algorithm = algorithm.lower().replace('-', '')
+        if value and algorithm in hashlib.algorithms_available:
+            try:
+                return algorithm, base64.b64decode(value, validate=True).hex()
+            except ValueError:
+                pass  # not base64
+    return None
+
+
+def remote_info(session, url):
+    """
+    Size of the remote file, and whether it can be downloaded in ranges.
+    
+    Returns:
+        dict: 'url' (after redirects), 'size' (None if unknown), 'ranges', 'etag', 'last_modified', 'checksum'
+    """
+    response = session.head(url, allow_redirects=True, timeout=30)
+    headers = response.headers
+    size = int(headers['Content-Length']) if response.ok and 'Content-Length' in headers else None
+    ranges = response.ok and headers.get('Accept-Ranges', '').lower() == 'bytes'
+    if not ranges:
+        # some servers only tell when asked for a range
+        response = session.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=30)
+        response.close()
+        if response.status_code == 206 and '/' in response.headers.get('Content-Range', ''):
+            size = int(response.headers['Content-Range'].split('/')[1])
+            ranges = True
+            headers = response.headers
+    return {'url': response.url, 'size': size, 'ranges': bool(ranges and size),
+            'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified'),
+            'checksum': remote_checksum(headers)}
+
+
+def file_checksum(filename, algorithm='sha256'):
+    h = hashlib.new(algorithm)
+    with open(filename, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def download_ranges(session, info, part_file, state, save_state, workers=download_workers):
+    """
+    Download the chunks that are not done yet, in parallel range requests.
+    Each chunk is written at its offset in the partial file, and recorded as done in the state.
+    """
+    chunk_size = state['chunk_size']
+    chunks = [i for i in range((info['size'] + chunk_size - 1) // chunk_size) if i not in state['done']]
+    lock = threading.Lock()
+    if not os.path.exists(part_file):
+        with open(part_file, 'wb') as file:
+            file.truncate(info['size'])
+
+    def fetch(i):
+        start = i * chunk_size
+        end = min(info['size'], start + chunk_size) - 1
+        for attempt in range(download_attempts):
+            try:
+                headers = {'Range': f'bytes={start}-{end}'}
+                if info['etag']:
+                    headers['If-Range'] = info['etag']
+                response = session.get(info['url'], headers=headers, stream=True, timeout=60)
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise RuntimeError('the file changed on the server, or the range request was ignored')
+                written = 0
+                with open(part_file, 'r+b') as file:
+                    file.seek(start)
+                    for data in response.iter_content(chunk_size=1 << 16):
+                        file.write(data)
+                        written += len(data)
+                if written != end - start + 1:
+                    raise RuntimeError(f'received {written} of {end - start + 1} bytes')
+                with lock:
+                    state['done'].append(i)
+                    save_state()
+                return
+            except (requests.RequestException, RuntimeError) as e:
+                error = e
+        raise RuntimeError(f'chunk at {start} failed after {download_attempts} attempts: {error}')
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        errors = [f.exception() for f in [executor.submit(fetch, i) for i in chunks]]
+    errors = [e for e in errors if e]
+    if errors:
+        raise errors[0]
+
+
+def download_file(url, output_dir="downloaded_files", workers=download_workers, chunk_size=download_chunk_size, checksum=None):
     """
     Downloads a file from the given URL and saves it to the specified output directory.
     
+    If the server supports range requests, the file is downloaded in chunks, in parallel,
+    and an interrupted download is resumed: the partial file (.part) and the chunks done
+    (.json) are kept. Otherwise, the file is streamed in one request.
+    The download is verified against the checksum, if given or sent by the server, and
+    skipped if the file was already downloaded and has not changed on the server.
+    
     Args:
         url (str): The URL to download from.
         output_dir (str): The directory where the file will be saved.
+        workers (int): Number of parallel range requests.
+        chunk_size (int): Bytes per range request.
+        checksum (str): Expected checksum, e.g., "sha256:<hex digest>".
     
     Returns:
         str: The path to the downloaded file, or None if an error occurs.
@@ -71,21 +206,150 @@ def download_file(url, output_dir="downloaded_files"):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     
+    filename = os.path.join(output_dir, "downloaded_data.zip")
+    part_file = filename + '.part'
+    state_file = filename + '.json'
+    
     try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
+        session = http_session(workers)
+        info = remote_info(session, url)
+        expected = tuple(checksum.lower().split(':', 1)) if checksum else info['checksum']
+        
+        # state of a previous download: {'url', 'size', 'etag', 'last_modified', 'chunk_size', 'done', 'sha256'}
+        state = {}
+        if os.path.exists(state_file):
+            with open(state_file, 'r') as file:
+                state = json.load(file)
+        unchanged = (info['etag'] or info['last_modified']) and state.get('chunk_size') == chunk_size and \
+            [state.get(k) for k in ('url', 'size', 'etag', 'last_modified')] == [url, info['size'], info['etag'], info['last_modified']]
+        if unchanged and state.get('sha256') and os.path.exists(filename) and os.path.getsize(filename) == info['size']:
+            print(f"Downloaded file is up to date: {filename}")
+            return filename
+        if not unchanged or not os.path.exists(part_file):
+            state = {'url': url, 'size': info['size'], 'etag': info['etag'], 'last_modified': info['last_modified'],
+                     'chunk_size': chunk_size, 'done': []}
+            if os.path.exists(part_file):
+                os.remove(part_file)
+
+        def save_state():
+            with open(state_file + '.tmp', 'w') as file:
+                json.dump(state, file)
+            os.replace(state_file + '.tmp', state_file)
+
+        if info['ranges']:
+            if state['done']:
+                print(f"Resuming download: {len(state['done'])} chunks of {chunk_size} bytes done")
+            download_ranges(session, info, part_file, state, save_state, workers)
+        else:
+            response = session.get(url, stream=True, timeout=60)
+            response.raise_for_status()
+            with open(part_file, "wb") as file:
+                for chunk in response.iter_content(chunk_size=1 << 16):
+                    file.write(chunk)
         
-        filename = os.path.join(output_dir, "downloaded_data.zip")
-        with open(filename, "wb") as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                file.write(chunk)
-        print(f"Downloaded file saved to {filename}")
+        if info['size'] is not None and os.path.getsize(part_file) != info['size']:
+            raise RuntimeError(f"downloaded {os.path.getsize(part_file)} bytes, expected {info['size']}")
+        if expected and file_checksum(part_file, expected[0]) != expected[1]:
+            os.remove(part_file)
+            if os.path.exists(state_file):
+                os.remove(state_file)
+            raise RuntimeError(f"{expected[0]} checksum does not match")
+        state['sha256'] = file_checksum(part_file) if expected is None or expected[0] != 'sha256' else expected[1]
+        os.replace(part_file, filename)
+        save_state()
+        print(f"Downloaded file saved to {filename}, sha256: {state['sha256']}")
         return filename
     
-    except requests.RequestException as e:
+    except (requests.RequestException, RuntimeError, OSError) as e:
         print(f"Error downloading file: {e}")
         return None
 
+def file_crc32(path):
+    crc = 0
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def member_path(info, mat_files_dir):
+    """
+    Destination of a zip member, in mat_files_dir; None if the name points outside of it
+    """
+    root = os.path.abspath(mat_files_dir)
+    path = os.path.abspath(os.path.join(root, info.filename))
+    return path if path.startswith(root + os.sep) else None
+
+
+def member_up_to_date(info, path):
+    """
+    True if the file on disk has the size and CRC of the zip member
+    """
+    return os.path.exists(path) and os.path.getsize(path) == info.file_size and file_crc32(path) == info.CRC
+
+
+def extract_member(zip_ref, info, path):
+    """
+    Decompress a zip member straight to its final path (through a temporary file, so
+    an interrupted extraction does not leave a partial .mat), with the member's date.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with zip_ref.open(info) as source, open(path + '.tmp', 'wb') as destination:
+        shutil.copyfileobj(source, destination, 1 << 20)
+    os.replace(path + '.tmp', path)
+    mtime = time.mktime(info.date_time + (0, 0, -1))
+    os.utime(path, (mtime, mtime))
+
+
+def extract_mat_files(filename, mat_files_dir="mat_files", workers=extract_workers):
+    """
+    Extracts the .mat files from a ZIP file into mat_files_dir, keeping the folder structure.
+    Only the .mat members are read; files already on disk with the same size and CRC are skipped.
+    
+    Args:
+        filename (str): The path to the ZIP file.
+        mat_files_dir (str): The directory where .mat files will be written.
+        workers (int): Number of members extracted in parallel.
+    
+    Returns:
+        dict: 'extracted', 'skipped' (lists of paths), 'bytes' written
+    """
+    with zipfile.ZipFile(filename, 'r') as zip_ref:
+        infos = [info for info in zip_ref.infolist()
+                 if not info.is_dir() and info.filename.lower().endswith(".mat")]
+    result = {'extracted': [], 'skipped': [], 'bytes': 0}
+    lock = threading.Lock()
+    local = threading.local()
+    zip_refs = []
+
+    def extract(info):
+        path = member_path(info, mat_files_dir)
+        if path is None:
+            print(f"Skipping \"{info.filename}\": outside of {mat_files_dir}")
+            return
+        if member_up_to_date(info, path):
+            with lock:
+                result['skipped'].append(path)
+            return
+        # one ZipFile per thread, each with its own file position
+        if not hasattr(local, 'zip_ref'):
+            local.zip_ref = zipfile.ZipFile(filename, 'r')
+            with lock:
+                zip_refs.append(local.zip_ref)
+        extract_member(local.zip_ref, info, path)
+        with lock:
+            result['extracted'].append(path)
+            result['bytes'] += info.file_size
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(extract, info) for info in infos]
+    for zip_ref in zip_refs:
+        zip_ref.close()
+    for f in futures:
+        f.result()
+    return result
+
+
 def unzip_and_clean(filename, output_dir):
     """
     Unzips a given ZIP file and copies all .mat files to a separate directory while maintaining folder structure.
@@ -116,13 +380,18 @@ def delete_unwanted_files(directory):
                     print(f"Error deleting {file_path}: {e}")
 
 
-def unzip_and_copy_mat_files(filename, output_dir, mat_files_dir="mat_files"):
+def unzip_and_copy_mat_files(filename, output_dir=None, mat_files_dir="mat_files"):
+    """
+    Extracts the .mat files from the ZIP file directly into mat_files_dir (see extract_mat_files);
+    the other files (CSV, PDF) are not extracted.
+    output_dir is deprecated and ignored: nothing is extracted there anymore. It is kept so that
+    the calls with (filename, output_dir, mat_files_dir) still work.
+    """
     if filename and filename.endswith(".zip"):
         try:
-            with zipfile.ZipFile(filename, 'r') as zip_ref:
-                zip_ref.extractall(output_dir)
-            print(f"Extracted contents of {filename} into {output_dir}")
-            copy_mat_files(output_dir, mat_files_dir)
+            result = extract_mat_files(filename, mat_files_dir)
+            print(f"Extracted {len(result['extracted'])} .mat files ({result['bytes'] / 2**20:.1f} MB) from {filename} into {mat_files_dir}; "
+                  f"{len(result['skipped'])} files were up to date")
         except zipfile.BadZipFile:
             print("Downloaded file is not a valid ZIP archive.")
 
@@ -145,39 +414,184 @@ def copy_mat_files(source_dir, destination_dir):
                 except Exception as e:
                     print(f"Error copying \"{source_path}\": {e}")
 
+class RemoteFile:
+    """
+    Read-only file object for a file on an HTTP server, using range requests,
+    so that zipfile can read the central directory of a remote zip without downloading it.
+    """
+
+    def __init__(self, session, url, size):
+        self.session = session
+        self.url = url
+        self.size = size
+        self.position = 0
+        self.requests = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def seek(self, offset, whence=0):
+        self.position = [offset, self.position + offset, self.size + offset][whence]
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, n=-1):
+        end = self.size if n < 0 else min(self.size, self.position + n)
+        if end <= self.position:
+            return b''
+        data = self.read_range(self.position, end)
+        self.position = end
+        return data
+
+    def read_range(self, start, end):
+        response = self.session.get(self.url, headers={'Range': f'bytes={start}-{end - 1}'}, timeout=60)
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise RuntimeError('the server ignored the range request')
+        with self.lock:
+            self.requests += 1
+            self.bytes += len(response.content)
+        return response.content
+
+
+def fetch_member(remote, info, path):
+    """
+    Download one zip member with a range request (local header and compressed data), and write it to path
+    """
+    header_size = struct.calcsize(zipfile.structFileHeader)
+    # the local extra field is usually the same as in the central directory; if longer, it is read again
+    start = info.header_offset
+    data = remote.read_range(start, min(remote.size, start + header_size + len(info.filename.encode()) + len(info.extra) + info.compress_size + 1024))
+    header = struct.unpack(zipfile.structFileHeader, data[:header_size])
+    offset = header_size + header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH]
+    if len(data) < offset + info.compress_size:
+        data = remote.read_range(start, start + offset + info.compress_size)
+    data = data[offset:offset + info.compress_size]
+    if info.compress_type == zipfile.ZIP_DEFLATED:
+        data = zlib.decompressobj(-15).decompress(data)
+    elif info.compress_type != zipfile.ZIP_STORED:
+        raise RuntimeError(f"{info.filename}: compression method {info.compress_type} is not supported")
+    if len(data) != info.file_size or zlib.crc32(data) != info.CRC:
+        raise RuntimeError(f"{info.filename}: CRC or size does not match")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as file:
+        file.write(data)
+    os.replace(path + '.tmp', path)
+    mtime = time.mktime(info.date_time + (0, 0, -1))
+    os.utime(path, (mtime, mtime))
+
+
+def load_manifest(filename, mat_files_dir):
+    """
+    Manifest of the .mat files on disk: {path relative to mat_files_dir: [size, CRC, mtime]}.
+    The saved manifest is used for the files whose size and mtime did not change; the CRC of the others is computed.
+    """
+    saved = {}
+    if os.path.exists(filename):
+        with open(filename, 'r') as file:
+            saved = json.load(file)
+    manifest = {}
+    for root, _, files in os.walk(mat_files_dir):
+        for file in files:
+            if not file.lower().endswith(".mat"):
+                continue
+            path = os.path.join(root, file)
+            name = os.path.relpath(path, mat_files_dir).replace(os.sep, '/')
+            s = os.stat(path)
+            if name in saved and [saved[name][0], saved[name][2]] == [s.st_size, s.st_mtime]:
+                manifest[name] = saved[name]
+            else:
+                manifest[name] = [s.st_size, file_crc32(path), s.st_mtime]
+    return manifest
+
+
+def save_manifest(manifest, filename):
+    with open(filename + '.tmp', 'w') as file:
+        json.dump(manifest, file, separators=(',', ':'))
+    os.replace(filename + '.tmp', filename)
+
+
+def sync_mat_files(url, mat_files_dir="mat_files", manifest_path=None, workers=download_workers, download_dir="downloaded"):
+    """
+    Updates mat_files_dir from the measurement zip on the server, downloading only the new or changed .mat files.
+    
+    The central directory of the remote zip (names, sizes, CRCs) is read with range requests, and compared
+    with the manifest of the local files; the missing members are then downloaded, each with a range request.
+    If the server does not support range requests, the zip is downloaded and extracted (extract_mat_files).
+    
+    Args:
+        url (str): The URL of the zip file.
+        mat_files_dir (str): The directory where .mat files are kept.
+        manifest_path (str): The manifest file; default: manifest_file, next to mat_files_dir.
+        workers (int): Number of parallel downloads.
+        download_dir (str): Where the zip is downloaded, if range requests are not supported.
+    
+    Returns:
+        dict: 'fetched' (list of paths), 'up_to_date' (number of files), 'bytes' downloaded
+    """
+    if manifest_path is None:
+        manifest_path = os.path.join(os.path.dirname(os.path.abspath(mat_files_dir)), manifest_file)
+    session = http_session(workers)
+    info = remote_info(session, url)
+    if not info['ranges']:
+        print("The server does not support range requests; downloading the zip file")
+        filename = download_file(url, output_dir=download_dir, workers=workers)
+        if filename is None:
+            return None
+        result = extract_mat_files(filename, mat_files_dir, workers=workers)
+        save_manifest(load_manifest(manifest_path, mat_files_dir), manifest_path)
+        return {'fetched': result['extracted'], 'up_to_date': len(result['skipped']), 'bytes': os.path.getsize(filename)}
+
+    manifest = load_manifest(manifest_path, mat_files_dir)
+    remote = RemoteFile(session, info['url'], info['size'])
+    with zipfile.ZipFile(remote, 'r') as zip_ref:
+        infos = [i for i in zip_ref.infolist() if not i.is_dir() and i.filename.lower().endswith(".mat")]
+    missing = []
+    for i in list(infos):
+        path = member_path(i, mat_files_dir)
+        if path is None:
+            print(f"Skipping \"{i.filename}\": outside of {mat_files_dir}")
+            infos.remove(i)
+        elif manifest.get(i.filename, [None, None])[0:2] != [i.file_size, i.CRC]:
+            missing.append((i, path))
+    print(f"Remote zip: {len(infos)} .mat files, {len(missing)} new or changed "
+          f"(central directory: {remote.bytes / 2**10:.0f} kB in {remote.requests} requests)")
+
+    lock = threading.Lock()
+
+    def fetch(item):
+        i, path = item
+        fetch_member(remote, i, path)
+        with lock:
+            print(f"Fetched: \"{i.filename}\"")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch, item) for item in missing]
+    errors = [f.exception() for f in futures if f.exception()]
+    for e in errors:
+        print(f"Error: {e}")
+    save_manifest(load_manifest(manifest_path, mat_files_dir), manifest_path)
+    return {'fetched': [path for (i, path), f in zip(missing, futures) if not f.exception()],
+            'up_to_date': len(infos) - len(missing), 'bytes': remote.bytes}
 
 
 if __name__ == "__main__":
     script_dir = os.path.dirname(os.path.abspath(__file__))
-    if 1:
-        # Download, extract, copy .mat files
-        try:
-            url = extract_measurement_url()
-            print(f"Extracted URL: {url}")
-            download_path = os.path.join(script_dir,'downloaded')
-            filename = download_file(url, output_dir=download_path)
-            mat_path = os.path.join(script_dir,'mat_files')
-            unzip_and_copy_mat_files(filename, download_path, mat_path)
-        except Exception as e:
-            print(f"Error: {e}")
-
-    if 0:        
-        # Download, extract, copy .mat files
-        try:
-            url = "https://stratus.ece.ubc.ca/s/kfHwqfkcxNEMgXs/download"  # Test URL
-            print(f"Using test URL: {url}")
-            download_path = os.path.join(script_dir,'downloaded')
-            filename = download_file(url, output_dir=download_path)
-            mat_path = os.path.join(script_dir,'mat_files')
-            unzip_and_copy_mat_files(filename, download_path, mat_path)
-            # unzip_and_clean(filename, "downloaded_files")
-        except Exception as e:
-            print(f"Error: {e}")
-
-    if 0:
-        # copy from local folder
-        source_dir = '/Users/lukasc/Downloads/die_1'
-        mat_path = os.path.join(script_dir,'mat_files')
+    mat_path = os.path.join(script_dir,'mat_files')
+    if len(sys.argv) > 1:
+        # copy from local folder, e.g., python fetch_measurement_data.py ~/Downloads/die_1
+        source_dir = sys.argv[1]
         print(source_dir, mat_path)
         copy_mat_files(source_dir, mat_path)
-        
+        sys.exit()
+
+    # Sync the .mat files: only the new or changed files are downloaded
+    try:
+        url = extract_measurement_url()
+        print(f"Extracted URL: {url}")
+        result = sync_mat_files(url, mat_path, download_dir=os.path.join(script_dir,'downloaded'))
+        if result:
+            print(f"Synced: {len(result['fetched'])} files fetched, {result['up_to_date']} up to date, {result['bytes'] / 2**20:.1f} MB downloaded")
+    except Exception as e:
+        print(f"Error: {e}")
@@ -0,0 +1,320 @@
+'''
+Spectrum store: the .mat measurements converted to memory-mapped arrays
+
+scipy.io.loadmat has to decompress and parse the whole file each time a
+spectrum is needed. The store is converted once, and then opened with
+memory-mapping, so a spectrum is a view into the file (no copy, no parsing).
+
+Spectra with the same wavelength sweep are stored together, as one array
+of shape (files, 4 channels, points) in float32, so a scan over all the
+devices (e.g., which channels are above the noise floor) is one numpy
+operation rather than a loop over files.
+
+spectra/
+  index.json: {'grids': [{'file', 'wavelengths' (file), 'shape'}],
+               'files': {path relative to mat_files: [grid, row, size, mtime]}}
+  grid_N.wl.npy: wavelengths [nm], float64
+  grid_N.f32: spectra [dB], float32, raw
+
+Spectra that were loaded are kept in an LRU cache (spectrum_cache), which
+is shared by the viewer's plots and
+analyze_mat_file; the viewer prefetches spectra in a thread pool. The
+spectra from the store are kept as views into the memory-mapped files, and
+only the ones read from .mat files (not converted yet) count against
+cache_bytes.
+
+Usage:
+  python measurements/spectra.py          (convert, or add the new .mat files)
+  python measurements/spectra.py --rebuild
+'''
+
+import os
+import json
+import hashlib
+import argparse
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from catalog import mat_file_list
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+mat_files_folder = os.path.join(script_dir, 'mat_files')
+store_folder = os.path.join(script_dir, 'spectra')
+channels = 4
+cache_bytes = 256 * 2**20  # memory for the spectrum cache
+prefetch_workers = 4
+
+
+def read_mat(mat_file_path):
+    '''
+    Wavelengths [nm] and the spectra of the 4 channels [dB], from a .mat file
+    Returns (wavelengths, array of shape (4, points)); missing channels are NaN
+    '''
+    import scipy.io  # only needed to convert the .mat files
+    mat_data = scipy.io.loadmat(mat_file_path)
+    test_result = mat_data.get("testResult")
+    rows_inner = test_result[0, 0]["rows"][0, 0]
+    wavelengths = test_result[0][0][0]['wavelength'].flatten()[0].flatten()
+    spectra = np.full((channels, len(wavelengths)), np.nan)
+    for i in range(1, channels + 1):
+        channel_key = f"channel_{i}"
+        if channel_key in rows_inner.dtype.names:
+            spectra[i - 1] = rows_inner[channel_key].flatten()
+    return wavelengths, spectra
+
+
+def convert(mat_files_dir=mat_files_folder, store_dir=store_folder, rebuild=False):
+    '''
+    Convert the .mat files to the store. Files already in the store are kept,
+    and new files are appended; if a file was changed or removed, the store is rebuilt.
+    Returns the number of files converted.
+    '''
+    index_file = os.path.join(store_dir, 'index.json')
+    index = {'grids': [], 'files': {}}
+    if not rebuild and os.path.exists(index_file):
+        with open(index_file, 'r') as file:
+            index = json.load(file)
+    files = mat_file_list(mat_files_dir)
+    for path, (grid, row, size, mtime) in index['files'].items():
+        s = os.stat(os.path.join(mat_files_dir, path)) if path in files else None
+        if s is None or [s.st_size, s.st_mtime] != [size, mtime]:
+            return convert(mat_files_dir, store_dir, rebuild=True)
+    if rebuild:
+        for f in os.listdir(store_dir) if os.path.exists(store_dir) else []:
+            if f.startswith('grid_'):
+                os.remove(os.path.join(store_dir, f))
+    os.makedirs(store_dir, exist_ok=True)
+
+    # the rows are appended, and numbered from the index: the rows left by an interrupted
+    # conversion, after those in the index, are removed first; if rows are missing, the store is rebuilt
+    for grid in index['grids']:
+        grid_file = os.path.join(store_dir, grid['file'])
+        grid_bytes = grid['shape'][0] * channels * grid['shape'][2] * np.dtype(np.float32).itemsize
+        if not os.path.exists(grid_file) or os.path.getsize(grid_file) < grid_bytes:
+            return convert(mat_files_dir, store_dir, rebuild=True)
+        os.truncate(grid_file, grid_bytes)
+
+    # grids are identified by a hash of the wavelengths
+    grid_ids = {g['hash']: i for i, g in enumerate(index['grids'])}
+    converted = 0
+    for path in files:
+        if path in index['files']:
+            continue
+        try:
+            wavelengths, spectra = read_mat(os.path.join(mat_files_dir, path))
+        except Exception as e:
+            print(f"Error reading {path}: {e}")
+            continue
+        h = hashlib.sha1(wavelengths.astype(np.float64).tobytes()).hexdigest()
+        if h not in grid_ids:
+            grid_ids[h] = len(index['grids'])
+            name = 'grid_%s' % grid_ids[h]
+            np.save(os.path.join(store_dir, name + '.wl.npy'), wavelengths.astype(np.float64))
+            # a new grid may have been started by an interrupted conversion
+            open(os.path.join(store_dir, name + '.f32'), 'wb').close()
+            index['grids'].append({'hash': h, 'file': name + '.f32', 'wavelengths': name + '.wl.npy',
+                                   'shape': [0, channels, len(wavelengths)]})
+        grid = index['grids'][grid_ids[h]]
+        with open(os.path.join(store_dir, grid['file']), 'ab') as file:
+            file.write(spectra.astype(np.float32).tobytes())
+        s = os.stat(os.path.join(mat_files_dir, path))
+        index['files'][path] = [grid_ids[h], grid['shape'][0], s.st_size, s.st_mtime]
+        grid['shape'][0] += 1
+        converted += 1
+
+    # the index is written last, so the rows of an interrupted conversion are not used, and are removed by the next one
+    with open(index_file + '.tmp', 'w') as file:
+        json.dump(index, file)
+    os.replace(index_file + '.tmp', index_file)
+    return converted
+
+
+class SpectrumStore:
+    '''
+    Read-only access to the store; spectra are views into the memory-mapped files
+    '''
+
+    def __init__(self, store_dir=store_folder, mat_files_dir=mat_files_folder):
+        self.store_dir = store_dir
+        self.mat_files_dir = os.path.abspath(mat_files_dir)
+        with open(os.path.join(store_dir, 'index.json'), 'r') as file:
+            self.index = json.load(file)
+        self.grids = {}
+
+    def key(self, mat_file_path):
+        '''
+        Path relative to mat_files, as used in the index
+        '''
+        if os.path.isabs(mat_file_path):
+            mat_file_path = os.path.relpath(mat_file_path, self.mat_files_dir)
+        return mat_file_path.replace(os.sep, '/')
+
+    def __contains__(self, mat_file_path):
+        return self.key(mat_file_path) in self.index['files']
+
+    def current(self, mat_file_path):
+        '''
+        True if the file is in the store, and was not changed since it was converted
+        '''
+        key = self.key(mat_file_path)
+        if key not in self.index['files']:
+            return False
+        size, mtime = self.index['files'][key][2:4]
+        try:
+            s = os.stat(os.path.join(self.mat_files_dir, key))
+        except OSError:
+            return False
+        return [s.st_size, s.st_mtime] == [size, mtime]
+
+    def grid(self, i):
+        '''
+        (wavelengths, spectra of shape (files, 4, points)) for a wavelength grid
+        '''
+        if i not in self.grids:
+            g = self.index['grids'][i]
+            wavelengths = np.load(os.path.join(self.store_dir, g['wavelengths']))
+            spectra = np.memmap(os.path.join(self.store_dir, g['file']), dtype=np.float32, mode='r',
+                                shape=tuple(g['shape']))
+            self.grids[i] = (wavelengths, spectra)
+        return self.grids[i]
+
+    def get(self, mat_file_path):
+        '''
+        (wavelengths, spectra of shape (4, points)) for a .mat file in the store
+        '''
+        grid, row = self.index['files'][self.key(mat_file_path)][0:2]
+        wavelengths, spectra = self.grid(grid)
+        return wavelengths, spectra[row]
+
+    def files(self, grid):
+        '''
+        The files in a grid, in row order
+        '''
+        files = [(row, path) for path, (g, row, size, mtime) in self.index['files'].items() if g == grid]
+        return [path for row, path in sorted(files)]
+
+    def above_noise_floor(self, noise_floor):
+        '''
+        {path: [channels whose maximum exceeds the noise floor]}, for all the files
+        '''
+        result = {}
+        for grid in range(len(self.index['grids'])):
+            wavelengths, spectra = self.grid(grid)
+            above = np.nanmax(spectra, axis=2) > noise_floor
+            rows = {row: path for path, (g, row, size, mtime) in self.index['files'].items() if g == grid}
+            for row, channel in zip(*np.nonzero(above)):
+                if row in rows:
+                    result.setdefault(rows[row], []).append(int(channel) + 1)
+        return result
+
+
+_store = None
+
+
+def load_spectrum_uncached(mat_file_path):
+    '''
+    (wavelengths, spectra of shape (4, points)) for a .mat file:
+    from the store, if the file was converted and not changed since, otherwise from the .mat file
+    '''
+    global _store
+    if _store is None:
+        _store = False
+        if os.path.exists(os.path.join(store_folder, 'index.json')):
+            _store = SpectrumStore()
+    if _store and _store.current(mat_file_path):
+        return _store.get(mat_file_path)
+    return read_mat(mat_file_path)
+
+
+class SpectrumCache:
+    '''
+    LRU cache of spectra, bounded by the total size of the arrays read from .mat files;
+    the views into the memory-mapped store are not counted, since the OS pages them in and out.
+    Spectra can be loaded in the background with prefetch().
+    '''
+
+    def __init__(self, max_bytes=cache_bytes, workers=prefetch_workers):
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.entries = collections.OrderedDict()  # path: (wavelengths, spectra)
+        self.bytes = 0
+        self.pending = {}  # path: Future, being loaded in the background
+        self.lock = threading.Lock()
+        self.executor = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, mat_file_path):
+        with self.lock:
+            if mat_file_path in self.entries:
+                self.entries.move_to_end(mat_file_path)
+                self.hits += 1
+                return self.entries[mat_file_path]
+            self.misses += 1
+            future = self.pending.get(mat_file_path)
+        if future:
+            return future.result()
+        return self.load(mat_file_path)
+
+    def load(self, mat_file_path):
+        value = load_spectrum_uncached(mat_file_path)
+        with self.lock:
+            if mat_file_path not in self.entries:
+                self.entries[mat_file_path] = value
+                self.bytes += self.entry_bytes(value)
+            # the oldest spectra are removed first; the new one is always kept
+            while self.bytes > self.max_bytes and len(self.entries) > 1:
+                path, entry = self.entries.popitem(last=False)
+                self.bytes -= self.entry_bytes(entry)
+        return value
+
+    @staticmethod
+    def entry_bytes(value):
+        '''
+        Memory used by a cached spectrum: 0 for a view into the store (its wavelengths are shared by the grid)
+        '''
+        wavelengths, spectra = value
+        return 0 if isinstance(spectra, np.memmap) else wavelengths.nbytes + spectra.nbytes
+
+    def prefetch(self, mat_file_paths):
+        '''
+        Load the spectra in the background
+        '''
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='prefetch')
+            for path in mat_file_paths:
+                if path not in self.entries and path not in self.pending:
+                    self.pending[path] = self.executor.submit(self._prefetch, path)
+
+    def _prefetch(self, mat_file_path):
+        try:
+            return self.load(mat_file_path)
+        finally:
+            with self.lock:
+                self.pending.pop(mat_file_path, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+
+spectrum_cache = SpectrumCache()
+
+
+def load_spectrum(mat_file_path):
+    '''
+    (wavelengths, spectra of shape (4, points)) for a .mat file, using the spectrum cache
+    '''
+    return spectrum_cache.get(mat_file_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert the .mat measurements to the spectrum store')
+    parser.add_argument('--rebuild', action='store_true', help='convert all the files again')
+    args = parser.parse_args()
+    converted = convert(rebuild=args.rebuild)
+    store = SpectrumStore()
+    print(f"Converted {converted} files; {len(store.index['files'])} files in {len(store.index['grids'])} wavelength grids")
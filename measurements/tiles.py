@@ -0,0 +1,147 @@
+'''
+Tile pyramid of the merged layout (../merge/EBeam.oas), for the viewer
+
+Rendering a cell with KLayout takes up to a second for the full die, so the
+layout is rendered once, as PNG tiles at several zoom levels: at level z,
+the (square) extent of the top cell is divided into 2^z x 2^z tiles of
+tile_size pixels. The viewer composes an image of any region from the
+tiles of the level that has enough resolution.
+
+The pyramid is stored in tiles/<hash of the layout file>/<z>/<i>_<j>.png,
+with i the column from the left and j the row from the bottom, and
+meta.json, which is written when all the tiles are done. Building is
+resumable, and the pyramids of previous layouts are removed when done.
+
+Usage (the viewer runs this in the background if needed):
+  python measurements/tiles.py [layout file]
+'''
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+tiles_folder = os.path.join(script_dir, 'tiles')
+tile_size = 256  # pixels
+levels = 6  # zoom levels 0 .. 5; at level 5, about 0.9 pixels per micron: a 605 micron wide cell is about 550 pixels
+
+
+def layout_hash(layout_path):
+    h = hashlib.sha256()
+    with open(layout_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()[:16]
+
+
+def pyramid_folder(layout_path):
+    return os.path.join(tiles_folder, layout_hash(layout_path))
+
+
+def load_pyramid(layout_path):
+    '''
+    The pyramid's meta data, with 'folder' added, or None if it is not built (yet)
+    '''
+    folder = pyramid_folder(layout_path)
+    meta_file = os.path.join(folder, 'meta.json')
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file, 'r') as file:
+        meta = json.load(file)
+    meta['folder'] = folder
+    return meta
+
+
+def tile_file(meta, z, i, j):
+    return os.path.join(meta['folder'], str(z), f"{i}_{j}.png")
+
+
+def tile_range(meta, box, width):
+    '''
+    Tiles needed to show a region at a given width in pixels.
+
+    Args:
+        box: [left, bottom, right, top] in microns
+    Returns:
+        level z, columns (i0, i1), rows (j0, j1), and the crop rectangle
+        (x, y, w, h) in pixels, in the image of the tiles with row j1 at the top;
+        None if even the deepest level has fewer pixels than width for the region
+        (most opt_in cells are less than 275 microns wide), which is then rendered with KLayout
+    '''
+    left, bottom, size = meta['extent']
+    box_width = max(box[2] - box[0], 1e-3)
+    z = 0
+    while z < meta['levels'] - 1 and box_width / (size / 2**z) * meta['tile_size'] < width:
+        z += 1
+    if box_width / (size / 2**z) * meta['tile_size'] < width:
+        return None
+    n = 2**z
+    s = size / n
+    clamp = lambda v: min(max(v, 0), n - 1)
+    i0, i1 = clamp(int((box[0] - left) // s)), clamp(int((box[2] - left) // s))
+    j0, j1 = clamp(int((box[1] - bottom) // s)), clamp(int((box[3] - bottom) // s))
+    scale = meta['tile_size'] / s  # pixels per micron
+    x = (box[0] - (left + i0 * s)) * scale
+    y = ((bottom + (j1 + 1) * s) - box[3]) * scale
+    return z, (i0, i1), (j0, j1), (int(x), int(y), max(1, int(box_width * scale)), max(1, int((box[3] - box[1]) * scale)))
+
+
+def build_pyramid(layout_path, verbose=True):
+    '''
+    Render all the tiles of the layout; tiles that exist are kept
+    '''
+    import klayout.db as pya
+    import klayout.lay as lay
+    import siepic_ebeam_pdk  # the EBeam technology, for the layer properties
+
+    folder = pyramid_folder(layout_path)
+    layout = pya.Layout()
+    layout.read(layout_path)
+    layout.technology_name = "EBeam"
+    bbox = layout.top_cell().dbbox()
+    size = max(bbox.width(), bbox.height())
+
+    layout_view = lay.LayoutView()
+    cell_view_index = layout_view.create_layout(True)
+    layout_view.active_cellview_index = cell_view_index
+    cell_view = layout_view.cellview(cell_view_index)
+    cell_view.layout().assign(layout)
+    cell_view.cell = cell_view.layout().top_cell()
+    layout_view.load_layer_props(layout.technology().eff_layer_properties_file())
+    layout_view.set_config("text-font", 3)
+    layout_view.set_config("background-color", "#ffffff")
+    layout_view.set_config("grid-show-ruler", "false")
+    layout_view.max_hier()
+
+    for z in range(levels):
+        n = 2**z
+        s = size / n
+        os.makedirs(os.path.join(folder, str(z)), exist_ok=True)
+        for i in range(n):
+            for j in range(n):
+                file_out = os.path.join(folder, str(z), f"{i}_{j}.png")
+                if os.path.exists(file_out):
+                    continue
+                layout_view.zoom_box(pya.DBox(bbox.left + i * s, bbox.bottom + j * s, bbox.left + (i + 1) * s, bbox.bottom + (j + 1) * s))
+                png_data = layout_view.get_pixels(tile_size, tile_size).to_png_data()
+                with open(file_out + '.tmp', 'wb') as f:
+                    f.write(png_data)
+                os.replace(file_out + '.tmp', file_out)
+        if verbose:
+            print(f"Tiles: level {z} done ({n*n} tiles)")
+
+    # written last: the pyramid is complete
+    with open(os.path.join(folder, 'meta.json'), 'w') as file:
+        json.dump({'extent': [bbox.left, bbox.bottom, size], 'levels': levels, 'tile_size': tile_size}, file)
+
+    # remove the pyramids of previous layouts
+    for f in os.listdir(tiles_folder):
+        if os.path.join(tiles_folder, f) != folder:
+            shutil.rmtree(os.path.join(tiles_folder, f), ignore_errors=True)
+
+
+if __name__ == "__main__":
+    layout_path = sys.argv[1] if len(sys.argv) > 1 else os.path.abspath(os.path.join(script_dir, '..', 'merge', 'EBeam.oas'))
+    build_pyramid(layout_path)
@@ -0,0 +1,327 @@
+'''
+Measurement data viewer: the window (PyQt6 and matplotlib), for viewer.py
+
+The list of the measured devices, the image of the selected cells in the
+layout, and the plot of their spectra. Only the GUI mode of viewer.py
+imports this module, so the other modes do not load Qt and matplotlib.
+'''
+
+import os
+import sys
+import subprocess
+import collections
+import numpy as np
+import matplotlib.pyplot as plt
+from PyQt6.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QListWidget, QLabel, QTabWidget, QScrollArea, QPushButton
+from PyQt6.QtGui import QPixmap, QImage, QPainter
+from PyQt6.QtCore import Qt, QTimer
+from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas, NavigationToolbar2QT as NavigationToolbar
+import SiEPIC
+from spectra import load_spectrum, spectrum_cache
+from tiles import load_pyramid, tile_range, tile_file
+from viewer import CONST_NoiseFloor, CONST_Prefetch, layout_file, find_text_label_box
+
+pixmap_cache_bytes = 64 * 2**20  # memory for the images of the cells
+
+class TabbedGUI(QMainWindow):
+    def __init__(self, layout, matches, layout_path=None):
+        super().__init__()
+        self.setWindowTitle("SiEPIC openEBL data viewer")
+        self.setGeometry(100, 100, 800, 600)
+        self.matches = dict(sorted(matches.items()))
+        self.layout = layout
+        self.legend_enabled = True  # Track legend state
+        self.lines = {}  # plotted lines, for each selected item
+        self.legend = None
+        self.background = None  # plot without the legend, for blitting
+        self.pixmaps = collections.OrderedDict()  # LRU cache of the images of the cells, at the largest width displayed so far
+        self.pixmaps_bytes = 0
+        self.layout_path = layout_path or layout_file()
+        self.pyramid = load_pyramid(self.layout_path)
+        if not self.pyramid:
+            self.start_pyramid_build()
+        
+        self.initUI()
+
+    def initUI(self):
+        main_widget = QWidget()
+        main_layout = QHBoxLayout()
+        
+        # List Widget on the Left
+        self.listWidget = QListWidget()
+        self.listWidget.setSelectionMode(QListWidget.SelectionMode.MultiSelection)
+        for item in sorted(self.matches.keys(), key=str.casefold):
+            self.listWidget.addItem(item)
+        self.listWidget.itemSelectionChanged.connect(self.update_tabs)
+        main_layout.addWidget(self.listWidget, 1)  # Takes 1 part of the space
+        
+        # Tabs on the Right
+        self.tabs = QTabWidget()
+        
+        # Tab 2: Image
+        self.tab2 = QWidget()
+        self.scrollArea = QScrollArea()
+        self.imageLabel = QLabel("Select an item to display an image")
+        self.imageLabel.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.scrollArea.setWidget(self.imageLabel)
+        self.scrollArea.setWidgetResizable(True)
+        layout2 = QVBoxLayout()
+        layout2.addWidget(self.scrollArea)
+        self.tab2.setLayout(layout2)
+        self.display_klayout_cell_image(self.layout.top_cell().name, self.layout.top_cell()) #, width=self.scrollArea.width()*0.99)
+        
+        # Tab 3: Data Plot
+        self.tab3 = QWidget()
+        self.figure, self.ax = plt.subplots()
+        self.ax.set_xlabel("Wavelength [nm]")
+        self.ax.set_ylabel("Transmission [dB]")
+        self.ax.grid(True)
+        self.canvas = FigureCanvas(self.figure)
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        self.toolbar = NavigationToolbar(self.canvas, self)
+        self.legend_button = QPushButton("Toggle Legend")
+        self.legend_button.clicked.connect(self.toggle_legend)
+        layout3 = QVBoxLayout()
+        layout3.addWidget(self.toolbar)
+        layout3.addWidget(self.canvas)
+        layout3.addWidget(self.legend_button)
+        self.tab3.setLayout(layout3)
+        
+        # Add tabs to the main layout
+        self.tabs.addTab(self.tab2, "Image")
+        self.tabs.addTab(self.tab3, "Plot")
+        main_layout.addWidget(self.tabs, 3)  # Takes 3 parts of the space
+        
+        main_widget.setLayout(main_layout)
+        self.setCentralWidget(main_widget)
+
+    def start_pyramid_build(self):
+        """
+        Builds the tile pyramid of the layout (see tiles.py) in a separate process;
+        until it is done, images are rendered with KLayout.
+        """
+        tiles_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tiles.py')
+        self.pyramid_process = subprocess.Popen([sys.executable, tiles_script, self.layout_path])
+        self.pyramid_timer = QTimer(self)
+        self.pyramid_timer.timeout.connect(self.check_pyramid)
+        self.pyramid_timer.start(2000)
+
+    def check_pyramid(self):
+        if self.pyramid_process.poll() is None:
+            return
+        self.pyramid_timer.stop()
+        self.pyramid = load_pyramid(self.layout_path)
+        self.pixmaps.clear()
+        self.pixmaps_bytes = 0
+
+    def resizeEvent(self, event):
+        """
+        Resize event to dynamically adjust image size.
+        """
+        if self.imageLabel.pixmap():
+            self.display_klayout_cell_image(width=self.scrollArea.width()*0.99)
+        super().resizeEvent(event)
+
+    def update_tabs(self):
+        """
+        Updates the plot for the selection: only the lines of the items that were
+        added or removed are plotted or removed. Lines that are added without
+        changing the axes are drawn on top of the previous plot (blitting).
+        """
+        selected_items = [item.text() for item in self.listWidget.selectedItems()]
+        selected_items = [key for key in selected_items if key in self.matches]
+        if not selected_items:
+            self.display_klayout_cell_image(self.layout.top_cell().name, self.layout.top_cell(), width=self.scrollArea.width()*0.99)
+        
+        multi = len(selected_items) > 1
+        redraw = self.background is None
+        for key in [key for key in self.lines if key not in selected_items]:
+            for line in self.lines.pop(key):
+                line.remove()
+            redraw = True
+        
+        # labels change when going from one to several items
+        for key in self.lines:
+            for line in self.lines[key]:
+                label = f"{key}:{line.get_gid()}" if multi else f"channel:{line.get_gid()}"
+                if line.get_label() != label:
+                    line.set_label(label)
+                    redraw = True
+        
+        new_lines = []
+        for selected_key in selected_items:
+            if selected_key not in self.lines:
+                mat_file_path = self.matches[selected_key][0]  # Get the first associated file
+                self.lines[selected_key] = self.plot_mat_data(mat_file_path, selected_key, multi)
+                new_lines += self.lines[selected_key]
+                self.display_klayout_cell_image(selected_key, width=self.scrollArea.width()*0.99)
+        
+        if multi:
+            title = "Spectrum Data for selected files"
+        else:
+            title = f"Spectrum Data for {selected_items[0]}" if selected_items else ""
+        if self.ax.get_title() != title:
+            self.ax.set_title(title)
+            redraw = True
+        
+        limits = (self.ax.get_xlim(), self.ax.get_ylim())
+        self.ax.relim()
+        self.ax.autoscale_view()
+        if limits != (self.ax.get_xlim(), self.ax.get_ylim()):
+            redraw = True
+        
+        self.update_legend()
+        if redraw:
+            self.canvas.draw_idle()
+        else:
+            self.blit(new_lines)
+        self.prefetch_neighbours()
+
+    def update_legend(self):
+        """
+        The legend is an animated artist: it is drawn on top of the plot,
+        so it can be changed or toggled without drawing the plot again.
+        """
+        if self.legend:
+            self.legend.remove()
+            self.legend = None
+        if self.lines and any(self.lines.values()):
+            self.legend = self.ax.legend()
+            self.legend.set_animated(True)
+            self.legend.set_visible(self.legend_enabled)
+
+    def on_draw(self, event):
+        """
+        After the plot is drawn (e.g., zoom, resize), keep it for blitting, and add the legend.
+        """
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        if self.legend and self.legend.get_visible():
+            self.figure.draw_artist(self.legend)
+
+    def blit(self, new_lines=()):
+        """
+        Draws the new lines on the previous plot, and the legend on top.
+        """
+        self.canvas.restore_region(self.background)
+        for line in new_lines:
+            self.ax.draw_artist(line)
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        if self.legend and self.legend.get_visible():
+            self.figure.draw_artist(self.legend)
+        self.canvas.blit(self.figure.bbox)
+
+    def prefetch_neighbours(self, n=CONST_Prefetch):
+        """
+        Loads the spectra of the items next to the selection in the background,
+        so selecting them next does not need to read the files.
+        """
+        paths = []
+        for item in self.listWidget.selectedItems():
+            row = self.listWidget.row(item)
+            for j in range(max(0, row - n), min(self.listWidget.count(), row + n + 1)):
+                key = self.listWidget.item(j).text()
+                if key in self.matches:
+                    paths.append(self.matches[key][0])
+        spectrum_cache.prefetch(paths)
+
+    def toggle_legend(self):
+        """
+        Toggles the visibility of the legend.
+        """
+        self.legend_enabled = not self.legend_enabled
+        if self.legend:
+            self.legend.set_visible(self.legend_enabled)
+            if self.background is None:
+                self.canvas.draw_idle()
+            else:
+                self.blit()
+    
+    def plot_mat_data(self, mat_file_path, title, multi=False):
+        """
+        Reads and plots the spectrum data from a .mat file (or the spectrum store, see spectra.py).
+        Returns the lines; the channel number is the line's gid.
+        """
+        wavelengths, spectra = load_spectrum(mat_file_path)
+        
+        lines = []
+        for i in range(1, 5):
+            spectrum_data = spectra[i-1]
+            if not np.isnan(spectrum_data).all() and np.nanmax(spectrum_data) > CONST_NoiseFloor:
+                if multi:
+                    lines += self.ax.plot(wavelengths, spectrum_data, label=f"{title}:{i}", gid=i)
+                else:
+                    lines += self.ax.plot(wavelengths, spectrum_data, label=f"channel:{i}", gid=i)
+        return lines
+
+    def display_klayout_cell_image(self, cell_name=None, cell=None, width=400):
+        """
+        Displays an image of the KLayout cell in Tab 2.
+        The image is composed from the tile pyramid if it is built and has the resolution,
+        otherwise rendered with KLayout. The images are kept (up to pixmap_cache_bytes), so a
+        resize to a smaller width only rescales them.
+        """
+        layout = self.layout
+        if cell_name:
+            self.cell_name = cell_name
+            self.cell = cell
+        if not cell_name:
+            if 'cell_name' in dir(self):
+                cell_name = self.cell_name
+                cell = self.cell
+        width = int(width)
+        pixmap = self.pixmaps.get(cell_name)
+        if pixmap is not None:
+            self.pixmaps.move_to_end(cell_name)
+        if pixmap is None or pixmap.width() < width:
+            box = None
+            if cell_name in self.matches:
+                cell, box = find_text_label_box(layout, [10,0], self.matches[cell_name][1]['opt_in'])
+            elif cell:
+                box = cell.dbbox()
+            if not cell:
+                self.imageLabel.setText("Cell not found in layout")
+                return
+            pixmap = compose_tiles(self.pyramid, box, width) if self.pyramid else None
+            if pixmap is None:
+                image_path = os.path.join(SiEPIC._globals.TEMP_FOLDER, f"{cell_name}.png")
+                im = cell.image(image_path, width=width, retina=False)
+                pixmap = QPixmap(image_path)
+            self.cache_pixmap(cell_name, pixmap)
+        self.imageLabel.setPixmap(pixmap.scaledToWidth(width, Qt.TransformationMode.SmoothTransformation))
+    
+    def cache_pixmap(self, cell_name, pixmap):
+        """
+        Keeps the image of a cell; the least recently displayed ones are removed first.
+        """
+        if cell_name in self.pixmaps:
+            old = self.pixmaps.pop(cell_name)
+            self.pixmaps_bytes -= old.width() * old.height() * 4
+        self.pixmaps[cell_name] = pixmap
+        self.pixmaps_bytes += pixmap.width() * pixmap.height() * 4
+        while self.pixmaps_bytes > pixmap_cache_bytes and len(self.pixmaps) > 1:
+            name, old = self.pixmaps.popitem(last=False)
+            self.pixmaps_bytes -= old.width() * old.height() * 4
+
+def compose_tiles(pyramid, box, width):
+    """
+    Image of a region of the layout, from the tiles of the pyramid (see tiles.py).
+    
+    Args:
+        pyramid: from load_pyramid
+        box (pya.DBox): the region, in microns
+        width (int): minimum width of the image, in pixels
+    Returns None if the tiles do not have the resolution for width (see tile_range)
+    """
+    tiles = tile_range(pyramid, [box.left, box.bottom, box.right, box.top], width)
+    if tiles is None:
+        return None
+    z, (i0, i1), (j0, j1), (x, y, w, h) = tiles
+    size = pyramid['tile_size']
+    image = QImage((i1 - i0 + 1) * size, (j1 - j0 + 1) * size, QImage.Format.Format_RGB32)
+    image.fill(Qt.GlobalColor.white)
+    painter = QPainter(image)
+    for i in range(i0, i1 + 1):
+        for j in range(j0, j1 + 1):
+            painter.drawImage((i - i0) * size, (j1 - j) * size, QImage(tile_file(pyramid, z, i, j)))
+    painter.end()
+    return QPixmap.fromImage(image.copy(x, y, w, h))
@@ -11,6 +11,46 @@ Output
 - in folder "merge"
 -   files: EBeam.oas, EBeam.txt, EBeam.coords
 
+Usage:
+  python merge/EBeam_merge.py [--jobs N] [--no-cache] [--streaming] [--dedup] [--fingerprints] [--placement {walker,floorplan}]
+
+The submissions are loaded, filtered and clipped in parallel (one worker
+process per submission), then placed and copied into the merged layout
+in sorted order by a single writer, so the output does not depend on
+the number of jobs. The workers hand the clipped cells back as GDSII,
+which the writer reads straight into the merged layout; the cells that
+have the name of a cell already there get a new one (e.g., Waveguide$1),
+as with copy_tree.
+
+Prepared submissions are cached in merge/cache, keyed by the file contents
+and the merge configuration, so only new or changed files are re-processed.
+The key also has prepare_version, which is incremented when the preparation
+changes, so entries from an older version of this script are not used.
+
+With --streaming, each placed submission is written straight into the
+output as soon as it is ready, and released, so the memory use is bounded
+by the largest submission rather than the whole die. The output is then
+GDSII (EBeam.gds), since OASIS needs the whole layout to write its tables.
+In this mode, the index of the labels (EBeam_labels.json) is not saved;
+the measurement viewer builds it when it first loads the layout.
+
+The placement on the die is done by merge/floorplan.py; "walker" (the
+default) is the column placement used for the fabricated die, and
+"floorplan" places the submissions by their actual size, keeping the
+positions of the previous merge (EBeam_floorplan.json) for files that
+did not change.
+
+With --dedup, the cells that are identical in several submissions
+(e.g., ebeam_y_1550, ebeam_y_1550$1, ...) are replaced by one cell before
+the export, see merge/cell_dedup.py; not in streaming mode, where the
+submissions are already written. OASIS already stores repeated geometry
+compactly, so this only makes the file 5 to 17% smaller, for 2 to 5 s
+more on a 8 to 13 s merge; it is not done by default.
+
+With --fingerprints, the log lists the submissions that are duplicates or
+near-duplicates of another one (same geometry, or most of their cells
+shared), see fingerprint.py; they are still merged.
+
 '''
 
 
@@ -41,6 +81,11 @@ dbu = 0.001
 log_siepictools = False
 framework_file = 'EBL_Framework_1cm_PCM_static.oas'
 ubc_file = 'UBC_static.oas'
+jobs = None  # number of worker processes used to prepare the submissions; None: all CPU cores
+cache_folder = 'cache'  # prepared submissions, in the merge folder
+prepare_version = 8  # of what prepare_submission returns; increment it when that changes, so the cached submissions are prepared again
+placement = 'walker'  # 'walker': original column placement; 'floorplan': packing, see floorplan.py
+floorplan_file = 'EBeam_floorplan.json'
 
 
 # record processing time
@@ -59,6 +104,19 @@ from SiEPIC._globals import Python_Env, KLAYOUT_VERSION, KLAYOUT_VERSION_3
 from SiEPIC.scripts import zoom_out, export_layout
 from SiEPIC.utils import find_automated_measurement_labels
 import os
+import sys
+import argparse
+import collections
+import hashlib
+import json
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from gds_stream import GDSStreamWriter
+from floorplan import Floorplan, ColumnWalker
+from label_index import load_label_index, index_file
+from cell_dedup import dedup_cells, log_report
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import fingerprint
 
 '''
 if Python_Env == 'Script':
@@ -75,92 +133,60 @@ if Python_Env == 'Script':
         import siepic_ebeam_pdk
 '''
 
-# Output layout
-layout = pya.Layout()
-layout.dbu = dbu
-top_cell = layout.create_cell(top_cell_name)
-layerText = pya.LayerInfo(int(layer_text.split('/')[0]), int(layer_text.split('/')[1]))
-layerTextN = top_cell.layout().layer(layerText)
-
-def disable_libraries():
-    print('Disabling KLayout libraries')
+def disable_libraries(verbose=True):
+    if verbose:
+        print('Disabling KLayout libraries')
     for l in pya.Library().library_ids():
-        print(' - %s' % pya.Library().library_by_id(l).name())
+        if verbose:
+            print(' - %s' % pya.Library().library_by_id(l).name())
         pya.Library().library_by_id(l).delete()
 
-disable_libraries()
-
-# path for this python file
-path = os.path.dirname(os.path.realpath(__file__))
-
-# Log file
-global log_file
-log_file = open(os.path.join(path,filename_out+'.txt'), 'w')
-def log(text):
-    global log_file
-    log_file.write(text)
-    log_file.write('\n')
-
-log('SiEPIC-Tools %s, layout merge, running KLayout 0.%s.%s ' % (SiEPIC.__version__, KLAYOUT_VERSION,KLAYOUT_VERSION_3) )
-current_time = now.strftime("%Y-%m-%d, %H:%M:%S local time")
-log("Date: %s" % current_time)
-
-# Load all the GDS/OAS files from the "submissions" folder:
-path2 = os.path.abspath(os.path.join(path,"../submissions"))
-files_in = []
-_, _, files = next(os.walk(path2), (None, None, []))
-for f in sorted(files):
-    files_in.append(os.path.join(path2,f))
-
-# Load all the GDS/OAS files from the "framework" folder:
-path2 = os.path.abspath(os.path.join(path,"../framework"))
-_, _, files = next(os.walk(path2), (None, None, []))
-for f in sorted(files):
-    files_in.append(os.path.join(path2,f))
-
-# Create course cells using the folder name under the top cell
-cell_edXphot1x = layout.create_cell("edX")
-t = Trans(Trans.R0, 0,0)
-top_cell.insert(CellInstArray(cell_edXphot1x.cell_index(), t))
-cell_ELEC413 = layout.create_cell("ELEC413")
-top_cell.insert(CellInstArray(cell_ELEC413.cell_index(), t))
-cell_SiEPIC_Passives = layout.create_cell("SiEPIC_Passives")
-top_cell.insert(CellInstArray(cell_SiEPIC_Passives.cell_index(), t))
-cell_openEBL = layout.create_cell("openEBL")
-top_cell.insert(CellInstArray(cell_openEBL.cell_index(), t))
-
-# Create a date	stamp cell, and add a text label
-merge_stamp = '.merged:'+now.strftime("%Y-%m-%d-%H:%M:%S")
-cell_date = layout.create_cell(merge_stamp)
-text = Text (merge_stamp, Trans(Trans.R0, 0, 0) )
-shape = cell_date.shapes(layout.layer(10,0)).insert(text)
-top_cell.insert(CellInstArray(cell_date.cell_index(), t))   
-
-# Origins for the layouts
-x,y = 0,cell_Height+cell_Gap_Height
-
-import subprocess
-import pandas as pd
-for f in [f for f in files_in if '.oas' in f.lower() or '.gds' in f.lower()]:
-    basefilename = os.path.basename(f)
-
-    # GitHub Action gets the actual time committed.  This can be done locally
-    # via git restore-mtime.  Then we can load the time from the file stamp
-
-    filedate = datetime.fromtimestamp(os.path.getmtime(f)).strftime("%Y%m%d_%H%M")
-    log("\nLoading: %s, dated %s" % (os.path.basename(f), filedate))
-
-    # Tried to get it from GitHub but that didn't work:
-    # get the time the file was last updated from the Git repository 
-    # a = subprocess.run(['git', '-C', os.path.dirname(f), 'log', '-1', '--pretty=%ci',  basefilename], stdout = subprocess.PIPE) 
-    # filedate = pd.to_datetime(str(a.stdout.decode("utf-8"))).strftime("%Y%m%d_%H%M")
-    #filedate = os.path.getctime(os.path.dirname(f)) # .strftime("%Y%m%d_%H%M")
-    
-  
-    # Load layout  
-    layout2 = pya.Layout()
-    layout2.read(f)
-
+def map_bounded(executor, fn, items, window):
+    '''
+    Like executor.map, but with at most window results pending,
+    so that the prepared submissions do not all pile up in memory
+    '''
+    pending = collections.deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def move_layers(layout):
+    for i in range(0,len(layers_move)):
+        layer1=layout.find_layer(*layers_move[i][0])
+        if layer1 is None:
+            continue
+        layer2=layout.layer(*layers_move[i][1])
+        layout.move_layer(layer1, layer2)
+
+def die_obstacles():
+    '''
+    Areas of the die that cannot be used for submissions, as (left, bottom, right, top)
+    '''
+    return [
+        (0, 0, chip_Width, cell_Height+cell_Gap_Height),  # bottom row
+        (0, chip_Height1, cell_Width, chip_Height2),  # first column is shorter
+        (tr_cutout_x, tr_cutout_y, chip_Width, chip_Height2),  # top right cutout for PCM
+        (br_cutout_x, 0, chip_Width, br_cutout_y),  # bottom right cutout for PCM
+        (br_cutout2_x, 0, chip_Width, br_cutout2_y),  # bottom right cutout #2 for PCM
+    ]
+
+def create_placer(method, previous=None):
+    '''
+    Placement engine for the submissions; see floorplan.py
+    '''
+    if method == 'floorplan':
+        return Floorplan(chip_Width, chip_Height2, cell_Width, cell_Gap_Width, cell_Gap_Height, die_obstacles(), previous)
+    return ColumnWalker(cell_Width, cell_Height, cell_Gap_Width, cell_Gap_Height, chip_Height1, chip_Height2,
+                        (tr_cutout_x, tr_cutout_y), (br_cutout_x, br_cutout_y), (br_cutout2_x, br_cutout2_y))
+
+def course_name(basefilename):
+    '''
+    Course (and hence course cell) for a submission, from its filename
+    '''
     if 'ebeam' in basefilename.lower():
         course = 'edXphot1x'
     elif 'elec413' in basefilename.lower():
@@ -171,13 +197,179 @@ for f in [f for f in files_in if '.oas' in f.lower() or '.gds' in f.lower()]:
         course = 'SiEPIC_Passives'
     else:
         course = 'openEBL'
+    return course
+
+def cache_key(f):
+    '''
+    Cache key for a prepared submission: a hash of the file contents,
+    of the configuration that affects how it is prepared, and of prepare_version
+    '''
+    h = hashlib.sha256()
+    with open(f, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            h.update(chunk)
+    config = ['layer_map', course_name(os.path.basename(f)), layers_keep, layer_text, layer_SEM, layer_SEM_allow,
+              cell_Width, cell_Height, dbu, log_siepictools, '0.%s.%s' % (KLAYOUT_VERSION, KLAYOUT_VERSION_3), prepare_version]
+    h.update(json.dumps(config).encode('utf-8'))
+    return h.hexdigest()
+
+def cache_entry(key, cache_path):
+    '''
+    The prepared submission for the cache key, from the cache in cache_path; None if it has no (complete) entry.
+    Its clipped cell is not loaded: result['gds_file'] is the .gds file of the entry, which read_prepared reads
+    '''
+    file_json = os.path.join(cache_path, key + '.json')
+    file_gds = os.path.join(cache_path, key + '.gds')
+    if not os.path.exists(file_json):
+        return None
+    try:
+        with open(file_json, 'r') as file:
+            result = json.load(file)
+        result['gds'] = None
+        if result['cell_name']:
+            if not os.path.exists(file_gds):
+                return None
+            result['gds_file'] = file_gds
+        return result
+    except (OSError, ValueError, KeyError):
+        return None  # incomplete entry; the file is prepared again
+
+def prepare_submission_cached(f, cache_path=None):
+    '''
+    prepare_submission, using the cache in cache_path if it has an entry for this file.
+    Each entry is a .json file with the result, and a .gds file with the clipped cell.
+    Returns (result, key, True if it was loaded from the cache)
+    '''
+    if not cache_path:
+        return prepare_submission(f), None, False
+
+    key = cache_key(f)
+    result = cache_entry(key, cache_path)
+    if result:
+        return result, key, True
+
+    result = prepare_submission(f)
+    file_json = os.path.join(cache_path, key + '.json')
+    file_gds = os.path.join(cache_path, key + '.gds')
+
+    # write the entry; the .json is written last, and renamed into place, so a partial entry is never used
+    if result['gds']:
+        with open(file_gds + '.tmp%s' % os.getpid(), 'wb') as file:
+            file.write(result['gds'])
+        os.replace(file_gds + '.tmp%s' % os.getpid(), file_gds)
+    with open(file_json + '.tmp%s' % os.getpid(), 'w') as file:
+        json.dump({k: v for k, v in result.items() if k != 'gds'}, file)
+    os.replace(file_json + '.tmp%s' % os.getpid(), file_json)
+    # the writer reads the clipped cell from the entry, so it is not sent back
+    if result['gds']:
+        result['gds'] = None
+        result['gds_file'] = file_gds
+    return result, key, False
+
+def load_options(layers):
+    '''
+    Layout reader options that only load the given layers, e.g., ['1/0', '10/0']
+    '''
+    layer_map = pya.LayerMap()
+    for i, layer in enumerate(layers):
+        layer_map.map(pya.LayerInfo.from_string(layer), i)
+    options = pya.LoadLayoutOptions()
+    options.layer_map = layer_map
+    options.create_other_layers = False
+    return options
+
+def clean_text_layer(cell, layer_index):
+    '''
+    Clean up the text layer of the cell and of the cells below it:
+    delete the shapes that are not texts, and the SiEPIC-Tools texts.
+    Returns (SiEPIC-Tools texts, opt_in texts), in the order of the hierarchy; the opt_in texts once for each place they are in the cell
+    '''
+    # one pass over the texts only; the other shapes are cleared in each cell, without visiting them
+    siepic_texts, labels = [], []
+    s = cell.begin_shapes_rec(layer_index)
+    s.shape_flags = pya.Shapes.STexts
+    while not s.at_end():
+        text = s.shape().text_string
+        if text.startswith('SiEPIC-Tools'):
+            siepic_texts.append(text)
+            s.shape().delete()
+        elif text.startswith('opt_in'):
+            labels.append(text)
+        s.next()
+    layout = cell.layout()
+    for ci in [cell.cell_index()] + list(cell.called_cells()):
+        shapes = layout.cell(ci).shapes(layer_index)
+        if not shapes.is_empty():
+            shapes.clear(pya.Shapes.SAll & ~pya.Shapes.STexts)
+    return siepic_texts, labels
+
+
+# name of the clipped cell in the GDSII of a prepared submission; read_prepared gives it the name of the top cell
+clipped_cell_name = '$clipped'
+
+def read_prepared(layout, result):
+    '''
+    Read the clipped cell of a prepared submission, and the cells below it, from its GDSII bytes
+    (or from its cache entry) straight into layout. The cells that have the name of a cell already in layout get a new name
+    (e.g., Waveguide$1), as with copy_tree. Returns the clipped cell
+    '''
+    options = pya.LoadLayoutOptions()
+    options.cell_conflict_resolution = pya.LoadLayoutOptions.RenameCell
+    if result.get('gds_file'):
+        layout.read(result['gds_file'], options)
+    else:
+        layout.read_bytes(result['gds'], options)
+    cell = layout.cell(clipped_cell_name)
+    cell.name = layout.unique_cell_name(result['cell_name'])
+    return cell
+
+
+def prepare_submission(f):
+    '''
+    Load one submission and prepare its cell for the merge:
+    load only the kept layers, check the dbu, find the top cell, clean up the text layer,
+    and clip to the maximum cell size.
+    This runs in a worker process, and does not touch the merged layout.
+
+    Returns a dict with:
+        'log': list of lines for the log file
+        'course': course name
+        'cell_name': name of the user's top cell, or None if nothing is to be placed
+        'texts': SiEPIC-Tools text labels, to be added to the submission cell
+        'bbox': lower left corner of the top cell
+        'size': width and height of the clipped cell
+        'gds': the clipped cell and the cells below it, as GDSII bytes; see read_prepared
+    '''
+    basefilename = os.path.basename(f)
+    lines = []
+    result = {'log': lines, 'course': course_name(basefilename), 'cell_name': None, 'texts': [], 'gds': None}
+
+    course = result['course']
+    lines.append("  - course name: %s" % (course) )
 
-    cell_course = eval('cell_' + course)
-    log("  - course name: %s" % (course) )
+    # Load layout: the kept layers are mapped, so the reader creates them first, in the order of layers_keep;
+    # the other layers are created after them, so that the log can name them, and are deleted
+    layers_keep2 = [layer_SEM] if course in layer_SEM_allow else []
+    options = load_options(layers_keep + layers_keep2)
+    options.create_other_layers = True
+    layout2 = pya.Layout()
+    layout2.read(f, options)
+    num_shapes, num_skipped = 0, 0
+    for li in layout2.layer_indexes():
+        shapes = sum(c.shapes(li).size() for c in layout2.each_cell())
+        if li < len(layers_keep + layers_keep2):
+            if shapes:
+                lines.append('  - loading layer: %s' % layout2.get_info(li).to_s())
+            num_shapes += shapes
+        else:
+            lines.append('  - skipping layer: %s (%s shapes)' % (layout2.get_info(li).to_s(), shapes))
+            num_skipped += shapes
+            layout2.delete_layer(li)
+    lines.append('  - loaded %s shapes on the kept layers, skipped %s shapes on the other layers, from a file of %s bytes' % (num_shapes, num_skipped, os.path.getsize(f)))
 
     # Check the DBU Database Unit, in case someone changed it, e.g., 5 nm, or 0.1 nm.
     if round(layout2.dbu,10) != dbu:
-        log('  - WARNING: The database unit (%s dbu) in the layout does not match the required dbu of %s.' % (layout2.dbu, dbu))
+        lines.append('  - WARNING: The database unit (%s dbu) in the layout does not match the required dbu of %s.' % (layout2.dbu, dbu))
         print('  - WARNING: The database unit (%s dbu) in the layout does not match the required dbu of %s.' % (layout2.dbu, dbu))
         # Step 1: change the DBU to match, but that magnifies the layout
         wrong_dbu = layout2.dbu
@@ -187,158 +379,335 @@ for f in [f for f in files_in if '.oas' in f.lower() or '.gds' in f.lower()]:
             # determine the scaling required
             scaling = round(wrong_dbu / dbu, 10)
             layout2.transform (pya.ICplxTrans(scaling, 0, False, 0, 0))
-            log('  - WARNING: Database resolution has been corrected and the layout scaled by %s' % scaling) 
+            lines.append('  - WARNING: Database resolution has been corrected and the layout scaled by %s' % scaling) 
         except:
             print('ERROR IN EBeam_merge.py: Incorrect DBU and scaling unsuccessful')
     
     # check that there is one top cell in the layout
     num_top_cells = len(layout2.top_cells())
     if num_top_cells > 1:
-        log('  - layout should only contain one top cell; contains (%s): %s' % (num_top_cells, [c.name for c in layout2.top_cells()]) )
+        lines.append('  - layout should only contain one top cell; contains (%s): %s' % (num_top_cells, [c.name for c in layout2.top_cells()]) )
     if num_top_cells == 0:
-        log('  - layout does not contain a top cell')
+        lines.append('  - layout does not contain a top cell')
 
     # Find the top cell
     for cell in layout2.top_cells():
-        if os.path.basename(f) == framework_file:
-            # Create sub-cell using the filename under top cell
-            subcell2 = layout.create_cell(os.path.basename(f)+"_"+filedate)
-            t = Trans(Trans.R0, 0,0)
-            top_cell.insert(CellInstArray(subcell2.cell_index(), t))
-            # copy
-            subcell2.copy_tree(layout2.cell(cell.name)) 
-            break
-
-        if os.path.basename(f) == ubc_file:
-            # Create sub-cell using the filename under top cell
-            subcell2 = layout.create_cell(os.path.basename(f)+"_"+filedate)
-            t = Trans(Trans.R0, 8780000,8780000)      
-            top_cell.insert(CellInstArray(subcell2.cell_index(), t))
-            # copy
-            subcell2.copy_tree(layout2.cell(cell.name)) 
-            break
-
-
         if num_top_cells == 1 or cell.name.lower() == 'top' or cell.name.lower() == 'EBeam_':
-            log("  - top cell: %s" % cell.name)
+            lines.append("  - top cell: %s" % cell.name)
 
             # check layout height
             if cell.bbox().top < cell.bbox().bottom:
-                log(' - WARNING: empty layout. Skipping.')
+                lines.append(' - WARNING: empty layout. Skipping.')
                 break
                 
-            # Create sub-cell using the filename under course cell
-            subcell2 = layout.create_cell(os.path.basename(f)+"_"+filedate)
-            t = Trans(Trans.R0, x,y)
-            cell_course.insert(CellInstArray(subcell2.cell_index(), t))
-            
-            # Clear extra layers
-            layers_keep2 = [layer_SEM] if course in layer_SEM_allow else []
-            for li in layout2.layer_infos():
-                if li.to_s() in layers_keep + layers_keep2:
-                    log('  - loading layer: %s' % li.to_s())
-                else:
-                    log('  - deleting layer: %s' % li.to_s())
-                    layer_index = layout2.find_layer(li)
-                    layout2.delete_layer(layer_index)
-                    
             # Delete non-text geometries in the Text layer
             layer_index = layout2.find_layer(int(layer_text.split('/')[0]), int(layer_text.split('/')[1]))
             if type(layer_index) != type(None):
-                s = cell.begin_shapes_rec(layer_index)
-                shapes_to_delete = []
-                while not s.at_end():
-                    if s.shape().is_text():
-                        text = s.shape().text.string
-                        if text.startswith('SiEPIC-Tools'):
-                            if log_siepictools:
-                                log('  - %s' % s.shape() )
-                            s.shape().delete()
-                            subcell2.shapes(layerTextN).insert(pya.Text(text, 0, 0))
-                        elif text.startswith('opt_in'):
-                            log('  - measurement label: %s' % text )
-                    else:
-                        shapes_to_delete.append( s.shape() )
-                    s.next()
-                for s in shapes_to_delete:
-                    s.delete()
+                siepic_texts, labels = clean_text_layer(cell, layer_index)
+                if log_siepictools:
+                    lines += ['  - %s' % text for text in siepic_texts]
+                lines += ['  - measurement label: %s' % text for text in labels]
+                result['texts'] += siepic_texts
 
             # bounding box of the cell
             bbox = cell.bbox()
-            log('  - bounding box: %s' % bbox.to_s() )
+            lines.append('  - bounding box: %s' % bbox.to_s() )
                             
-            # Create sub-cell under subcell cell, using user's cell name
-            subcell = layout.create_cell(cell.name)
-            t = Trans(Trans.R0, -bbox.left,-bbox.bottom)
-            subcell2.insert(CellInstArray(subcell.cell_index(), t))
-        
             # clip cells
             cell2 = layout2.clip(cell.cell_index(), pya.Box(bbox.left,bbox.bottom,bbox.left+cell_Width,bbox.bottom+cell_Height))
             bbox2 = layout2.cell(cell2).bbox()
             if bbox != bbox2:
-                log('  - WARNING: Cell was clipped to maximum size of %s X %s' % (cell_Width, cell_Height) )
-                log('  - clipped bounding box: %s' % bbox2.to_s() )
+                lines.append('  - WARNING: Cell was clipped to maximum size of %s X %s' % (cell_Width, cell_Height) )
+                lines.append('  - clipped bounding box: %s' % bbox2.to_s() )
+
+            result['cell_name'] = cell.name
+            result['bbox'] = (bbox.left, bbox.bottom)
+            result['size'] = (bbox2.width(), bbox2.height())
+            # the clipped cell (e.g., TOP$1) is found by its name by read_prepared
+            layout2.cell(cell2).name = clipped_cell_name
+
+            # hand the clipped cell (and its hierarchy) back to the writer, as GDSII, which keeps
+            # the order of the shapes (OASIS does not); the ghost cells stay ghost cells, which the
+            # writer matches by name with the cells of the other submissions, as copy_tree does
+            options = pya.SaveLayoutOptions()
+            options.format = 'GDS2'
+            options.select_cell(cell2)
+            result['gds'] = layout2.write_bytes(options)
+            break
 
-            # copy
-            subcell.copy_tree(layout2.cell(cell2))  
-            
-            log('  - Placed at position: %s, %s' % (x,y) )
-                
-            # Measure the height of the cell that was added, and move up
-            y += max (cell_Height, subcell.bbox().height()) + cell_Gap_Height
-            # move right and bottom when we reach the top of the chip
-            if y + cell_Height > chip_Height1 and x == 0:
-                y = cell_Height + cell_Gap_Height
-                x += cell_Width + cell_Gap_Width
-            if y + cell_Height > chip_Height2:
-                y = cell_Height + cell_Gap_Height
-                x += cell_Width + cell_Gap_Width
-            # check top right cutout for PCM
-            if x + cell_Width > tr_cutout_x and y + cell_Height > tr_cutout_y:
-                # go to the next column
-                y = cell_Height + cell_Gap_Height    
-                x += cell_Width + cell_Gap_Width
-            # Check bottom right cutout for PCM
-            if x + cell_Width > br_cutout_x and y < br_cutout_y:
-                y = br_cutout_y
-            # Check bottom right cutout #2 for PCM
-            if x + cell_Width > br_cutout2_x and y < br_cutout2_y:
-                y = br_cutout2_y
+    return result
 
-'''
-text_out,opt_in = find_automated_measurement_labels(topcell=top_cell, LayerTextN=layerTextN)
-coords_file = open(os.path.join(path,'merge',filename_out+'_coords.txt'), 'w')
-coords_file.write(text_out)
-coords_file.close()
-'''
 
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Merge the submissions into a single layout')
+    parser.add_argument('-j', '--jobs', type=int, default=jobs, help='number of worker processes (default: all CPU cores)')
+    parser.add_argument('--no-cache', action='store_true', help='prepare all the submissions again, without using the cache')
+    parser.add_argument('--placement', choices=['walker', 'floorplan'], default=placement, help='placement of the submissions on the die')
+    parser.add_argument('--streaming', action='store_true', help='write each submission to the output (GDSII) as it is placed, to bound the memory use')
+    parser.add_argument('--dedup', action='store_true', help='replace the identical cells of different submissions by one cell')
+    parser.add_argument('--fingerprints', action='store_true', help='list the submissions that are duplicates or near-duplicates of another one')
+    args = parser.parse_args()
 
-# move layers
-for i in range(0,len(layers_move)):
-    layer1=layout.find_layer(*layers_move[i][0])
-    layer2=layout.find_layer(*layers_move[i][1])
-    layout.move_layer(layer1, layer2)
+    # Output layout
+    layout = pya.Layout()
+    layout.dbu = dbu
+    top_cell = layout.create_cell(top_cell_name)
+    layerText = pya.LayerInfo(int(layer_text.split('/')[0]), int(layer_text.split('/')[1]))
+    layerTextN = top_cell.layout().layer(layerText)
 
-# Export as-is layout, for UW fabrication
-log('')
+    def new_layout():
+        layout_sub = pya.Layout()
+        layout_sub.dbu = dbu
+        return layout_sub
 
-#export_layout (top_cell, path, filename='EBeam', relative_path='', format='gds')
-file_out = export_layout (top_cell, path, filename='EBeam', relative_path='', format='oas')
-# log("Layout exported successfully %s: %s" % (save_options.format, file_out) )
+    disable_libraries()
 
+    # path for this python file
+    path = os.path.dirname(os.path.realpath(__file__))
 
-log("\nExecution time: %s seconds" % int((time.time() - start_time)))
+    # Log file
+    global log_file
+    log_file = open(os.path.join(path,filename_out+'.txt'), 'w')
+    def log(text):
+        global log_file
+        log_file.write(text)
+        log_file.write('\n')
+
+    log('SiEPIC-Tools %s, layout merge, running KLayout 0.%s.%s ' % (SiEPIC.__version__, KLAYOUT_VERSION,KLAYOUT_VERSION_3) )
+    current_time = now.strftime("%Y-%m-%d, %H:%M:%S local time")
+    log("Date: %s" % current_time)
+
+    # Load all the GDS/OAS files from the "submissions" folder:
+    path2 = os.path.abspath(os.path.join(path,"../submissions"))
+    files_in = []
+    _, _, files = next(os.walk(path2), (None, None, []))
+    for f in sorted(files):
+        files_in.append(os.path.join(path2,f))
+
+    # Load all the GDS/OAS files from the "framework" folder:
+    path2 = os.path.abspath(os.path.join(path,"../framework"))
+    _, _, files = next(os.walk(path2), (None, None, []))
+    for f in sorted(files):
+        files_in.append(os.path.join(path2,f))
+
+    # Create course cells using the folder name under the top cell
+    cell_edXphot1x = layout.create_cell("edX")
+    t = Trans(Trans.R0, 0,0)
+    top_cell.insert(CellInstArray(cell_edXphot1x.cell_index(), t))
+    cell_ELEC413 = layout.create_cell("ELEC413")
+    top_cell.insert(CellInstArray(cell_ELEC413.cell_index(), t))
+    cell_SiEPIC_Passives = layout.create_cell("SiEPIC_Passives")
+    top_cell.insert(CellInstArray(cell_SiEPIC_Passives.cell_index(), t))
+    cell_openEBL = layout.create_cell("openEBL")
+    top_cell.insert(CellInstArray(cell_openEBL.cell_index(), t))
+
+    # Create a date	stamp cell, and add a text label
+    merge_stamp = '.merged:'+now.strftime("%Y-%m-%d-%H:%M:%S")
+    cell_date = layout.create_cell(merge_stamp)
+    text = Text (merge_stamp, Trans(Trans.R0, 0, 0) )
+    shape = cell_date.shapes(layout.layer(10,0)).insert(text)
+    top_cell.insert(CellInstArray(cell_date.cell_index(), t))   
+
+    # In streaming mode, "layout" only holds the top-level cells; the submissions are
+    # built in their own layout, written out, and referenced here as ghost cells
+    if args.streaming:
+        stream = GDSStreamWriter(os.path.join(path, filename_out+'.gds'), dbu, [c.name for c in layout.each_cell()])
+
+    def place_cell(layout_sub, subcell2, cell_parent, t):
+        '''
+        Instantiate subcell2 in cell_parent; in streaming mode, write out its layout first
+        '''
+        if args.streaming:
+            move_layers(layout_sub)
+            stream.write(layout_sub, subcell2)
+            subcell2 = layout.create_cell(subcell2.name)
+            subcell2.ghost_cell = True
+        cell_parent.insert(CellInstArray(subcell2.cell_index(), t))
+
+    files_in = [f for f in files_in if '.oas' in f.lower() or '.gds' in f.lower()]
+
+    # Placement of the submissions; the floorplan keeps the positions from the previous merge
+    previous = None
+    if args.placement == 'floorplan':
+        previous = Floorplan.load(os.path.join(path, floorplan_file)) or {}
+        names = [os.path.basename(f) for f in files_in]
+        previous = {name: previous[name] for name in previous if name in names}
+    placer = create_placer(args.placement, previous)
+
+    # The framework files are copied as-is by the writer; everything else is prepared by the workers
+    files_static = [framework_file, ubc_file]
+    files_prepare = [f for f in files_in if os.path.basename(f) not in files_static]
+    cache_path = None
+    if not args.no_cache:
+        cache_path = os.path.join(path, cache_folder)
+        os.makedirs(cache_path, exist_ok=True)
+    # duplicates and near-duplicates of other submissions are listed, and still merged
+    if args.fingerprints:
+        fingerprints = fingerprint.fingerprint_files(files_prepare, args.jobs, os.path.join(os.path.dirname(path), fingerprint.cache_folder) if cache_path else None)
+        log('')
+        fingerprint.print_report(fingerprints, log, diffs=False)
+    # the submissions in the cache are read by the writer; the worker processes are only started for the others
+    cache_keys, cached = [], {}
+    if cache_path:
+        for f in files_prepare:
+            cache_keys.append(cache_key(f))
+            cached[f] = cache_entry(cache_keys[-1], cache_path)
+    files_todo = [f for f in files_prepare if not cached.get(f)]
+    if files_todo:
+        print('Preparing %s submissions using %s worker processes' % (len(files_todo), args.jobs or os.cpu_count()))
+        executor = ProcessPoolExecutor(max_workers=args.jobs, initializer=disable_libraries, initargs=(False,))
+        # results are returned in the order of files_todo, as they become available
+        prepared = map_bounded(executor, partial(prepare_submission_cached, cache_path=cache_path), files_todo, 2 * (args.jobs or os.cpu_count()))
+
+    for f in files_in:
+        basefilename = os.path.basename(f)
+
+        # GitHub Action gets the actual time committed.  This can be done locally
+        # via git restore-mtime.  Then we can load the time from the file stamp
+
+        filedate = datetime.fromtimestamp(os.path.getmtime(f)).strftime("%Y%m%d_%H%M")
+        log("\nLoading: %s, dated %s" % (os.path.basename(f), filedate))
+
+        # Tried to get it from GitHub but that didn't work:
+        # get the time the file was last updated from the Git repository 
+        # a = subprocess.run(['git', '-C', os.path.dirname(f), 'log', '-1', '--pretty=%ci',  basefilename], stdout = subprocess.PIPE) 
+        # filedate = pd.to_datetime(str(a.stdout.decode("utf-8"))).strftime("%Y%m%d_%H%M")
+        #filedate = os.path.getctime(os.path.dirname(f)) # .strftime("%Y%m%d_%H%M")
+
+        if basefilename in files_static:
+            # Load layout  
+            layout2 = pya.Layout()
+            layout2.read(f)
+            log("  - course name: %s" % (course_name(basefilename)) )
+            # Find the top cell
+            for cell in layout2.top_cells():
+                if basefilename == framework_file:
+                    t = Trans(Trans.R0, 0,0)
+                else:
+                    t = Trans(Trans.R0, 8780000,8780000)      
+                if args.streaming and round(layout2.dbu,10) == dbu:
+                    # no need to copy the framework; rename its top cell, and write it out as-is
+                    cell.name = os.path.basename(f)+"_"+filedate
+                    place_cell(layout2, cell, top_cell, t)
+                    break
+                # Create sub-cell using the filename under top cell
+                layout_sub = new_layout() if args.streaming else layout
+                subcell2 = layout_sub.create_cell(os.path.basename(f)+"_"+filedate)
+                # copy
+                subcell2.copy_tree(layout2.cell(cell.name)) 
+                place_cell(layout_sub, subcell2, top_cell, t)
+                break
+            continue
+
+        result = cached.get(f) or next(prepared)[0]
+        for line in result['log']:
+            log(line)
+        if not result['cell_name']:
+            continue
+
+        cell_course = eval('cell_' + result['course'])
+
+        # Create sub-cell using the filename under course cell
+        layout_sub = new_layout() if args.streaming else layout
+        subcell2 = layout_sub.create_cell(os.path.basename(f)+"_"+filedate)
+
+        # SiEPIC-Tools labels are moved to the submission cell
+        for text in result['texts']:
+            subcell2.shapes(layout_sub.layer(layerText)).insert(pya.Text(text, 0, 0))
+
+        # Create sub-cell under subcell cell, using user's cell name: the clipped cell, read into the layout
+        subcell = read_prepared(layout_sub, result)
+        t = Trans(Trans.R0, -result['bbox'][0],-result['bbox'][1])
+        subcell2.insert(CellInstArray(subcell.cell_index(), t))
+
+        # Find a place on the die, using the size of the cell that was added; from the result, since
+        # the bounding box of a cell in the merged layout updates the whole layout each time
+        position = placer.place(basefilename, *result['size'])
+        if position is None:
+            log('  - WARNING: no space left on the die. Skipping.')
+            print('  - WARNING: no space left on the die for %s' % basefilename)
+            layout_sub.delete_cell_rec(subcell2.cell_index())
+            continue
+        x, y = position
+        place_cell(layout_sub, subcell2, cell_course, Trans(Trans.R0, x,y))
+        
+        log('  - Placed at position: %s, %s' % (x,y) )
+
+    if files_todo:
+        executor.shutdown()
+
+    placer.finish()
+    if args.placement == 'floorplan':
+        placer.save(os.path.join(path, floorplan_file))
+        report = placer.report(cell_Height)
+        log('\nFloorplan: %s submissions, %.1f%% of the usable die area, %s columns used, %s free slots of %s X %s' % (
+            report['placed'], 100*report['utilization'], report['columns_used'], report['free_slots'], cell_Width, cell_Height))
+
+    if cache_path:
+        print('Prepared submissions: %s from the cache, %s processed' % (len(files_prepare) - len(files_todo), len(files_todo)))
+        # remove entries for files that are no longer in the submissions
+        for file in os.listdir(cache_path):
+            if file.split('.')[0] not in cache_keys:
+                os.remove(os.path.join(cache_path, file))
+
+    '''
+    text_out,opt_in = find_automated_measurement_labels(topcell=top_cell, LayerTextN=layerTextN)
+    coords_file = open(os.path.join(path,'merge',filename_out+'_coords.txt'), 'w')
+    coords_file.write(text_out)
+    coords_file.close()
+    '''
+
+
+    # Export as-is layout, for UW fabrication
+    log('')
+
+    if args.streaming:
+        # the top-level cells; the submissions have already been written
+        stream.write(layout, rename=False)
+        stream.close()
+        file_out = stream.filename
+    else:
+        # move layers
+        move_layers(layout)
+
+        # one cell for the identical cells of the submissions, e.g., the grating couplers (see cell_dedup.py)
+        if args.dedup:
+            dedup_time = time.time()
+            dedup_report = dedup_cells(layout)
+            log_report(dedup_report, log)
+            log('  - in %.1f seconds' % (time.time() - dedup_time))
+
+        #export_layout (top_cell, path, filename='EBeam', relative_path='', format='gds')
+        file_out = export_layout (top_cell, path, filename='EBeam', relative_path='', format='oas')
+    # log("Layout exported successfully %s: %s" % (save_options.format, file_out) )
+    log('Output: %s, %.1f MB' % (os.path.basename(file_out), os.path.getsize(file_out) / 2**20))
+
+    # index of the labels, saved next to the layout, for the measurement viewer (see label_index.py);
+    # in streaming mode, the layout is not in memory, and the viewer builds the index when it first loads it
+    if os.path.exists(index_file(file_out)):
+        os.remove(index_file(file_out))
+    if args.streaming:
+        log('Labels: not indexed in streaming mode')
+    else:
+        label_index = load_label_index(file_out, layout)
+        duplicates = label_index.duplicates()
+        log('Labels: %s opt_in labels, in %s; %s duplicated' % (
+            sum(1 for l in label_index.labels if l['text'].startswith('opt_in')), os.path.basename(index_file(file_out)), len(duplicates)))
+        for text in duplicates:
+            log('  - duplicated: %s, in cells %s' % (text, ', '.join(sorted(set(l['cell'] for l in label_index.find_all(text))))))
 
-log_file.close()
 
-# Display the layout in KLayout, using KLayout Package "klive", which needs to be installed in the KLayout Application
-try:
-    if Python_Env == 'Script':
-        from SiEPIC.utils import klive
-        klive.show(file_out, technology=tech_name)
-except:
-    pass
+    log("\nExecution time: %s seconds" % int((time.time() - start_time)))
 
-print("KLayout EBeam_merge.py, completed in: %s seconds" % int((time.time() - start_time)))
+    log_file.close()
 
+    # Display the layout in KLayout, using KLayout Package "klive", which needs to be installed in the KLayout Application
+    try:
+        if Python_Env == 'Script':
+            from SiEPIC.utils import klive
+            klive.show(file_out, technology=tech_name)
+    except:
+        pass
 
+    print("KLayout EBeam_merge.py, completed in: %s seconds" % int((time.time() - start_time)))
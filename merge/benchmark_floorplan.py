@@ -0,0 +1,85 @@
+'''
+Benchmark of the placement engines in floorplan.py, on the real submissions
+
+Compares the original column walker with the floorplan packing:
+utilization of the usable die area, free slots, and runtime.
+The submission sizes come from the merge cache (run EBeam_merge.py first
+to fill it; missing entries are prepared here).
+
+Usage:
+  python merge/benchmark_floorplan.py
+'''
+
+import os
+import time
+import EBeam_merge as merge
+from floorplan import Floorplan
+
+
+def submission_sizes(path):
+    '''
+    (filename, width, height) of the clipped cell of each submission, in merge order
+    '''
+    cache_path = os.path.join(path, merge.cache_folder)
+    os.makedirs(cache_path, exist_ok=True)
+    path_submissions = os.path.abspath(os.path.join(path, '../submissions'))
+    sizes = []
+    for f in sorted(os.listdir(path_submissions)):
+        if not ('.oas' in f.lower() or '.gds' in f.lower()):
+            continue
+        result, key, cached = merge.prepare_submission_cached(os.path.join(path_submissions, f), cache_path)
+        if not result['cell_name']:
+            continue
+        sizes.append((f, result['size'][0], result['size'][1]))
+    return sizes
+
+
+def run(method, sizes, repeat=20):
+    '''
+    Place all the submissions; returns (placer, runtime per placement of all submissions)
+    '''
+    start = time.perf_counter()
+    for i in range(repeat):
+        placer = merge.create_placer(method, {})
+        for name, width, height in sizes:
+            placer.place(name, width, height)
+        placer.finish()
+    return placer, (time.perf_counter() - start) / repeat
+
+
+if __name__ == "__main__":
+    path = os.path.dirname(os.path.realpath(__file__))
+    merge.disable_libraries(verbose=False)
+    sizes = submission_sizes(path)
+    print('Submissions: %s' % len(sizes))
+
+    # usable area, and free slots, are measured on the same die for both methods
+    placed = {}
+    for method in ['walker', 'floorplan']:
+        placer, runtime = run(method, sizes)
+        die = Floorplan(merge.chip_Width, merge.chip_Height2, merge.cell_Width, merge.cell_Gap_Width,
+                        merge.cell_Gap_Height, merge.die_obstacles())
+        outside = 0
+        for name, (x, y, width, height) in placer.placed.items():
+            if x not in die.columns or not die.fits(x, y, height):
+                # the walker does not check the right edge of the die
+                outside += 1
+                continue
+            die.add(name, x, y, width, height)
+        report = die.report(merge.cell_Height)
+        print('%-10s placed: %s, outside the die: %s, utilization: %.1f%%, columns used: %s, free slots: %s, runtime: %.2f ms' % (
+            method, report['placed'], outside, 100*report['utilization'], report['columns_used'], report['free_slots'], 1000*runtime))
+        placed[method] = placer.placed
+    moved = [name for name in placed['walker'] if tuple(placed['walker'][name][:2]) != tuple(placed['floorplan'][name][:2])]
+    print('floorplan positions different from the walker: %s of %s' % (len(moved), len(placed['walker'])))
+
+    # stability: remove one submission, and place again starting from the previous floorplan
+    placer, runtime = run('floorplan', sizes, repeat=1)
+    previous = dict(placer.placed)
+    removed = sizes[len(sizes)//2]
+    sizes2 = [s for s in sizes if s != removed]
+    placer2 = merge.create_placer('floorplan', {name: previous[name] for name, w, h in sizes2 if name in previous})
+    for name, width, height in sizes2:
+        placer2.place(name, width, height)
+    moved = sum(1 for name in placer2.placed if placer2.placed[name][:2] != tuple(previous[name][:2]))
+    print('floorplan stability: removed %s, %s of %s submissions moved' % (removed[0], moved, len(placer2.placed)))
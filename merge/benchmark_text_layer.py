@@ -0,0 +1,109 @@
+'''
+Micro-benchmark of the text layer cleanup in EBeam_merge.py
+
+Times clean_text_layer (one pass over the texts, the other shapes cleared
+in each cell) against the per-shape loop it replaced, on the submissions with the most shapes on the text layer, and on
+a synthetic text-heavy layout (texts, and boxes drawn on the text layer, in
+a cell placed many times). Each one is run on a fresh copy of the layout,
+and the results of the two are compared.
+
+Usage:
+  python merge/benchmark_text_layer.py [submissions folder]
+'''
+
+import os
+import sys
+import time
+import pya
+from EBeam_merge import clean_text_layer, layer_text
+
+submissions = 5  # the submissions with the most shapes on the text layer
+runs = 10  # the fastest run is used; the first ones are slower, with the caches cold
+synthetic_shapes = 20000  # texts and boxes in the synthetic layout's child cell
+synthetic_instances = 10
+
+
+def clean_text_layer_loop(cell, layer_index):
+    '''
+    The per-shape loop that clean_text_layer replaced, for comparison
+    '''
+    siepic_texts, labels = [], []
+    s = cell.begin_shapes_rec(layer_index)
+    shapes_to_delete = []
+    while not s.at_end():
+        if s.shape().is_text():
+            text = s.shape().text.string
+            if text.startswith('SiEPIC-Tools'):
+                s.shape().delete()
+                siepic_texts.append(text)
+            elif text.startswith('opt_in'):
+                labels.append(text)
+        else:
+            shapes_to_delete.append(s.shape())
+        s.next()
+    for s in shapes_to_delete:
+        s.delete()
+    return siepic_texts, labels
+
+
+def synthetic_layout():
+    layout = pya.Layout()
+    li = layout.layer(pya.LayerInfo.from_string(layer_text))
+    top = layout.create_cell('TOP')
+    child = layout.create_cell('child')
+    for i in range(synthetic_shapes):
+        child.shapes(li).insert(pya.Text('opt_in_TE_1550_device_%s' % i if i % 10 == 0 else 'label %s' % i, i * 10, 0))
+        child.shapes(li).insert(pya.Box(i * 10, 0, i * 10 + 5, 5))
+    for i in range(synthetic_instances):
+        top.insert(pya.CellInstArray(child.cell_index(), pya.Trans(0, i * 1000)))
+    top.shapes(li).insert(pya.Text('SiEPIC-Tools verification: 0 errors', 0, 0))
+    return layout
+
+
+def benchmark(read_layout, function):
+    '''
+    Fastest of the runs, in seconds, and the result: (texts left, SiEPIC-Tools texts, opt_in texts);
+    the texts are sorted, since a large Texts collection is in the order of its spatial index
+    '''
+    best = None
+    for r in range(runs):
+        layout = read_layout()
+        li = layout.find_layer(pya.LayerInfo.from_string(layer_text))
+        cell = layout.top_cells()[0]
+        start_time = time.perf_counter()
+        siepic_texts, labels = function(cell, li)
+        runtime = time.perf_counter() - start_time
+        best = runtime if best is None else min(best, runtime)
+        left = sum(c.shapes(li).size() for c in layout.each_cell())
+    return best, (left, sorted(siepic_texts), sorted(labels))
+
+
+def text_layer_shapes(filename):
+    layout = pya.Layout()
+    layout.read(filename)
+    li = layout.find_layer(pya.LayerInfo.from_string(layer_text))
+    if li is None or len(layout.top_cells()) != 1:
+        return 0
+    return sum(c.shapes(li).size() for c in layout.each_cell())
+
+
+if __name__ == "__main__":
+    path = os.path.dirname(os.path.realpath(__file__))
+    folder = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(path), 'submissions')
+    files = [os.path.join(folder, f) for f in sorted(os.listdir(folder)) if f.lower().endswith(('.gds', '.oas'))]
+    files = sorted(files, key=text_layer_shapes)[-submissions:]
+
+    def read(filename):
+        def read_layout():
+            layout = pya.Layout()
+            layout.read(filename)
+            return layout
+        return read_layout
+
+    cases = [(os.path.basename(f), read(f)) for f in files] + [
+        ('synthetic, %s texts and %s boxes x %s instances' % (synthetic_shapes, synthetic_shapes, synthetic_instances), synthetic_layout)]
+    for name, read_layout in cases:
+        t_loop, r_loop = benchmark(read_layout, clean_text_layer_loop)
+        t_clean, r_clean = benchmark(read_layout, clean_text_layer)
+        print('%s: per-shape loop %.2f ms, clean_text_layer %.2f ms, %.1fx%s' % (
+            name, 1000 * t_loop, 1000 * t_clean, t_loop / t_clean, '' if r_loop == r_clean else ', DIFFERENT results'))
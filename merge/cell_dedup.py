@@ -0,0 +1,165 @@
+'''
+Merge identical cells in a layout, keeping the hierarchy
+
+Each submission is copied into the merged layout with its own cells, so a
+cell used by many submissions (e.g., ebeam_gc_te1550, ebeam_y_1550, or the
+same Waveguide) is in the layout many times, as ebeam_y_1550, ebeam_y_1550$1,
+ebeam_y_1550$2, ... This finds the cells with the same name (without the $N
+suffix) and the same content, and replaces them by one cell.
+
+The cells are visited bottom-up, and each one gets a key: the hash of its
+name, its shapes on each layer (in any order) and its instances, with the
+children that are copies replaced by the cell that is kept, so cells that
+only differ by which copy of a child they use get the same key. Cells with the same key are compared
+with LayoutDiff before they are merged, so the layout does not change if the
+key misses a difference (e.g., shapes with different properties, for which
+only the property ids are hashed); such cells are counted as mismatches and
+kept.
+
+Usage:
+  python merge/cell_dedup.py EBeam.oas [output file]
+'''
+
+import os
+import re
+import sys
+import time
+import struct
+import hashlib
+import pya
+
+
+def base_name(name):
+    '''
+    The cell name without the $N suffixes added when cells are copied into a layout with the same name
+    '''
+    return re.sub(r'(\$\d+)+$', '', name)
+
+
+def shape_hash(shape):
+    '''
+    Hash of the shape's geometry (not of where it is stored)
+    '''
+    if shape.is_box():
+        return shape.box.hash()
+    if shape.is_path():
+        return shape.path.hash()
+    if shape.is_text():
+        return shape.text.hash()
+    if shape.is_edge():
+        return shape.edge.hash()
+    return shape.polygon.hash()
+
+
+def instance(inst, target):
+    '''
+    The instance (CellInstArray), referring to the cell that replaces its child
+    '''
+    array = inst.cell_inst
+    array.cell_index = target(inst.cell_index)
+    return array
+
+
+def cell_key(cell, layers, target=lambda ci: ci):
+    '''
+    Hash of the cell's name, shapes and instances; layers: [(layer index, name)];
+    target(cell index) is the cell that replaces a child
+    '''
+    h = hashlib.sha256(base_name(cell.name).encode('utf-8'))
+    for li, name in layers:
+        shapes = cell.shapes(li)
+        if shapes.is_empty():
+            continue
+        hashes = sorted((s.type(), shape_hash(s), s.prop_id) for s in shapes.each())
+        h.update(name.encode('utf-8'))
+        h.update(struct.pack('<%sQ' % (3 * len(hashes)), *[v & 0xffffffffffffffff for t in hashes for v in t]))
+    instances = sorted((instance(i, target).hash(), i.prop_id) for i in cell.each_inst())
+    h.update(b'instances')
+    h.update(struct.pack('<%sQ' % (2 * len(instances)), *[v & 0xffffffffffffffff for t in instances for v in t]))
+    return h.digest()
+
+
+def same_cell(layout, a, b):
+    '''
+    True if the cells a and b (indexes) have the same shapes, and the same instances
+    of identical children; the smart cell mapping pairs the cells by content, not by name
+    '''
+    return pya.LayoutDiff().compare(layout.cell(a), layout.cell(b), pya.LayoutDiff.Silent | pya.LayoutDiff.SmartCellMapping)
+
+
+def dedup_cells(layout, verify=True):
+    '''
+    Replace the identical cells of the layout by one cell (see above).
+    Returns a report: {'cells': cells removed, 'shapes': shapes removed,
+    'names': {name: copies removed}, 'mismatches': same key, but LayoutDiff found a difference}
+    '''
+    layers = sorted(((li, layout.get_info(li).to_s()) for li in layout.layer_indexes()), key=lambda l: l[1])
+    top_cells = set(c.cell_index() for c in layout.top_cells())
+    kept = {}  # key: cell index
+    copies = {}  # cell index of a copy: its key
+    report = {'cells': 0, 'shapes': 0, 'names': {}, 'mismatches': 0}
+
+    def target(ci):
+        return kept[copies[ci]] if ci in copies else ci
+
+    # the layout is only changed at the end: changing it here would make KLayout
+    # update the hierarchy each time it is queried
+    for ci in layout.each_cell_bottom_up():
+        cell = layout.cell(ci)
+        if ci in top_cells or cell.is_ghost_cell() or cell.is_proxy():
+            continue
+        key = cell_key(cell, layers, target)
+        k = kept.get(key)
+        if k is None:
+            kept[key] = ci
+            continue
+        if verify and not same_cell(layout, k, ci):
+            report['mismatches'] += 1
+            continue
+        # keep the copy with the original name, e.g., ebeam_y_1550 rather than ebeam_y_1550$3
+        if cell.name == base_name(cell.name) and layout.cell(k).name != cell.name:
+            k, ci = ci, k
+            kept[key] = k
+        copies[ci] = key
+        name = base_name(cell.name)
+        report['names'][name] = report['names'].get(name, 0) + 1
+        report['shapes'] += sum(layout.cell(ci).shapes(li).size() for li, _ in layers)
+
+    # the instances of the copies now refer to the kept cells
+    layout.start_changes()
+    try:
+        for cell in layout.each_cell():
+            for inst in [i for i in cell.each_inst() if i.cell_index in copies]:
+                inst.cell_index = target(inst.cell_index)
+    finally:
+        layout.end_changes()
+    report['cells'] = len(copies)
+    if copies:
+        layout.delete_cells(list(copies))
+    return report
+
+
+def log_report(report, log=print, top=10):
+    log('Identical cells: %s copies removed (%s shapes), of %s cell names%s' % (
+        report['cells'], report['shapes'], len(report['names']),
+        '; %s with the same key were kept, as LayoutDiff found a difference' % report['mismatches'] if report['mismatches'] else ''))
+    for name, n in sorted(report['names'].items(), key=lambda n: -n[1])[:top]:
+        log('  - %s: %s copies' % (name, n))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    file_in = sys.argv[1]
+    file_out = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(file_in)[0] + '_dedup' + os.path.splitext(file_in)[1]
+    layout = pya.Layout()
+    layout.read(file_in)
+    cells = sum(1 for c in layout.each_cell())
+    start_time = time.time()
+    report = dedup_cells(layout)
+    runtime = time.time() - start_time
+    log_report(report)
+    layout.write(file_out)
+    print('%s cells -> %s, in %.1f seconds; %s: %.1f MB -> %s: %.1f MB' % (
+        cells, sum(1 for c in layout.each_cell()), runtime, file_in, os.path.getsize(file_in) / 2**20, file_out, os.path.getsize(file_out) / 2**20))
@@ -0,0 +1,114 @@
+'''
+GDSII stream writer for the merge, used by EBeam_merge.py --streaming
+
+A GDSII file is a header, a list of structures (cells) in any order, and
+an ENDLIB record. KLayout writes each small layout (one submission) to
+bytes, and the structures are appended to the output file, so only one
+submission needs to be in memory at a time. Cells that are only referenced
+(e.g., the submissions, from the course cells) are written as ghost cells.
+'''
+
+import os
+import pya
+
+# GDSII record types
+BGNSTR = 0x05
+ENDLIB = b'\x00\x04\x04\x00'
+
+
+def gds_structures(file):
+    '''
+    Returns the (start, end) offsets of the structure records in a GDSII file
+    written by KLayout, i.e., everything between the library header and the
+    ENDLIB record
+    '''
+    start = 0
+    file.seek(0)
+    while True:
+        record = file.read(4)
+        length = int.from_bytes(record[0:2], 'big')
+        if len(record) < 4 or record[2] == BGNSTR or length == 0:
+            break
+        start += length
+        file.seek(start)
+    # ENDLIB is the last record; anything after it is padding
+    size = file.seek(0, os.SEEK_END)
+    file.seek(max(start, size - 4096))
+    tail = file.read()
+    end = size - len(tail) + tail.rfind(ENDLIB)
+    return start, end
+
+
+class GDSStreamWriter:
+    '''
+    Writes a GDSII file one layout at a time.
+
+    Cell names need to be unique in the output; cells that clash with a name
+    already written are renamed, using the same "name$N" scheme as copy_tree.
+    '''
+
+    def __init__(self, filename, dbu, reserved_names=()):
+        self.filename = filename
+        self.names = set(reserved_names)
+        self.options = pya.SaveLayoutOptions()
+        self.options.format = 'GDS2'
+        self.options.gds2_write_timestamps = False
+        self.options.write_context_info = False  # one $$$CONTEXT_INFO$$$ cell per layout would clash
+        layout = pya.Layout()
+        layout.dbu = dbu
+        data = layout.write_bytes(self.options)
+        self.file = open(filename, 'wb')
+        self.file.write(data[:data.rfind(ENDLIB)])
+        self.bytes_written = 0
+
+    def unique_name(self, name):
+        if name not in self.names:
+            return name
+        n = 1
+        while '%s$%s' % (name, n) in self.names:
+            n += 1
+        return '%s$%s' % (name, n)
+
+    def write(self, layout, cell=None, rename=True):
+        '''
+        Append the (non-ghost) cells of the layout to the file,
+        or only the given cell and its hierarchy.
+        With rename, cells are renamed in the layout if needed, so the caller
+        can find the name that was written.
+        '''
+        options = self.options.dup()
+        if cell:
+            options.select_cell(cell.cell_index())
+            cells = [cell] + [layout.cell(c) for c in cell.called_cells()]
+        else:
+            cells = list(layout.each_cell())
+        for c in cells:
+            if c.ghost_cell:
+                continue
+            if rename:
+                c.name = self.unique_name(c.name)
+            self.names.add(c.name)
+        # written to a temporary file, rather than bytes, to keep the memory down for large layouts
+        # (KLayout replaces the file when writing, so it is opened afterwards)
+        file_tmp = self.filename + '.tmp'
+        layout.write(file_tmp, options)
+        try:
+            with open(file_tmp, 'rb') as file:
+                start, end = gds_structures(file)
+                file.seek(start)
+                self.copy(file, end - start)
+        finally:
+            os.remove(file_tmp)
+
+    def copy(self, file, length):
+        while length > 0:
+            data = file.read(min(length, 1 << 20))
+            if not data:
+                break
+            self.file.write(data)
+            self.bytes_written += len(data)
+            length -= len(data)
+
+    def close(self):
+        self.file.write(ENDLIB)
+        self.file.close()
@@ -0,0 +1,212 @@
+'''
+Index of the text labels in a layout (e.g., the opt_in labels in EBeam.oas)
+
+One pass over the text layer, through the hierarchy, gives for each label:
+the text, its position in the top cell, the cell containing it, and that
+cell's bounding box in the top cell (microns). Lookups by text are a dict,
+and "labels inside this region" queries use an R-tree.
+
+The merge saves the index next to the layout (EBeam_labels.json), and the
+measurement viewer loads it, so the layout is only scanned once.
+'''
+
+import os
+import json
+import math
+
+layer_text = '10/0'
+
+# the indexes of the loaded layouts: {layout: {layer: LabelIndex}}, see layout_label_index;
+# here rather than in measurements/viewer.py, which also runs as __main__ and would have two of them
+_layout_indexes = {}
+
+
+class RTree:
+    '''
+    R-tree of boxes [left, bottom, right, top], bulk loaded (Sort-Tile-Recursive)
+    '''
+
+    def __init__(self, boxes, capacity=16):
+        self.capacity = capacity
+        # node: (bbox, children, item); leaves have an item and no children
+        nodes = [(list(box), None, i) for i, box in enumerate(boxes)]
+        while len(nodes) > capacity:
+            nodes = self.pack(nodes)
+        self.root = (self.union([n[0] for n in nodes]), nodes, None) if nodes else None
+
+    @staticmethod
+    def union(boxes):
+        return [min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes)]
+
+    def pack(self, nodes):
+        '''
+        Group the nodes into parents of up to capacity nodes, in vertical slices
+        '''
+        groups = math.ceil(len(nodes) / self.capacity)
+        slice_size = self.capacity * math.ceil(math.sqrt(groups))
+        nodes = sorted(nodes, key=lambda n: n[0][0] + n[0][2])
+        parents = []
+        for s in range(0, len(nodes), slice_size):
+            column = sorted(nodes[s:s + slice_size], key=lambda n: n[0][1] + n[0][3])
+            for g in range(0, len(column), self.capacity):
+                children = column[g:g + self.capacity]
+                parents.append((self.union([c[0] for c in children]), children, None))
+        return parents
+
+    def query(self, box):
+        '''
+        Items whose box overlaps the box
+        '''
+        items = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node_box, children, item = stack.pop()
+            if node_box[0] > box[2] or node_box[2] < box[0] or node_box[1] > box[3] or node_box[3] < box[1]:
+                continue
+            if children is None:
+                items.append(item)
+            else:
+                stack.extend(children)
+        return sorted(items)
+
+
+class LabelIndex:
+    '''
+    labels: list of {'text', 'x', 'y', 'cell', 'bbox'}, in the order of the layout
+    '''
+
+    def __init__(self, labels, layout_signature=None):
+        self.labels = labels
+        self.layout_signature = layout_signature
+        self.by_text = {}
+        for i, label in enumerate(labels):
+            self.by_text.setdefault(label['text'], []).append(i)
+        self.rtree = RTree([[l['x'], l['y'], l['x'], l['y']] for l in labels])
+
+    @staticmethod
+    def build(layout, layer=layer_text):
+        '''
+        Scan the texts on the layer, in the top cell of the layout
+        '''
+        layer_index = layout.find_layer(int(layer.split('/')[0]), int(layer.split('/')[1]))
+        labels = []
+        if layer_index is None:
+            return LabelIndex(labels)
+        dbu = layout.dbu
+        bboxes = {}  # cell bbox in its own coordinates
+        iter = layout.top_cell().begin_shapes_rec(layer_index)
+        while not iter.at_end():
+            shape = iter.shape()
+            if shape.is_text():
+                trans = iter.trans()
+                text = shape.text.transformed(trans)
+                cell = iter.cell()
+                if cell.cell_index() not in bboxes:
+                    bboxes[cell.cell_index()] = cell.bbox()
+                bbox = bboxes[cell.cell_index()].transformed(trans)
+                labels.append({'text': text.string, 'x': text.x * dbu, 'y': text.y * dbu, 'cell': cell.name,
+                               'bbox': [bbox.left * dbu, bbox.bottom * dbu, bbox.right * dbu, bbox.top * dbu]})
+            iter.next()
+        return LabelIndex(labels)
+
+    def find(self, text):
+        '''
+        First label with this text, or None
+        '''
+        i = self.by_text.get(text)
+        return self.labels[i[0]] if i else None
+
+    def find_all(self, text):
+        return [self.labels[i] for i in self.by_text.get(text, [])]
+
+    def query(self, box):
+        '''
+        Labels positioned inside the box [left, bottom, right, top], in microns
+        '''
+        return [self.labels[i] for i in self.rtree.query(box)]
+
+    def duplicates(self, prefix='opt_in'):
+        return sorted(t for t, i in self.by_text.items() if len(i) > 1 and t.startswith(prefix))
+
+    def measurement_labels(self):
+        '''
+        The labels parsed like SiEPIC's find_automated_measurement_labels (without 'Text'):
+        opt_in_<polarization>_<wavelength>_<type>_<deviceID>_<params>, then elec_<deviceID>_<params>
+        '''
+        opt_in = []
+        for label in self.labels:
+            if label['text'].find("opt") > -1:
+                textlabel = label['text'] if 'opt_in' in label['text'] else label['text'].replace('opt_', 'opt_in_')
+                fields = textlabel.split("_")
+                while len(fields) < 7:
+                    fields.append('comment')
+                opt_in.append({'opt_in': textlabel, 'x': int(label['x']), 'y': int(label['y']), 'pol': fields[2],
+                               'wavelength': fields[3], 'type': fields[4], 'deviceID': fields[5], 'params': fields[6:]})
+        for label in self.labels:
+            if label['text'].find("elec") > -1:
+                fields = label['text'].split("_")
+                while len(fields) < 4:
+                    fields.append('comment')
+                opt_in.append({'elec': label['text'], 'x': int(label['x']), 'y': int(label['y']),
+                               'deviceID': fields[1], 'params': fields[2:]})
+        return opt_in
+
+    def save(self, filename):
+        # json.dumps, since json.dump does not use the C encoder
+        with open(filename, 'w') as file:
+            file.write(json.dumps({'layout': self.layout_signature, 'labels': self.labels}, separators=(',', ':')))
+
+    @staticmethod
+    def load(filename, layout_path=None):
+        '''
+        Load a saved index; None if it does not exist, or was made for another version of the layout
+        '''
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'r') as file:
+            data = json.load(file)
+        if layout_path and data.get('layout') != layout_signature(layout_path):
+            return None
+        return LabelIndex(data['labels'], data.get('layout'))
+
+
+def layout_signature(layout_path):
+    s = os.stat(layout_path)
+    return [s.st_size, s.st_mtime]
+
+
+def index_file(layout_path):
+    '''
+    The index is saved next to the layout, e.g., EBeam_labels.json
+    '''
+    return os.path.splitext(layout_path)[0] + '_labels.json'
+
+
+def load_label_index(layout_path, layout=None):
+    '''
+    The saved index for a layout file, or build it (from the layout, if loaded) and save it.
+    If the layout is given, the index is kept for it (see layout_label_index)
+    '''
+    index = LabelIndex.load(index_file(layout_path), layout_path)
+    if index is None:
+        if layout is None:
+            import klayout.db as pya
+            layout = pya.Layout()
+            layout.read(layout_path)
+        index = LabelIndex.build(layout)
+        index.layout_signature = layout_signature(layout_path)
+        index.save(index_file(layout_path))
+    if layout is not None:
+        _layout_indexes.setdefault(layout, {})[layer_text] = index
+    return index
+
+
+def layout_label_index(layout, layer=layer_text):
+    '''
+    The index of the labels on a layer of a loaded layout: the one loaded by
+    load_label_index, or built on first use; kept for the layout
+    '''
+    indexes = _layout_indexes.setdefault(layout, {})
+    if layer not in indexes:
+        indexes[layer] = LabelIndex.build(layout, layer)
+    return indexes[layer]
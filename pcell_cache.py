@@ -0,0 +1,94 @@
+'''
+Cache of PCell geometry, for the layout generator scripts
+
+ly.create_cell(name, library, parameters) computes the PCell each time a
+script runs, e.g., a spiral_paperclip, or each contra_directional_coupler
+in a parameter sweep. create_cell here keeps the geometry: the first time,
+the PCell is computed and saved as a static OASIS file, in
+pcell_cache/<hash>.oas; the next times (in any script, or run), the cell is
+read from the file.
+
+The hash is of the cell name, library, parameters, database unit, and the
+SiEPIC-Tools, PDK and KLayout versions, so a new PDK recomputes the cells.
+The cells from the cache are static (not PCells), also the first time, so
+every run gives the same cells; the pins and the device recognition layers
+are part of the geometry, so connect_cell and connect_pins_with_waveguide
+work the same. Scripts that export the PCells (e.g., export_type = 'PCell')
+should use layout.create_cell instead.
+
+Usage, in a script:
+  from pcell_cache import create_cell
+  cell = create_cell(ly, 'spiral_paperclip', 'EBeam_Beta', {'length': 200, ...})
+'''
+
+import os
+import json
+import hashlib
+import pya
+
+cache_folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'pcell_cache')
+
+_versions = None
+_cells = {}  # cells already created in a layout: {(id(layout), hash): cell index}
+
+
+def tool_versions():
+    global _versions
+    if _versions is None:
+        import SiEPIC
+        from SiEPIC._globals import KLAYOUT_VERSION, KLAYOUT_VERSION_3
+        try:
+            from importlib.metadata import version
+            pdk_version = version('siepic_ebeam_pdk')
+        except Exception:
+            pdk_version = ''
+        _versions = [SiEPIC.__version__, pdk_version, '0.%s.%s' % (KLAYOUT_VERSION, KLAYOUT_VERSION_3)]
+    return _versions
+
+
+def cell_hash(layout, name, library, parameters):
+    key = [name, library, sorted((k, repr(v)) for k, v in (parameters or {}).items()), layout.dbu, tool_versions()]
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()[:24]
+
+
+def create_cell(layout, name, library, parameters={}, verbose=False):
+    '''
+    Same as layout.create_cell(name, library, parameters), with the geometry cached in pcell_cache.
+    Returns the cell, or None if the library does not have it.
+    '''
+    h = cell_hash(layout, name, library, parameters)
+    if (id(layout), h) in _cells and layout.is_valid_cell_index(_cells[(id(layout), h)]):
+        return layout.cell(_cells[(id(layout), h)])
+    file = os.path.join(cache_folder, h + '.oas')
+
+    if not os.path.exists(file):
+        existing = layout.cells()
+        cell = layout.create_cell(name, library, parameters)
+        if cell is None:
+            return None
+        # static copy, without the PCell context, so that reading it does not recompute the PCell
+        fragment = pya.Layout()
+        fragment.dbu = layout.dbu
+        fragment.create_cell(cell.name).copy_tree(cell)
+        os.makedirs(cache_folder, exist_ok=True)
+        options = pya.SaveLayoutOptions()
+        options.format = 'OASIS'
+        options.write_context_info = False
+        fragment.write(file + '.tmp', options)
+        os.replace(file + '.tmp', file)
+        # the PCell is replaced by the cell read from the file, as in the next runs
+        # (unless the layout already had this PCell variant)
+        if layout.cells() > existing:
+            layout.prune_cell(cell.cell_index(), -1)
+        if verbose:
+            print('PCell cache: %s saved to %s' % (name, file))
+
+    fragment = pya.Layout()
+    fragment.read(file)
+    fragment.dbu = layout.dbu
+    cell = layout.create_cell(fragment.top_cell().name)
+    cell.copy_tree(fragment.top_cell())
+    if verbose:
+        print('PCell cache: %s from %s' % (name, file))
+    _cells[(id(layout), h)] = cell.cell_index()
+    return cell
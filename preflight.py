@@ -0,0 +1,162 @@
+'''
+Pre-flight check of submissions, before the full verification
+
+Catches the common problems that are cheap to detect:
+ - the layout does not have exactly 1 top cell
+ - the top cell is larger than cell_Width X cell_Height
+ - the database unit is not dbu (the merge has to rescale the layout)
+ - there are no opt_in labels on the text layer
+ - shapes on layers that the merge does not keep (these are discarded)
+
+The file is only loaded into a layout (without the technology, PCells,
+or layout_check). It is read in full, since the bounding box and the
+layers that are removed need all the shapes: over the 226 submissions,
+0.7 s in total, 2.6 ms for the median file and 23 ms for the largest.
+
+Files with errors can be rejected before running layout_check;
+warnings are reported only.
+
+Usage:
+  python preflight.py submissions/EBeam_username.gds
+  python preflight.py --json preflight.json submissions
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import pya
+
+# same as run_verification.py and merge/EBeam_merge.py
+cell_Width = 605000
+cell_Height = 410000
+dbu = 0.001
+layers_keep = ['1/0','1/10', '68/0', '81/0', '10/0', '99/0', '26/0', '31/0', '32/0', '33/0', '998/0']
+layer_text = '10/0'
+layer_SEM = '200/0'  # kept for some courses only
+layers_ignore = ['1/99']  # Waveguide layer, from the PDK; removed in the merge, as expected
+
+# which checks reject the file; the others are warnings
+checks_errors = ['read', 'top_cells', 'bbox']
+version = 2  # of the checks; cached verification results of other versions are checked again
+
+
+def summary_layout(layout):
+    '''
+    (dbu, top cell names, bbox of the top cell in dbu, layers, texts on layer_text)
+    '''
+    top_cells = [c.name for c in layout.top_cells()]
+    bbox = None
+    layers = set()
+    texts = []
+    if len(top_cells) == 1:
+        top_cell = layout.top_cell()
+        b = top_cell.bbox()
+        if not b.empty():
+            bbox = [b.left, b.bottom, b.right, b.top]
+        for li in layout.layer_indexes():
+            info = layout.get_info(li)
+            if top_cell.bbox_per_layer(li).empty():
+                continue
+            layers.add('%s/%s' % (info.layer, info.datatype))
+            if '%s/%s' % (info.layer, info.datatype) == layer_text:
+                it = top_cell.begin_shapes_rec(li)
+                it.shape_flags = pya.Shapes.STexts
+                while not it.at_end():
+                    texts.append(it.shape().text.string)
+                    it.next()
+    return layout.dbu, top_cells, bbox, layers, texts
+
+
+def check_file(filename, layout=None):
+    '''
+    Pre-flight check of one file; the layout is loaded, unless it is given.
+
+    Returns a dict with:
+       'file': the file
+       'dbu', 'top_cells', 'bbox' (width and height in microns), 'opt_in' (number of unique labels),
+       'layers_removed': layers that the merge does not keep
+       'errors': list of (check, message) that reject the file
+       'warnings': list of (check, message)
+       'runtime': in seconds
+    '''
+    start_time = time.time()
+    report = {'file': filename, 'dbu': None, 'top_cells': [], 'bbox': None, 'opt_in': 0,
+              'layers_removed': [], 'errors': [], 'warnings': [], 'runtime': 0}
+
+    def fail(check, message):
+        (report['errors'] if check in checks_errors else report['warnings']).append((check, message))
+
+    try:
+        if layout is None:
+            layout = pya.Layout()
+            layout.read(filename)
+        file_dbu, top_cells, bbox, layers, texts = summary_layout(layout)
+    except Exception as e:
+        fail('read', 'Error loading layout: %s' % e)
+        report['runtime'] = time.time() - start_time
+        return report
+
+    report['dbu'] = file_dbu
+    report['top_cells'] = top_cells
+    if len(top_cells) != 1:
+        fail('top_cells', 'layout does not have 1 top cell. It has %s.' % len(top_cells))
+
+    # rounded as in the merge, so that e.g. 0.0010000000000000002 is accepted
+    if round(file_dbu, 10) != dbu:
+        fail('dbu', 'database unit is %s, rather than %s microns' % (file_dbu, dbu))
+
+    if bbox:
+        # in microns, since the dbu may not be the expected one
+        width, height = (bbox[2] - bbox[0]) * file_dbu, (bbox[3] - bbox[1]) * file_dbu
+        report['bbox'] = [round(width, 3), round(height, 3)]
+        if width > cell_Width * dbu + 1e-9 or height > cell_Height * dbu + 1e-9:
+            fail('bbox', 'Cell bounding box / extent (%s, %s) is larger than the maximum size of %s X %s microns' % (
+                report['bbox'][0], report['bbox'][1], cell_Width * dbu, cell_Height * dbu))
+
+    report['opt_in'] = len(set(t for t in texts if t.startswith('opt_in')))
+    if report['opt_in'] == 0:
+        fail('opt_in', 'no opt_in labels on layer %s' % layer_text)
+
+    report['layers_removed'] = sorted(layers - set(layers_keep + [layer_SEM] + layers_ignore))
+    if report['layers_removed']:
+        fail('layers', 'shapes on layers %s will be removed in the merge' % ', '.join(report['layers_removed']))
+
+    report['runtime'] = time.time() - start_time
+    return report
+
+
+def print_report(report):
+    print('%s: %s errors, %s warnings, %.2f seconds' % (report['file'], len(report['errors']), len(report['warnings']), report['runtime']))
+    for check, message in report['errors']:
+        print(' - Error (%s): %s' % (check, message))
+    for check, message in report['warnings']:
+        print(' - Warning (%s): %s' % (check, message))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pre-flight check of layout files')
+    parser.add_argument('files', nargs='+', help='.gds/.oas files, or folders containing them')
+    parser.add_argument('--json', default=None, help='output file for the reports, in JSON')
+    args = parser.parse_args()
+
+    files = []
+    for p in args.files:
+        if os.path.isdir(p):
+            files += [os.path.join(p, f) for f in sorted(os.listdir(p)) if f.lower().endswith(('.gds', '.oas'))]
+        else:
+            files.append(p)
+
+    reports = []
+    for f in files:
+        reports.append(check_file(f))
+        print_report(reports[-1])
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=1)
+
+    rejected = [r['file'] for r in reports if r['errors']]
+    print('Rejected: %s of %s files' % (len(rejected), len(reports)))
+    sys.exit(1 if rejected else 0)
@@ -0,0 +1,146 @@
+'''
+Run the layout generator scripts in "submissions/KLayout Python", in parallel
+
+Each script is run in its own Python interpreter (the scripts create their
+layout at the top level, and export it to submissions/<script name>.oas or
+.gds), with a time limit and a memory limit, several at a time.
+
+The report (python_submissions_report.json) lists, for each script:
+the exit status, the output layout and .lyrdb files it produced, the
+runtime and the peak memory (RSS); the output of each script is saved in
+python_submissions_logs/<script name>.txt.
+
+Usage:
+  python run_python_submissions.py                 (all the scripts)
+  python run_python_submissions.py --jobs 4 "submissions/KLayout Python/EBeam_LukasChrostowski_MZI.py"
+
+Linux and macOS only (resource limits and os.wait4).
+'''
+
+import os
+import sys
+import json
+import time
+import signal
+import subprocess
+import resource
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+path = os.path.dirname(os.path.realpath(__file__))
+scripts_folder = os.path.join(path, 'submissions', 'KLayout Python')
+submissions_folder = os.path.join(path, 'submissions')
+report_file = 'python_submissions_report.json'
+logs_folder = 'python_submissions_logs'
+timeout = 600  # seconds per script
+memory_limit = 4096  # MB of address space per script
+jobs = None  # scripts run at the same time; None: all CPU cores
+memory_errors = ['MemoryError', 'std::bad_alloc', 'cannot allocate memory']  # in the output, when the memory limit is reached
+
+
+def script_outputs(script, start_time):
+    '''
+    Layout and .lyrdb files written by a script since start_time:
+    the layout is submissions/<script name>.oas or .gds, the .lyrdb is next to the script or the layout
+    '''
+    name = os.path.splitext(os.path.basename(script))[0]
+    outputs = {'layout': [], 'lyrdb': []}
+    candidates = [(os.path.join(submissions_folder, name + ext), 'layout') for ext in ('.oas', '.gds')] + \
+        [(os.path.join(folder, name + '.lyrdb'), 'lyrdb') for folder in (os.path.dirname(os.path.abspath(script)), submissions_folder)]
+    for file, kind in candidates:
+        if os.path.exists(file) and os.path.getmtime(file) >= start_time - 1:
+            outputs[kind].append(os.path.relpath(file, path))
+    return outputs
+
+
+def run_script(script, timeout=timeout, memory_limit=memory_limit, log_folder=logs_folder):
+    '''
+    Run one script, in its own process (and process group), with the limits.
+    Returns the report for the script.
+    '''
+    name = os.path.splitext(os.path.basename(script))[0]
+    os.makedirs(log_folder, exist_ok=True)
+    log_file = os.path.join(log_folder, name + '.txt')
+
+    def limits():
+        if memory_limit:
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit * 2**20, memory_limit * 2**20))
+
+    start_time = time.time()
+    timed_out = threading.Event()
+    with open(log_file, 'w') as log:
+        # headless: no KLayout application to show the layout in, no display
+        env = dict(os.environ, QT_QPA_PLATFORM='offscreen')
+        process = subprocess.Popen([sys.executable, os.path.abspath(script)], cwd=path,
+                                   stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+                                   preexec_fn=limits, start_new_session=True, env=env)
+
+        def kill():
+            timed_out.set()
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        # wait4 gives the resource usage of the process, including its peak memory
+        _, status, usage = os.wait4(process.pid, 0)
+        timer.cancel()
+        process.returncode = os.waitstatus_to_exitcode(status)
+    runtime = time.time() - start_time
+
+    with open(log_file, 'r', errors='replace') as log:
+        output = log.read()
+    if timed_out.is_set():
+        result = 'timeout'
+    elif process.returncode == 0:
+        result = 'ok'
+    elif any(m in output for m in memory_errors):
+        result = 'memory'
+    else:
+        result = 'failed'
+    # ru_maxrss is in kB on Linux, in bytes on macOS
+    peak_rss = usage.ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+    report = {'script': os.path.relpath(os.path.abspath(script), path), 'result': result, 'returncode': process.returncode,
+              'runtime': round(runtime, 2), 'peak_rss_MB': round(peak_rss, 1), 'log': log_file}
+    report.update(script_outputs(script, start_time))
+    if result == 'ok' and not report['layout']:
+        report['result'] = 'no output'
+    return report
+
+
+def run_scripts(scripts, jobs=jobs, timeout=timeout, memory_limit=memory_limit, log_folder=logs_folder):
+    '''
+    Run the scripts, up to jobs at a time; returns the reports, in the order of the scripts
+    '''
+    jobs = jobs or os.cpu_count()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(run_script, s, timeout, memory_limit, log_folder) for s in scripts]
+        reports = []
+        for f in futures:
+            reports.append(f.result())
+            r = reports[-1]
+            print('%s: %s, %.1f seconds, %.0f MB, %s' % (r['script'], r['result'], r['runtime'], r['peak_rss_MB'], ', '.join(r['layout'] + r['lyrdb'])))
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the KLayout Python submissions, in parallel')
+    parser.add_argument('scripts', nargs='*', help='scripts to run; default: all the .py files in "submissions/KLayout Python"')
+    parser.add_argument('-j', '--jobs', type=int, default=jobs, help='number of scripts run at the same time (default: all CPU cores)')
+    parser.add_argument('--timeout', type=float, default=timeout, help='time limit per script, in seconds')
+    parser.add_argument('--memory', type=int, default=memory_limit, help='memory limit per script, in MB (0: no limit)')
+    parser.add_argument('--report', default=report_file, help='output file for the report, in JSON')
+    args = parser.parse_args()
+
+    scripts = args.scripts or [os.path.join(scripts_folder, f) for f in sorted(os.listdir(scripts_folder)) if f.endswith('.py')]
+    start_time = time.time()
+    reports = run_scripts(scripts, args.jobs, args.timeout, args.memory)
+    with open(args.report, 'w') as f:
+        json.dump(reports, f, indent=1)
+
+    failed = [r['script'] for r in reports if r['result'] != 'ok']
+    print('Ran %s scripts in %.1f seconds; %s failed: %s' % (len(reports), time.time() - start_time, len(failed), ', '.join(failed)))
+    sys.exit(1 if failed else 0)
@@ -1,3 +1,4 @@
+
 import pya
 from pya import *
 import SiEPIC
@@ -5,65 +6,301 @@ from SiEPIC.verification import layout_check
 from SiEPIC.scripts import zoom_out
 from SiEPIC.utils import get_technology_by_name
 import siepic_ebeam_pdk
+import preflight
+import fingerprint
 import os
 import sys
+import time
+import json
+import shutil
+import hashlib
+import argparse
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 """
 Script to load .gds file passed in through commmand line and run verification using layout_check().
 Ouput lyrdb file is saved to path specified by 'file_lyrdb' variable in the script.
 
 Jasmina Brar 12/08/23, and Lukas Chrostowski
 
-"""
+Batch mode: several files, or folders, can be passed in; the technology is
+loaded once per worker process, and the files are verified in parallel.
+A summary (errors, runtime and size check for each file) is written to
+verification_summary.json. The last line printed is the total number of errors.
+
+Results are cached in verification_cache, keyed by the file contents, the
+SiEPIC-Tools, PDK and KLayout versions, the size limits, and the versions of
+the pre-flight checks and fingerprints, so unchanged files are not checked
+again; use --no-cache to force a fresh check.
 
-# gds file to run verification on
-gds_file = sys.argv[1]
+Files with the same geometry and cell names as another file (see
+fingerprint.py) are not checked again either: they get the result of the
+first one, with 'duplicate_of'. Use --no-fingerprint to check every file.
 
-print('Running SiEPIC-Tools automated verification for file %s' % gds_file)
+Each file first goes through the pre-flight check (preflight.py); files that
+fail it (e.g., wrong number of top cells, too large) are rejected without
+running layout_check. Use --no-preflight to always run layout_check.
 
-try:
-   # load into layout
-   layout = pya.Layout()
-   layout.read(gds_file)
-except:
-   print('Error loading layout')
-   num_errors = 1
+  python run_verification.py submissions/EBeam_username.gds
+  python run_verification.py --jobs 4 submissions
+  python run_verification.py --no-cache submissions
+
+"""
 
-try:
-   # get top cell from layout
-   if len(layout.top_cells()) != 1:
-      print('Error: layout does not have 1 top cell. It has %s.' % len(layout.top_cells()))
-      num_errors += 1
+# Make sure layout extent fits within the allocated area.
+cell_Width = 605000
+cell_Height = 410000
 
-   top_cell = layout.top_cell()
+summary_file = 'verification_summary.json'
+cache_folder = 'verification_cache'
 
-   # set layout technology because the technology seems to be empty, and we cannot load the technology using TECHNOLOGY = get_technology() because this isn't GUI mode
-   # refer to line 103 in layout_check()
-   # tech = layout.technology()
-   # print("Tech:", tech.name)
-   layout.TECHNOLOGY = get_technology_by_name('EBeam')
+TECHNOLOGY = None
 
-   # run verification
-   zoom_out(top_cell)
+def load_technology():
+   '''
+   Load the technology, once per process
+   '''
+   global TECHNOLOGY
+   if TECHNOLOGY is None:
+      TECHNOLOGY = get_technology_by_name('EBeam')
+   return TECHNOLOGY
 
-   # get file path, filename, path for output lyrdb file
+def lyrdb_path(gds_file):
+   '''
+   Output lyrdb file for a layout file
+   '''
    path = os.path.dirname(os.path.realpath(__file__))
-   filename = gds_file.split(".")[0]
-   file_lyrdb = os.path.join(path,filename+'.lyrdb')
-
-   # run verification
-   num_errors = layout_check(cell = top_cell, verbose=False, GUI=True, file_rdb=file_lyrdb)
-
-   # Make sure layout extent fits within the allocated area.
-   cell_Width = 605000
-   cell_Height = 410000
-   bbox = top_cell.bbox()
-   if bbox.width() > cell_Width or bbox.height() > cell_Height:
-      print('Error: Cell bounding box / extent (%s, %s) is larger than the maximum size of %s X %s microns' % (bbox.width()/1000, bbox.height()/1000, cell_Width/1000, cell_Height/1000) )
-      num_errors += 1
-except:
-   print('Unknown error occurred')
-   num_errors = 1
-
-# Print the result value to standard output
-print(num_errors)
+   filename = os.path.splitext(gds_file)[0]
+   return os.path.join(path,filename+'.lyrdb')
+
+def tool_versions():
+   try:
+      from importlib.metadata import version
+      pdk_version = version('siepic_ebeam_pdk')
+   except Exception:
+      # e.g., PDK loaded from a folder
+      pdk_version = getattr(siepic_ebeam_pdk, '__version__', os.path.dirname(siepic_ebeam_pdk.__file__))
+   from SiEPIC._globals import KLAYOUT_VERSION, KLAYOUT_VERSION_3
+   return {'SiEPIC': SiEPIC.__version__, 'siepic_ebeam_pdk': pdk_version, 'klayout': '0.%s.%s' % (KLAYOUT_VERSION, KLAYOUT_VERSION_3)}
+
+def cache_key(gds_file, run_preflight=True):
+   '''
+   Cache key for the verification of a file: a hash of its contents,
+   the tool versions, the size limits, whether the pre-flight check is used,
+   and the versions of the pre-flight checks and of the fingerprints
+   '''
+   h = hashlib.sha256()
+   with open(gds_file, 'rb') as f:
+      for chunk in iter(lambda: f.read(1 << 20), b''):
+         h.update(chunk)
+   h.update(json.dumps([tool_versions(), cell_Width, cell_Height, run_preflight, preflight.version, fingerprint.version], sort_keys=True).encode('utf-8'))
+   return h.hexdigest()
+
+def verify_file_cached(gds_file, cache_path=None, run_preflight=True):
+   '''
+   verify_file, using the cached result (and lyrdb) if the file was already checked.
+   The result has 'cached': True if it came from the cache.
+   '''
+   if not cache_path:
+      result = verify_file(gds_file, run_preflight)
+      result['cached'] = False
+      return result
+
+   try:
+      key = cache_key(gds_file, run_preflight)
+   except OSError:
+      result = verify_file(gds_file, run_preflight)
+      result['cached'] = False
+      return result
+   file_json = os.path.join(cache_path, key + '.json')
+   file_lyrdb = os.path.join(cache_path, key + '.lyrdb')
+   if os.path.exists(file_json):
+      try:
+         with open(file_json, 'r') as f:
+            result = json.load(f)
+         if os.path.exists(file_lyrdb):
+            shutil.copyfile(file_lyrdb, lyrdb_path(gds_file))
+         elif os.path.exists(lyrdb_path(gds_file)):
+            os.remove(lyrdb_path(gds_file))  # from an earlier run; this result has no lyrdb
+         print('Verification result for file %s loaded from the cache: %s errors' % (gds_file, result['errors']))
+         result.update({'file': gds_file, 'runtime': 0, 'cached': True})
+         return result
+      except (OSError, ValueError, KeyError):
+         pass  # incomplete entry; check the file again
+
+   # an lyrdb from an earlier run is removed, so only one written by this check is cached
+   # (there is none if the file is rejected before layout_check)
+   if os.path.exists(lyrdb_path(gds_file)):
+      os.remove(lyrdb_path(gds_file))
+   result = verify_file(gds_file, run_preflight)
+   result['cached'] = False
+
+   # the lyrdb is copied first, and the .json renamed into place last, so a partial entry is never used
+   if os.path.exists(lyrdb_path(gds_file)):
+      shutil.copyfile(lyrdb_path(gds_file), file_lyrdb)
+   elif os.path.exists(file_lyrdb):
+      os.remove(file_lyrdb)
+   with open(file_json + '.tmp%s' % os.getpid(), 'w') as f:
+      json.dump(result, f)
+   os.replace(file_json + '.tmp%s' % os.getpid(), file_json)
+   return result
+
+def verify_file(gds_file, run_preflight=True):
+   '''
+   Run verification on one file.
+   With run_preflight, files that fail the pre-flight check are not verified further.
+
+   Returns a dict with:
+      'file': the file
+      'errors': number of errors
+      'runtime': in seconds
+      'bbox': width and height of the top cell, in microns
+      'bbox_ok': True if the layout fits within cell_Width X cell_Height
+      'preflight': errors and warnings from the pre-flight check
+   '''
+   start_time = time.time()
+   result = {'file': gds_file, 'errors': 0, 'runtime': 0, 'bbox': None, 'bbox_ok': None, 'preflight': None}
+
+   print('Running SiEPIC-Tools automated verification for file %s' % gds_file)
+
+   try:
+      # load into layout
+      layout = pya.Layout()
+      layout.read(gds_file)
+   except:
+      print('Error loading layout')
+      result['errors'] = 1
+      result['runtime'] = time.time() - start_time
+      return result
+
+   if run_preflight:
+      report = preflight.check_file(gds_file, layout)
+      result['preflight'] = {'errors': report['errors'], 'warnings': report['warnings']}
+      for check, message in report['warnings']:
+         print('Pre-flight warning: %s' % message)
+      if report['errors']:
+         for check, message in report['errors']:
+            print('Error: %s' % message)
+         result['errors'] = len(report['errors'])
+         result['bbox'] = report['bbox']
+         if report['bbox']:
+            result['bbox_ok'] = 'bbox' not in [check for check, message in report['errors']]
+         result['runtime'] = time.time() - start_time
+         return result
+
+   try:
+      # get top cell from layout
+      if len(layout.top_cells()) != 1:
+         print('Error: layout does not have 1 top cell. It has %s.' % len(layout.top_cells()))
+         result['errors'] = 1
+         result['runtime'] = time.time() - start_time
+         return result
+
+      top_cell = layout.top_cell()
+
+      # set layout technology because the technology seems to be empty, and we cannot load the technology using TECHNOLOGY = get_technology() because this isn't GUI mode
+      # refer to line 103 in layout_check()
+      # tech = layout.technology()
+      # print("Tech:", tech.name)
+      layout.TECHNOLOGY = load_technology()
+
+      # run verification
+      zoom_out(top_cell)
+
+      # get file path, filename, path for output lyrdb file;
+      # each worker writes its own file, renamed into place when complete
+      file_lyrdb = lyrdb_path(gds_file)
+      file_lyrdb_tmp = file_lyrdb + '.tmp%s' % os.getpid()
+
+      # run verification
+      num_errors = layout_check(cell = top_cell, verbose=False, GUI=True, file_rdb=file_lyrdb_tmp)
+      if os.path.exists(file_lyrdb_tmp):
+         os.replace(file_lyrdb_tmp, file_lyrdb)
+
+      # Make sure layout extent fits within the allocated area.
+      bbox = top_cell.bbox()
+      result['bbox'] = [bbox.width()/1000, bbox.height()/1000]
+      result['bbox_ok'] = not (bbox.width() > cell_Width or bbox.height() > cell_Height)
+      if not result['bbox_ok']:
+         print('Error: Cell bounding box / extent (%s, %s) is larger than the maximum size of %s X %s microns' % (bbox.width()/1000, bbox.height()/1000, cell_Width/1000, cell_Height/1000) )
+         num_errors += 1
+   except:
+      print('Unknown error occurred')
+      num_errors = 1
+
+   result['errors'] = num_errors
+   result['runtime'] = time.time() - start_time
+   return result
+
+def find_files(paths):
+   '''
+   The .gds and .oas files to verify: files, and the files in folders
+   '''
+   files = []
+   for p in paths:
+      if os.path.isdir(p):
+         for f in sorted(os.listdir(p)):
+            if f.lower().endswith(('.gds', '.oas')):
+               files.append(os.path.join(p, f))
+      else:
+         files.append(p)
+   return files
+
+
+if __name__ == "__main__":
+
+   parser = argparse.ArgumentParser(description='Run SiEPIC-Tools verification on layout files')
+   parser.add_argument('files', nargs='+', help='.gds/.oas files, or folders containing them')
+   parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes (default: all CPU cores)')
+   parser.add_argument('--summary', default=summary_file, help='output file for the summary, in JSON')
+   parser.add_argument('--no-preflight', action='store_true', help='run layout_check even if the pre-flight check fails')
+   parser.add_argument('--no-cache', action='store_true', help='check all the files again, without using the cache')
+   parser.add_argument('--no-fingerprint', action='store_true', help='check the files that are duplicates of another file too')
+   args = parser.parse_args()
+
+   files = find_files(args.files)
+
+   cache_path = None
+   if not args.no_cache:
+      cache_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), cache_folder)
+      os.makedirs(cache_path, exist_ok=True)
+   verify = partial(verify_file_cached, cache_path=cache_path, run_preflight=not args.no_preflight)
+
+   if len(files) == 1:
+      # gds file to run verification on
+      results = [verify(files[0])]
+   else:
+      # files with the same geometry and cell names as another file get its result
+      duplicate_of = {}
+      if not args.no_fingerprint:
+         fingerprint_cache = os.path.join(os.path.dirname(os.path.realpath(__file__)), fingerprint.cache_folder) if cache_path else None
+         fingerprints = fingerprint.fingerprint_files(files, args.jobs, fingerprint_cache)
+         for first, others in fingerprint.duplicates(fingerprints, names=True).items():
+            for f in others:
+               duplicate_of[f] = first
+      unique = [f for f in files if f not in duplicate_of]
+
+      print('Running verification on %s files%s' % (len(unique), ' (and %s duplicates)' % len(duplicate_of) if duplicate_of else ''))
+      with ProcessPoolExecutor(max_workers=args.jobs, initializer=load_technology) as executor:
+         results = dict(zip(unique, executor.map(verify, unique)))
+      for f, first in duplicate_of.items():
+         if os.path.exists(lyrdb_path(first)):
+            shutil.copyfile(lyrdb_path(first), lyrdb_path(f))
+         elif os.path.exists(lyrdb_path(f)):
+            os.remove(lyrdb_path(f))
+         results[f] = dict(results[first], file=f, runtime=0, duplicate_of=first)
+      results = [results[f] for f in files]
+      for r in results:
+         if 'duplicate_of' in r:
+            print('%s: duplicate of %s, %s errors' % (r['file'], r['duplicate_of'], r['errors']))
+         else:
+            print('%s: %s errors, %.1f seconds%s' % (r['file'], r['errors'], r['runtime'], ' (cached)' if r['cached'] else ''))
+      if cache_path:
+         checked = [r['file'] for r in results if not r['cached'] and 'duplicate_of' not in r]
+         print('Cache: %s of %s files from the cache; checked: %s' % (len(results) - len(checked), len(results), ', '.join(checked) or 'none'))
+
+   with open(args.summary, 'w') as f:
+      json.dump(results, f, indent=1)
 
+   # Print the result value to standard output
+   print(sum(r['errors'] for r in results))
@@ -54,6 +54,17 @@ if Python_Env == 'Script':
 
 tech_name = 'EBeam'
 
+# PCell cache (pcell_cache.py, in the repository): the PCell geometry is computed once, then read from pcell_cache/
+# The cached cells are static, so the cache is not used when the PCells are exported
+create_cell = lambda ly, name, library, parameters={}: ly.create_cell(name, library, parameters)
+if export_type == 'static':
+    try:
+        import sys
+        sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+        from pcell_cache import create_cell
+    except ImportError:
+        pass
+
 from packaging import version
 if version.parse(SiEPIC.__version__) < version.parse("0.5.4"):
     raise Exception("Errors", "This example requires SiEPIC-Tools version 0.5.4 or greater.")
@@ -131,10 +142,10 @@ connect_pins_with_waveguide(instY1, 'opt2', instY2, 'opt3', waveguide_type=waveg
 connect_pins_with_waveguide(instY1, 'opt3', instY2, 'opt2', waveguide_type=waveguide_type,turtle_B=[125,-90])
 
 # 3rd MZI, with a very long delay line
-cell_ebeam_delay = ly.create_cell('spiral_paperclip', 'EBeam_Beta',
-                                  {'waveguide_type':waveguide_type_delay,
-                                   'length':200,
-                                   'flatten':True})
+cell_ebeam_delay = create_cell(ly, 'spiral_paperclip', 'EBeam_Beta',
+                               {'waveguide_type':waveguide_type_delay,
+                                'length':200,
+                                'flatten':True})
 x,y = 60000, 205000
 t = Trans(Trans.R0,x,y)
 instGC1 = cell.insert(CellInstArray(cell_ebeam_gc.cell_index(), t))
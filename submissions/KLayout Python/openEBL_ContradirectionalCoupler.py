@@ -45,6 +45,14 @@ tech_name = 'EBeam'
 from SiEPIC.extend import to_itype
 from SiEPIC.scripts import connect_pins_with_waveguide, connect_cell
 
+# PCell cache (pcell_cache.py, in the repository): the PCell geometry is computed once, then read from pcell_cache/
+try:
+    import sys
+    sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+    from pcell_cache import create_cell
+except ImportError:
+    create_cell = lambda ly, name, library, parameters={}: ly.create_cell(name, library, parameters)
+
 if SiEPIC.__version__ < '0.5.1':
     pya.MessageBox.warning("Errors", "This example requires SiEPIC-Tools version 0.5.1 or greater.", pya.MessageBox.Ok)
 
@@ -122,7 +130,7 @@ def ebeam_c_te_mux_1ch_standard_1543nm(topcell, x_pos = 0, y_pos = 0, N = params
     shape.text_size = 1.5/ly.dbu
     
     # contraDC PCell
-    pcell = ly.create_cell(params.component_contraDC, params.libname, 
+    pcell = create_cell(ly, params.component_contraDC, params.libname, 
         { "sbend":1, "number_of_periods": N, "grating_period": period, "gap": g, "wg1_width": w1, "wg2_width": w2, "corrugation_width1": dW1, "corrugation_width2": dW2 , "sinusoidal": sine, "index": a} )
     if not pcell:
         raise Exception("Cannot find cell %s in library %s." % (params.component_contraDC, params.libname))
@@ -0,0 +1,100 @@
+'''
+Fixtures for the tests: a local HTTP stand-in for the measurement server
+
+The stand-in serves one file at /download, with HEAD and GET, Range
+requests (bytes=start-end), ETag and If-Range, and an optional
+OC-Checksum header. Requests can be made to fail by dropping the
+connection part way through the body.
+'''
+
+import os
+import sys
+import threading
+import http.server
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'measurements'))
+
+
+class StandIn:
+    '''
+    State of the stand-in server, changed by the tests
+    '''
+
+    def __init__(self):
+        self.data = b''
+        self.etag = '"1"'
+        self.checksum = None  # value of the OC-Checksum header
+        self.ranges = True  # Accept-Ranges, and 206 responses to Range requests
+        self.drop = set()  # start offsets of the ranges whose response is cut off
+        self.log = []  # (method, Range header, If-Range header)
+        self.url = None
+
+    def set_data(self, data, etag):
+        self.data = data
+        self.etag = etag
+
+    def range_requests(self):
+        return [r for m, r, i in self.log if m == 'GET' and r]
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def headers_common(self, length):
+        self.send_header('Content-Length', str(length))
+        self.send_header('ETag', self.server.standin.etag)
+        if self.server.standin.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if self.server.standin.checksum:
+            self.send_header('OC-Checksum', self.server.standin.checksum)
+
+    def do_HEAD(self):
+        standin = self.server.standin
+        standin.log.append(('HEAD', None, None))
+        self.send_response(200)
+        self.headers_common(len(standin.data))
+        self.end_headers()
+
+    def do_GET(self):
+        standin = self.server.standin
+        data = standin.data
+        requested = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        standin.log.append(('GET', requested, if_range))
+        start, end = 0, len(data) - 1
+        # a stale If-Range gets the whole (changed) file, as in RFC 7233
+        partial = standin.ranges and requested and (if_range is None or if_range == standin.etag)
+        if partial:
+            first, last = requested.split('=', 1)[1].split('-')
+            start, end = int(first), min(int(last), len(data) - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, len(data)))
+        else:
+            self.send_response(200)
+        self.headers_common(end - start + 1)
+        self.end_headers()
+        body = data[start:end + 1]
+        if partial and start in standin.drop:
+            # the connection is dropped half way through the body
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def standin():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    server.standin = StandIn()
+    server.standin.url = 'http://127.0.0.1:%s/download' % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.standin
+    server.shutdown()
+    server.server_close()
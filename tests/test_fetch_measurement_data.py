@@ -0,0 +1,119 @@
+'''
+Tests of the download in measurements/fetch_measurement_data.py, against the stand-in server (conftest.py)
+'''
+
+import os
+import json
+import hashlib
+import fetch_measurement_data as fetch
+
+chunk_size = 64 * 2**10
+
+
+def payload(size, seed=0):
+    return bytes((i * 7 + seed) % 251 for i in range(size))
+
+
+def test_parallel_range_download(standin, tmp_path):
+    standin.set_data(payload(20 * chunk_size + 100), '"a"')
+    filename = fetch.download_file(standin.url, str(tmp_path), workers=4, chunk_size=chunk_size)
+    assert filename == os.path.join(str(tmp_path), 'downloaded_data.zip')
+    with open(filename, 'rb') as file:
+        assert file.read() == standin.data
+    # one range request per chunk, each with If-Range
+    ranges = standin.range_requests()
+    assert len(ranges) == 21
+    assert sorted(ranges) == sorted('bytes=%s-%s' % (i * chunk_size, min(len(standin.data), (i + 1) * chunk_size) - 1) for i in range(21))
+    assert all(if_range == '"a"' for method, r, if_range in standin.log if method == 'GET')
+    assert not os.path.exists(filename + '.part')
+
+
+def test_up_to_date(standin, tmp_path):
+    standin.set_data(payload(3 * chunk_size), '"a"')
+    fetch.download_file(standin.url, str(tmp_path), chunk_size=chunk_size)
+    standin.log.clear()
+    assert fetch.download_file(standin.url, str(tmp_path), chunk_size=chunk_size)
+    assert standin.range_requests() == []
+
+
+def test_resume_after_dropped_connection(standin, tmp_path):
+    standin.set_data(payload(10 * chunk_size), '"a"')
+    standin.drop = {3 * chunk_size, 7 * chunk_size}
+    assert fetch.download_file(standin.url, str(tmp_path), workers=4, chunk_size=chunk_size) is None
+    filename = os.path.join(str(tmp_path), 'downloaded_data.zip')
+    with open(filename + '.json', 'r') as file:
+        state = json.load(file)
+    assert sorted(state['done']) == [0, 1, 2, 4, 5, 6, 8, 9]
+    assert os.path.exists(filename + '.part') and not os.path.exists(filename)
+
+    # only the 2 missing chunks are requested again
+    standin.drop = set()
+    standin.log.clear()
+    assert fetch.download_file(standin.url, str(tmp_path), workers=4, chunk_size=chunk_size) == filename
+    assert sorted(standin.range_requests()) == ['bytes=%s-%s' % (i * chunk_size, (i + 1) * chunk_size - 1) for i in (3, 7)]
+    with open(filename, 'rb') as file:
+        assert file.read() == standin.data
+
+
+def test_changed_etag_restarts(standin, tmp_path):
+    standin.set_data(payload(6 * chunk_size), '"a"')
+    standin.drop = {2 * chunk_size}
+    assert fetch.download_file(standin.url, str(tmp_path), chunk_size=chunk_size) is None
+
+    # the file changed on the server: the chunks of the old version are not kept
+    standin.set_data(payload(6 * chunk_size, seed=1), '"b"')
+    standin.drop = set()
+    standin.log.clear()
+    filename = fetch.download_file(standin.url, str(tmp_path), chunk_size=chunk_size)
+    assert len(standin.range_requests()) == 6
+    with open(filename, 'rb') as file:
+        assert file.read() == standin.data
+
+
+def test_changed_during_download(standin, tmp_path):
+    # the file changes after the HEAD request: the server answers the If-Range of the old ETag with
+    # the whole new file (200), which is not written into the partial file
+    standin.set_data(payload(4 * chunk_size), '"a"')
+    info = fetch.remote_info(fetch.http_session(), standin.url)
+    standin.set_data(payload(4 * chunk_size, seed=1), '"b"')
+    part_file = str(tmp_path / 'data.part')
+    state = {'chunk_size': chunk_size, 'done': []}
+    try:
+        fetch.download_ranges(fetch.http_session(), info, part_file, state, lambda: None)
+        assert False, 'the download should fail'
+    except RuntimeError as e:
+        assert 'changed on the server' in str(e)
+    assert state['done'] == []
+
+
+def test_checksum_match(standin, tmp_path):
+    standin.set_data(payload(3 * chunk_size), '"a"')
+    standin.checksum = 'SHA1:%s MD5:%s ADLER32:0badc0de' % (hashlib.sha1(standin.data).hexdigest().upper(), hashlib.md5(standin.data).hexdigest())
+    filename = fetch.download_file(standin.url, str(tmp_path), chunk_size=chunk_size)
+    with open(filename + '.json', 'r') as file:
+        assert json.load(file)['sha256'] == hashlib.sha256(standin.data).hexdigest()
+
+
+def test_checksum_mismatch(standin, tmp_path):
+    standin.set_data(payload(3 * chunk_size), '"a"')
+    standin.checksum = 'SHA1:%s' % hashlib.sha1(b'something else').hexdigest()
+    assert fetch.download_file(standin.url, str(tmp_path), chunk_size=chunk_size) is None
+    # nothing is kept, so the next attempt starts over
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_checksum_unknown_algorithm(standin, tmp_path):
+    standin.set_data(payload(3 * chunk_size), '"a"')
+    standin.checksum = 'ADLER32:0badc0de'
+    filename = fetch.download_file(standin.url, str(tmp_path), chunk_size=chunk_size)
+    with open(filename, 'rb') as file:
+        assert file.read() == standin.data
+
+
+def test_no_range_support(standin, tmp_path):
+    standin.ranges = False
+    standin.set_data(payload(3 * chunk_size), '"a"')
+    filename = fetch.download_file(standin.url, str(tmp_path), chunk_size=chunk_size)
+    assert standin.range_requests() == ['bytes=0-0']  # asked once, by remote_info
+    with open(filename, 'rb') as file:
+        assert file.read() == standin.data
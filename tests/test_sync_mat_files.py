@@ -0,0 +1,127 @@
+'''
+Tests of sync_mat_files in measurements/fetch_measurement_data.py, against the stand-in server (conftest.py)
+'''
+
+import io
+import os
+import json
+import zlib
+import random
+import zipfile
+import fetch_measurement_data as fetch
+
+
+def mat_data(size, seed):
+    r = random.Random(seed)
+    return bytes(r.randrange(16) for _ in range(size))
+
+
+def make_zip(members):
+    '''
+    zip with the members {name: data}; the .mat files are deflated, the others stored
+    '''
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zip_ref:
+        for name, data in members.items():
+            compression = zipfile.ZIP_DEFLATED if name.endswith('.mat') else zipfile.ZIP_STORED
+            zip_ref.writestr(zipfile.ZipInfo(name, (2024, 10, 1, 12, 0, 0)), data, compress_type=compression)
+    return buffer.getvalue()
+
+
+members = {
+    'data/die1/device_a.mat': mat_data(40000, 1),
+    'data/die1/device_b.mat': mat_data(30000, 2),
+    'data/die2/device_c.MAT': mat_data(50000, 3),
+    'data/report.pdf': mat_data(400000, 4),
+    'data/measurements.csv': b'x' * 200000,
+}
+
+
+def sync(standin, tmp_path):
+    return fetch.sync_mat_files(standin.url, str(tmp_path / 'mat_files'), workers=2, download_dir=str(tmp_path / 'downloaded'))
+
+
+def read_manifest(tmp_path):
+    with open(str(tmp_path / fetch.manifest_file), 'r') as file:
+        return json.load(file)
+
+
+def test_first_sync(standin, tmp_path):
+    standin.set_data(make_zip(members), '"a"')
+    result = sync(standin, tmp_path)
+    mat_files = [name for name in members if name.lower().endswith('.mat')]
+    assert sorted(result['fetched']) == sorted(str(tmp_path / 'mat_files' / name) for name in mat_files)
+    assert result['up_to_date'] == 0
+    for name in mat_files:
+        with open(str(tmp_path / 'mat_files' / name), 'rb') as file:
+            assert file.read() == members[name]
+    assert not (tmp_path / 'mat_files' / 'data' / 'report.pdf').exists()
+    # the PDF and CSV members are not downloaded, nor the whole zip
+    assert result['bytes'] < 300000
+    assert not (tmp_path / 'downloaded').exists()
+    assert all(r != 'bytes=0-%d' % (len(standin.data) - 1) for r in standin.range_requests())
+
+    manifest = read_manifest(tmp_path)
+    assert sorted(manifest) == sorted(mat_files)
+    for name in mat_files:
+        path = str(tmp_path / 'mat_files' / name)
+        assert manifest[name] == [len(members[name]), zlib.crc32(members[name]), os.stat(path).st_mtime]
+
+
+def test_up_to_date(standin, tmp_path):
+    standin.set_data(make_zip(members), '"a"')
+    sync(standin, tmp_path)
+    standin.log.clear()
+    result = sync(standin, tmp_path)
+    assert result['fetched'] == []
+    assert result['up_to_date'] == 3
+    # only the end of the zip (central directory) is read
+    assert result['bytes'] < 2000
+    assert len(standin.range_requests()) <= 4
+
+
+def test_changed_members(standin, tmp_path):
+    standin.set_data(make_zip(members), '"a"')
+    sync(standin, tmp_path)
+    changed = dict(members)
+    changed['data/die1/device_b.mat'] = mat_data(35000, 5)
+    changed['data/die3/device_d.mat'] = mat_data(20000, 6)
+    standin.set_data(make_zip(changed), '"b"')
+    result = sync(standin, tmp_path)
+    assert sorted(result['fetched']) == sorted(str(tmp_path / 'mat_files' / name) for name in ('data/die1/device_b.mat', 'data/die3/device_d.mat'))
+    assert result['up_to_date'] == 2
+    for name in ('data/die1/device_b.mat', 'data/die3/device_d.mat'):
+        with open(str(tmp_path / 'mat_files' / name), 'rb') as file:
+            assert file.read() == changed[name]
+        assert read_manifest(tmp_path)[name][0:2] == [len(changed[name]), zlib.crc32(changed[name])]
+
+
+def test_changed_local_file(standin, tmp_path):
+    standin.set_data(make_zip(members), '"a"')
+    sync(standin, tmp_path)
+    path = str(tmp_path / 'mat_files' / 'data' / 'die1' / 'device_a.mat')
+    with open(path, 'wb') as file:
+        file.write(b'modified')
+    result = sync(standin, tmp_path)
+    assert result['fetched'] == [path]
+    with open(path, 'rb') as file:
+        assert file.read() == members['data/die1/device_a.mat']
+    assert read_manifest(tmp_path)['data/die1/device_a.mat'][0] == len(members['data/die1/device_a.mat'])
+
+
+def test_member_outside(standin, tmp_path):
+    standin.set_data(make_zip({'../outside.mat': b'x', 'inside.mat': b'y'}), '"a"')
+    result = sync(standin, tmp_path)
+    assert result['fetched'] == [str(tmp_path / 'mat_files' / 'inside.mat')]
+    assert not (tmp_path / 'outside.mat').exists()
+
+
+def test_no_range_support(standin, tmp_path):
+    standin.ranges = False
+    standin.set_data(make_zip(members), '"a"')
+    result = sync(standin, tmp_path)
+    assert len(result['fetched']) == 3
+    assert result['bytes'] == len(standin.data)
+    with open(str(tmp_path / 'mat_files' / 'data' / 'die2' / 'device_c.MAT'), 'rb') as file:
+        assert file.read() == members['data/die2/device_c.MAT']
+    assert sorted(read_manifest(tmp_path)) == sorted(name for name in members if name.lower().endswith('.mat'))